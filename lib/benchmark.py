@@ -0,0 +1,422 @@
+from collections import namedtuple
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import scipy
+import shapely
+
+from network import build_network_from_geodataframe, extend_network_with, write_network
+from snapping import build_snapping_index
+from compute_location_reach import compute_absolute_reach, compute_poi_reach, compute_buildings_reach
+from compute_accessibility_index import compute_accessibility_index_weighed_sum, compute_accessibility_index_pca, fit_pca_model, frame_chunks
+from tiled_reach import city_tiles, compute_tiled_absolute_reach
+from parquet_store import write_table
+
+from dotenv import load_dotenv
+
+# Load environment variables from a .env file
+load_dotenv()
+
+# Times the stages of the reach pipeline on synthetic cities - building the network, snapping the features to it,
+# the reach, the service index scoring and writing the results - for every backend and mode.
+# A run is written to BENCHMARK_DIR as json and compared with the baseline, the stages that got slower are reported.
+
+BENCHMARK_DIR = "lib/saves/benchmarks"
+BASELINE_PATH = f"{BENCHMARK_DIR}/baseline.json"
+# Blocks of SPACING meters, like the streets of a city
+SPACING = 50
+POI_TYPES = ['poi_schools', 'poi_health', 'poi_parks', 'poi_mobility']
+SUBGROUPS_PER_TYPE = 3
+# The networkx backend and the isochron mode are skipped on bigger networks, they would run for hours
+NETWORKX_MAX_EDGES = 200000
+# A stage is reported as a regression when it takes TOLERANCE times its baseline and at least MIN_SECONDS longer
+TOLERANCE = 1.25
+MIN_SECONDS = 0.05
+
+# The number of network edges, residential buildings and POIs (of all types) of a synthetic city
+CitySize = namedtuple('CitySize', ['edges', 'buildings', 'pois'])
+
+SIZES = {
+  'lozenec': CitySize(20000, 4000, 200),
+  'district': CitySize(200000, 40000, 2000),
+  'city': CitySize(1000000, 200000, 8000),
+  'metro': CitySize(3000000, 600000, 20000),
+}
+
+# backend -> modes: 'serial' and 'parallel' run the searches on one process or on workers,
+# 'tiled' runs compute_tiled_absolute_reach, building and snapping the network of every tile as it goes,
+# 'isochron' computes the reach of the POIs and buildings from their isochrons, like main.compute_isochron_accesibilities
+MODES = {
+  'networkx': ['serial', 'isochron'],
+  'csr': ['serial', 'parallel', 'tiled', 'isochron'],
+}
+
+def grid_side(edges):
+  """
+  The number of nodes per side of a square grid with about edges edges
+
+  >>> side = grid_side(20000)
+  >>> side, 2 * side * (side - 1)
+  (101, 20200)
+  """
+  return max(math.ceil((1 + math.sqrt(1 + 2 * edges)) / 2), 2)
+
+def grid_edges(side):
+  """
+  The (u, v) node positions of the horizontal and vertical edges of a side x side grid, node i * side + j is at column i, row j
+
+  >>> grid_edges(2).tolist()
+  [[0, 2], [1, 3], [0, 1], [2, 3]]
+  """
+  nodes = np.arange(side * side).reshape(side, side)
+  horizontal = np.stack([nodes[:-1, :].ravel(), nodes[1:, :].ravel()], axis=1)
+  vertical = np.stack([nodes[:, :-1].ravel(), nodes[:, 1:].ravel()], axis=1)
+
+  return np.concatenate([horizontal, vertical])
+
+def network_frame(lines):
+  """
+  The pedestrian network gdf of lines, like pedestrian_network_query returns, walked at 80 meters per minute
+  """
+  meters = shapely.length(lines)
+  return gpd.GeoDataFrame({'meters': meters, 'minutes': meters / 80, 'geom': lines}, geometry='geom', crs=7801)
+
+def synthetic_network(edges, kind = 'grid', spacing = SPACING, seed = 0):
+  """
+  A pedestrian network gdf of about edges lines.
+  kind: 'grid'|'irregular' - 'grid' is a square grid of straight blocks,
+    'irregular' moves the crossings, drops a fifth of the blocks, adds diagonals and bends every line
+
+  >>> gdf = synthetic_network(1000)
+  >>> gdf.shape[0], gdf.total_bounds.tolist()
+  (1012, [0.0, 0.0, 1100.0, 1100.0])
+  >>> synthetic_network(1000, kind = 'irregular').shape[0]
+  978
+  """
+  if kind not in ('grid', 'irregular'):
+    raise ValueError("kind = 'grid'|'irregular'")
+
+  side = grid_side(edges)
+  columns, rows = np.divmod(np.arange(side * side), side)
+  node_coords = np.stack([columns, rows], axis=1).astype(np.float64) * spacing
+  edge_nodes = grid_edges(side)
+  if kind == 'grid':
+    return network_frame(shapely.linestrings(node_coords[edge_nodes]))
+
+  rng = np.random.default_rng(seed)
+  node_coords += rng.uniform(-0.3, 0.3, node_coords.shape) * spacing
+  # Dropping a fifth of the blocks and adding a diagonal for a fifth of them keeps about the same number of edges
+  kept = edge_nodes[rng.random(edge_nodes.shape[0]) >= 0.2]
+  cells = np.flatnonzero((columns < side - 1) & (rows < side - 1))
+  cells = rng.choice(cells, size=min(kept.shape[0] // 4, cells.shape[0]), replace=False)
+  diagonals = np.stack([cells, cells + side + 1], axis=1)
+  edge_nodes = np.concatenate([kept, diagonals])
+
+  # Every line bends at a point moved away from its middle
+  ends = node_coords[edge_nodes]
+  middles = ends.mean(axis=1) + rng.normal(0, 0.1, (edge_nodes.shape[0], 2)) * spacing
+  return network_frame(shapely.linestrings(np.stack([ends[:, 0], middles, ends[:, 1]], axis=1)))
+
+def synthetic_buildings(bounds, count, seed = 1):
+  """
+  A residential buildings gdf of count square buildings of 10 to 30 meters scattered over bounds, like residential_buildings_query returns
+  """
+  rng = np.random.default_rng(seed)
+  xmin, ymin, xmax, ymax = bounds
+  centers = rng.uniform((xmin, ymin), (xmax, ymax), (count, 2))
+  halves = rng.uniform(5, 15, count)
+  geoms = shapely.box(centers[:, 0] - halves, centers[:, 1] - halves, centers[:, 0] + halves, centers[:, 1] + halves)
+
+  return gpd.GeoDataFrame({
+    'id': np.arange(count),
+    'geom': geoms,
+    'floors': rng.integers(1, 16, count),
+    'appartments': rng.integers(1, 80, count),
+  }, geometry='geom', crs=7801)
+
+def synthetic_pois(bounds, count, poi_types = POI_TYPES, seed = 2):
+  """
+  dict poi_type -> POI gdf (multipoints with a subgroup, like poi_query returns) with count POIs of all types together
+  """
+  rng = np.random.default_rng(seed)
+  xmin, ymin, xmax, ymax = bounds
+  pois = {}
+  for position, poi_type in enumerate(poi_types):
+    poi_count = count // len(poi_types) + (position < count % len(poi_types))
+    points = shapely.points(rng.uniform((xmin, ymin), (xmax, ymax), (poi_count, 2)))
+    pois[poi_type] = gpd.GeoDataFrame({
+      'id': np.arange(poi_count),
+      'geom': shapely.multipoints(points, indices=np.arange(poi_count)),
+      'subgroup': [f"{poi_type[4:]}_{subgroup}" for subgroup in rng.integers(0, SUBGROUPS_PER_TYPE, poi_count)],
+    }, geometry='geom', crs=7801)
+
+  return pois
+
+def synthetic_access_weights(poi_types = POI_TYPES, seed = 3):
+  """
+  The access weights of all subgroups of synthetic_pois, like the access_weights table
+  """
+  rng = np.random.default_rng(seed)
+  subgroups = [f"{poi_type[4:]}_{subgroup}" for poi_type in poi_types for subgroup in range(SUBGROUPS_PER_TYPE)]
+
+  return pd.DataFrame({'subgroup_id': subgroups, 'sgr_weights': rng.random(len(subgroups)), 'gr_weights': rng.random(len(subgroups))})
+
+def synthetic_city(size, kind = 'grid', seed = 0):
+  """
+  The pedestrian network, residential buildings, dict of POIs and access weights of a synthetic city of CitySize size
+  """
+  gdf_pedestrian_network = synthetic_network(size.edges, kind, seed = seed)
+  bounds = tuple(gdf_pedestrian_network.total_bounds)
+
+  return (
+    gdf_pedestrian_network,
+    synthetic_buildings(bounds, size.buildings, seed = seed + 1),
+    synthetic_pois(bounds, size.pois, seed = seed + 2),
+    synthetic_access_weights(seed = seed + 3),
+  )
+
+def timed(stages, stage, run):
+  """
+  Calls run, adds the seconds it took to stages[stage] and returns its result
+  """
+  start = time.perf_counter()
+  result = run()
+  stages[stage] = stages.get(stage, 0) + time.perf_counter() - start
+  return result
+
+def in_bounds(gdf, bounds):
+  return gdf.iloc[gdf.sindex.query(shapely.box(*bounds), predicate='intersects')].sort_index().reset_index(drop=True)
+
+def tiled_reach(gdf_pedestrian_network, pois, gdf_residentials, tile_size, workers, stages):
+  """
+  compute_tiled_absolute_reach over the synthetic city, the tiles are cut from the frames in memory.
+  The build, snapping and reach of all tiles are added up in stages
+  """
+  def load_tile(tile):
+    return (
+      in_bounds(gdf_pedestrian_network, tile.network_bounds),
+      {poi_type: in_bounds(gdf_poi_type, tile.features_bounds) for poi_type, gdf_poi_type in pois.items()},
+      in_bounds(gdf_residentials, tile.features_bounds),
+    )
+
+  tiles = city_tiles(tuple(gdf_residentials.total_bounds), tile_size, 1000)
+  pois_reach = {poi_type: [] for poi_type in pois}
+  residentials_reach = []
+  for _tile, tile_pois_reach, gdf_residentials_reach in compute_tiled_absolute_reach(load_tile, tiles, 'length', 1000, workers, lambda stage, run: timed(stages, stage, run)):
+    for poi_type, gdf_poi_reach in tile_pois_reach.items():
+      pois_reach[poi_type].append(gdf_poi_reach)
+    residentials_reach.append(gdf_residentials_reach)
+
+  return {poi_type: pd.concat(gdfs, ignore_index=True) for poi_type, gdfs in pois_reach.items()}, pd.concat(residentials_reach, ignore_index=True)
+
+def benchmark_case(city, backend, mode, workers = None, tile_size = 5000):
+  """
+  Runs the pipeline on city (see synthetic_city) once, returns the seconds every stage took:
+    build, snapping, reach, scoring, persist_network and persist_results. The isochron mode snaps the features
+    in its reach stage, as compute_poi_reach and compute_buildings_reach do, and persists no network.
+  A stage that cannot run here (a missing optional dependency like pyarrow) is None in the stages and its reason is in 'skipped'
+  workers: the processes of the parallel mode, None for all CPUs
+  """
+  if mode not in MODES[backend]:
+    raise ValueError(f"{backend} modes = {MODES[backend]}")
+
+  gdf_pedestrian_network, gdf_residentials, pois, df_access_weights = city
+  # extend_network_with adds the snapped nodes to the frames
+  gdf_residentials = gdf_residentials.copy()
+  pois = {poi_type: gdf_poi_type.copy() for poi_type, gdf_poi_type in pois.items()}
+  stages = {}
+  skipped = {}
+
+  if mode == 'tiled':
+    pois_reach, gdf_residentials_reach = tiled_reach(gdf_pedestrian_network, pois, gdf_residentials, tile_size, workers, stages)
+    pedestrian_network = None
+  elif mode == 'isochron':
+    pedestrian_network = timed(stages, 'build', lambda: build_network_from_geodataframe(gdf_pedestrian_network, backend = backend))
+
+    def isochron_reach():
+      pois_reach = {poi_type: compute_poi_reach(pedestrian_network, gdf_poi_type, gdf_residentials, 'length', 1000) for poi_type, gdf_poi_type in pois.items()}
+      return pois_reach, compute_buildings_reach(pedestrian_network, gdf_residentials, list(pois.values()), 'length', 1000)
+
+    pois_reach, gdf_residentials_reach = timed(stages, 'reach', isochron_reach)
+    pedestrian_network = None
+  else:
+    pedestrian_network = timed(stages, 'build', lambda: build_network_from_geodataframe(gdf_pedestrian_network, backend = backend))
+
+    def snap():
+      snapping_index = build_snapping_index(pedestrian_network)
+      for gdf in [*pois.values(), gdf_residentials]:
+        extend_network_with(pedestrian_network, gdf, snapping_index if backend == 'csr' else None)
+
+    timed(stages, 'snapping', snap)
+    pois_reach, gdf_residentials_reach = timed(stages, 'reach', lambda: compute_absolute_reach(
+      pedestrian_network, pois, gdf_residentials, 'length', 1000, workers = 1 if mode == 'serial' else workers,
+    ))
+
+  def score():
+    gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
+    model = fit_pca_model(lambda: frame_chunks(gdf_residentials_with_access_index), df_access_weights)
+    return compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca', model = model)
+
+  gdf_residentials_with_access_index = timed(stages, 'scoring', score)
+
+  with tempfile.TemporaryDirectory() as directory:
+    if pedestrian_network is not None and backend == 'csr':
+      timed(stages, 'persist_network', lambda: write_network(os.path.join(directory, 'network'), pedestrian_network, {**pois, 'residentials': gdf_residentials}))
+
+    def persist_results():
+      for poi_type, gdf_poi_reach in pois_reach.items():
+        write_table(directory, f"results_{poi_type}_reach_benchmark", gdf_poi_reach)
+      write_table(directory, "results_residentials_service_level_benchmark", gdf_residentials_with_access_index)
+
+    try:
+      timed(stages, 'persist_results', persist_results)
+    except ImportError as e:
+      stages['persist_results'] = None
+      skipped['persist_results'] = str(e)
+
+  return {'stages': stages, 'skipped': skipped}
+
+def benchmark_key(result):
+  return (result['size'], result['network'], result['backend'], result['mode'])
+
+def run_benchmarks(sizes, kinds = ('grid', 'irregular'), modes = MODES, workers = None, repeat = 1, tile_size = 5000):
+  """
+  benchmark_case for every size name of SIZES, network kind, backend and mode.
+  repeat: the number of runs of every case, the fastest time of every stage is kept
+  Returns a list of results with the case, the sizes of its city and the seconds of every stage
+  """
+  results = []
+  for size_name in sizes:
+    size = SIZES[size_name]
+    for kind in kinds:
+      city = synthetic_city(size, kind)
+      for backend, backend_modes in modes.items():
+        for mode in backend_modes:
+          result = {
+            'size': size_name,
+            'network': kind,
+            'backend': backend,
+            'mode': mode,
+            'edges': int(city[0].shape[0]),
+            'buildings': int(city[1].shape[0]),
+            'pois': int(sum(gdf.shape[0] for gdf in city[2].values())),
+          }
+          if (backend == 'networkx' or mode == 'isochron') and size.edges > NETWORKX_MAX_EDGES:
+            result.update(stages={}, skipped={'all': f"more than {NETWORKX_MAX_EDGES} edges"})
+            results.append(result)
+            continue
+
+          runs = [benchmark_case(city, backend, mode, workers, tile_size) for _ in range(repeat)]
+          result['stages'] = {stage: None if stage in runs[0]['skipped'] else min(run['stages'][stage] for run in runs) for stage in runs[0]['stages']}
+          result['skipped'] = runs[0]['skipped']
+          print(f"{size_name} {kind} {backend} {mode}: " + ", ".join(f"{stage} skipped" if seconds is None else f"{stage} {seconds:.2f}s" for stage, seconds in result['stages'].items()))
+          results.append(result)
+
+  return results
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def benchmark_environment(workers):
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'workers': workers,
+    'numpy': np.__version__,
+    'scipy': scipy.__version__,
+    'shapely': shapely.__version__,
+    'geopandas': gpd.__version__,
+  }
+
+def save_benchmarks(path, results, workers):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, 'w') as file:
+    json.dump({
+      'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'commit': git_commit(),
+      'environment': benchmark_environment(workers),
+      'results': results,
+    }, file, indent=2)
+  print(f"Benchmarks saved to {path}")
+
+def load_benchmarks(path):
+  with open(path) as file:
+    return json.load(file)
+
+def compare_benchmarks(results, baseline_results, tolerance = TOLERANCE, min_seconds = MIN_SECONDS):
+  """
+  The stages of results that take tolerance times longer than in the baseline and at least min_seconds more.
+  Cases and stages missing from the baseline, or skipped in either run, are not compared
+
+  >>> baseline = [{'size': 'lozenec', 'network': 'grid', 'backend': 'csr', 'mode': 'serial', 'stages': {'build': 1.0, 'reach': 0.01}}]
+  >>> results = [{'size': 'lozenec', 'network': 'grid', 'backend': 'csr', 'mode': 'serial', 'stages': {'build': 1.5, 'reach': 0.02}}]
+  >>> compare_benchmarks(results, baseline)
+  [{'size': 'lozenec', 'network': 'grid', 'backend': 'csr', 'mode': 'serial', 'stage': 'build', 'baseline': 1.0, 'seconds': 1.5, 'ratio': 1.5}]
+  >>> results[0]['stages'].update(build=None, persist_results=1.0)
+  >>> baseline[0]['stages']['persist_results'] = None
+  >>> compare_benchmarks(results, baseline)
+  []
+  """
+  baseline_stages = {benchmark_key(result): result['stages'] for result in baseline_results}
+  regressions = []
+  for result in results:
+    stages = baseline_stages.get(benchmark_key(result), {})
+    for stage, seconds in result['stages'].items():
+      if seconds is not None and stages.get(stage) is not None and seconds > stages[stage] * tolerance and seconds - stages[stage] >= min_seconds:
+        regressions.append({
+          **dict(zip(['size', 'network', 'backend', 'mode'], benchmark_key(result))),
+          'stage': stage,
+          'baseline': stages[stage],
+          'seconds': seconds,
+          'ratio': round(seconds / stages[stage], 2),
+        })
+
+  return regressions
+
+def main():
+  # BENCHMARK_SIZES: names of SIZES, comma separated
+  SIZE_NAMES = [size for size in os.getenv('BENCHMARK_SIZES', 'lozenec').split(',') if size.strip()]
+  KINDS = [kind for kind in os.getenv('BENCHMARK_NETWORKS', 'grid,irregular').split(',') if kind.strip()]
+  # BENCHMARK_MODES: backend:mode pairs, comma separated (e.g. csr:serial,csr:parallel), all MODES when empty
+  modes = {}
+  for backend_mode in os.getenv('BENCHMARK_MODES', '').split(','):
+    if backend_mode.strip():
+      backend, mode = backend_mode.strip().split(':')
+      modes.setdefault(backend, []).append(mode)
+  WORKERS = int(os.getenv('BENCHMARK_WORKERS')) if os.getenv('BENCHMARK_WORKERS') else None
+  REPEAT = int(os.getenv('BENCHMARK_REPEAT', 1))
+  TILE_SIZE = float(os.getenv('BENCHMARK_TILE_SIZE', 5000))
+  BASELINE = os.getenv('BENCHMARK_BASELINE', BASELINE_PATH)
+  # BENCHMARK_SAVE_BASELINE=1 stores the run as the new baseline
+  SAVE_BASELINE = os.getenv('BENCHMARK_SAVE_BASELINE', '0') == '1'
+
+  unknown = [size for size in SIZE_NAMES if size not in SIZES]
+  if unknown:
+    raise ValueError(f"Unknown sizes {unknown}, BENCHMARK_SIZES = {','.join(SIZES)}")
+
+  results = run_benchmarks(SIZE_NAMES, KINDS, modes or MODES, WORKERS, REPEAT, TILE_SIZE)
+  save_benchmarks(f"{BENCHMARK_DIR}/run_{time.strftime('%Y%m%d_%H%M%S')}.json", results, WORKERS)
+
+  if SAVE_BASELINE:
+    save_benchmarks(BASELINE, results, WORKERS)
+  elif os.path.exists(BASELINE):
+    regressions = compare_benchmarks(results, load_benchmarks(BASELINE)['results'])
+    for regression in regressions:
+      print(f"Regression {regression['size']} {regression['network']} {regression['backend']} {regression['mode']} {regression['stage']}: {regression['baseline']:.2f}s -> {regression['seconds']:.2f}s (x{regression['ratio']})")
+    if regressions:
+      raise SystemExit(1)
+    print(f"No regressions against {BASELINE}")
+
+if __name__ == "__main__":
+  main()
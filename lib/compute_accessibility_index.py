@@ -1,33 +1,86 @@
+from collections import namedtuple
+import os
+import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
 from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+
+from network_cache import cache_key, is_cached, save_arrays, load_manifest, load_array
+
+PCA_MODEL_DIR = "lib/saves/pca_models"
+CHUNK_SIZE = 100000
+
+# The PCA service index fitted once and reused, so scores of different runs are comparable.
+#   columns:    the subgroup ids, the features of the index
+#   weights:    gr_weights * sgr_weights of every subgroup, applied to its counts before scaling
+#   mean:       the mean of every weighted feature
+#   scale:      the standard deviation of every weighted feature
+#   pca_mean:   the mean of the standardized features seen by the PCA
+#   components: the principal components explaining 95% of the variance
+#   min_score:  the smallest raw score of the fitted buildings, it scores 0
+#   max_score:  the largest raw score of the fitted buildings, it scores 100
+PCAModel = namedtuple('PCAModel', ['columns', 'weights', 'mean', 'scale', 'pca_mean', 'components', 'min_score', 'max_score'])
+
+def access_weight_vector(columns, df_access_wheights):
+  """
+  The subgroup columns among columns and the weight of each, gr_weights * sgr_weights
+
+  >>> df_access_wheights = pd.DataFrame({'subgroup_id': ['parks', 'schools'], 'gr_weights': [0.5, 0.25], 'sgr_weights': [2, 4]})
+  >>> access_weight_vector(['id', 'schools', 'parks'], df_access_wheights)
+  (['schools', 'parks'], array([1., 1.]))
+  """
+  weights_map = df_access_wheights.set_index('subgroup_id')[['gr_weights', 'sgr_weights']].to_dict('index')
+  subgroup_columns = [col for col in columns if col in weights_map]
+  weights = np.array([float(weights_map[col]['gr_weights']) * float(weights_map[col]['sgr_weights']) for col in subgroup_columns], dtype=np.float64)
+
+  return subgroup_columns, weights
 
 def compute_accessibility_index_weighed_sum(gdf_residentials, df_access_wheights, column_name):
   """
     column_name: string - The name of the accessibility index column in the resulting df
+    The sum of the weights of the subgroups with at least one poi within reach of the building,
+    computed from the building x subgroup matrix of reached subgroups and the weight vector
+
+  >>> df_access_wheights = pd.DataFrame({'subgroup_id': ['parks', 'schools'], 'gr_weights': [0.5, 0.25], 'sgr_weights': [2, 4]})
+  >>> df = pd.DataFrame({'id': [1, 2, 3], 'parks': [3, 0, None], 'schools': [1, None, 0]})
+  >>> compute_accessibility_index_weighed_sum(df, df_access_wheights, 'service_index')['service_index'].tolist()
+  [2.0, 0.0, 0.0]
+
+  Every building gets exactly the sum of its weights added one by one in column order
+
+  >>> rng = np.random.default_rng(0)
+  >>> df_access_wheights = pd.DataFrame({'subgroup_id': [f"s{i}" for i in range(40)], 'gr_weights': rng.random(40), 'sgr_weights': rng.random(40)})
+  >>> df = pd.DataFrame(rng.integers(0, 2, (1000, 40)), columns=df_access_wheights['subgroup_id'])
+  >>> weights = (df_access_wheights['gr_weights'] * df_access_wheights['sgr_weights']).tolist()
+  >>> row_sums = [sum(weight for weight, count in zip(weights, row) if count > 0) for row in df.itertuples(index=False)]
+  >>> compute_accessibility_index_weighed_sum(df, df_access_wheights, 'service_index')['service_index'].tolist() == row_sums
+  True
   """
-  weights_map = df_access_wheights.set_index('subgroup_id')[['gr_weights', 'sgr_weights']].to_dict('index')
+  subgroup_columns, weights = access_weight_vector(gdf_residentials.columns, df_access_wheights)
   df = gdf_residentials.copy()
 
-  def calculate_service_level(row):
-    total = 0
-    for col in row.index:
-      if col in weights_map:
-        gr_weight = weights_map[col]['gr_weights']
-        sgr_weight = weights_map[col]['sgr_weights']
-        if pd.notna(row[col]) and row[col] > 0:
-          total += float(gr_weight) * float(sgr_weight)
-    return total
-
-  df[column_name] = df.apply(calculate_service_level, axis=1)
+  # NaN compares False, a building not reached by a subgroup does not get its weight
+  reached = df[subgroup_columns].to_numpy(dtype=np.float64, na_value=np.nan).T > 0
+  # Summed a subgroup at a time in column order rather than with reached @ weights, the floating point sums stay the same as the row by row ones
+  index = np.zeros(df.shape[0], dtype=np.float64)
+  for subgroup_reached, weight in zip(reached, weights):
+    index += subgroup_reached * weight
+  df[column_name] = index
 
   return df
 
-def compute_accessibility_index_pca(gdf_residentials, df_access_weights, column_name):
+def compute_accessibility_index_pca(gdf_residentials, df_access_weights, column_name, model = None):
   """
     column_name: string - The name of the accessibility index column in the resulting df
+    model: PCAModel to score the buildings with (see fit_pca_model), without it the PCA is fitted on gdf_residentials alone
   """
+  if model is not None:
+    df = gdf_residentials.copy()
+    df[column_name] = np.concatenate([np.array([]), *(pca_service_index(model, chunk) for chunk in frame_chunks(df))])
+    return df
+
   weights_map = df_access_weights.set_index('subgroup_id')[['gr_weights', 'sgr_weights']].to_dict('index')
   
   # Make a working copy and we need to adjust the features
@@ -66,3 +119,182 @@ def compute_accessibility_index_pca(gdf_residentials, df_access_weights, column_
   df[column_name] = 100 * (raw_accessibility - min_raw_score) / (max_raw_score - min_raw_score)
   
   return df
+
+def regions_service_level(gdf_regions, gdf_residentials, region_columns):
+  """
+  The service level of every region with buildings in it, as main.create_regions_with_service_level computes it in the database.
+  A region without appartments gets a weighted index of 0
+  region_columns: the columns of gdf_regions to keep, with its geometry
+
+  >>> gdf_regions = gpd.GeoDataFrame({'id': [1, 2, 3], 'geom': [shapely.box(0, 0, 10, 10), shapely.box(10, 0, 20, 10), shapely.box(20, 0, 30, 10)]}, geometry='geom')
+  >>> gdf_residentials = gpd.GeoDataFrame({'id': [1, 2, 3], 'service_index': [1., 3., 2.], 'service_index_pca': [10., 30., 20.], 'appcount': [1, 3, 0], 'geom': [shapely.Point(1, 1), shapely.Point(2, 2), shapely.Point(15, 5)]}, geometry='geom')
+  >>> regions_service_level(gdf_regions, gdf_residentials, ['id'])[['id', 'service_index', 'weighted_service_index', 'buildings_count']]
+     id  service_index  weighted_service_index  buildings_count
+  0   1            2.0                     2.5                2
+  1   2            2.0                     0.0                1
+
+  A building on the boundary of regions is in none of them, as with ST_Contains
+
+  >>> on_boundary = gdf_residentials.assign(geom=[shapely.Point(1, 1), shapely.Point(10, 5), shapely.Point(15, 0)])
+  >>> regions_service_level(gdf_regions, on_boundary, ['id'])[['id', 'buildings_count']]
+     id  buildings_count
+  0   1                1
+  """
+  gdf_regions = gdf_regions.reset_index(drop=True)
+  residentials = pd.DataFrame({
+    'service_index': gdf_residentials['service_index'].to_numpy(),
+    'weighted_service_index': (gdf_residentials['service_index'] * gdf_residentials['appcount']).to_numpy(),
+    'service_index_pca': gdf_residentials['service_index_pca'].to_numpy(),
+    'weighted_service_index_pca': (gdf_residentials['service_index_pca'] * gdf_residentials['appcount']).to_numpy(),
+    'appcount': gdf_residentials['appcount'].to_numpy(),
+  })
+  # A building within a region is one the region ST_Contains, its boundary is not in it
+  buildings, regions = gdf_regions.sindex.query(gdf_residentials.geometry.values, predicate='within')
+  grouped = residentials.iloc[buildings].groupby(regions)
+  sums = grouped.sum()
+  counts = grouped.size()
+
+  gdf_regions_service_level = gdf_regions.loc[sums.index, [*region_columns, gdf_regions.geometry.name]].reset_index(drop=True)
+  appcount = sums['appcount'].to_numpy()
+  gdf_regions_service_level['service_index'] = sums['service_index'].to_numpy() / counts.to_numpy()
+  gdf_regions_service_level['weighted_service_index'] = np.divide(sums['weighted_service_index'].to_numpy(), appcount, out=np.zeros(appcount.shape[0]), where=appcount != 0)
+  gdf_regions_service_level['service_index_pca'] = sums['service_index_pca'].to_numpy() / counts.to_numpy()
+  gdf_regions_service_level['weighted_service_index_pca'] = np.divide(sums['weighted_service_index_pca'].to_numpy(), appcount, out=np.zeros(appcount.shape[0]), where=appcount != 0)
+  gdf_regions_service_level['appcount'] = appcount
+  gdf_regions_service_level['buildings_count'] = counts.to_numpy()
+
+  return gdf_regions_service_level
+
+def frame_chunks(df, chunk_size = CHUNK_SIZE):
+  for start in range(0, df.shape[0], chunk_size):
+    yield df.iloc[start:start + chunk_size]
+
+def pca_features(df, columns, weights):
+  """
+  The weighted subgroup counts of every building, a subgroup missing from df or not reaching a building counts 0
+
+  >>> pca_features(pd.DataFrame({'parks': [1, None], 'id': [1, 2]}), ['parks', 'schools'], np.array([2., 3.]))
+  array([[2., 0.],
+         [0., 0.]])
+  """
+  features = np.zeros((df.shape[0], len(columns)), dtype=np.float64)
+  for position, col in enumerate(columns):
+    if col in df.columns:
+      features[:, position] = np.nan_to_num(df[col].to_numpy(dtype=np.float64, na_value=np.nan) * weights[position])
+
+  return features
+
+def feature_batches(load_chunks, columns, weights, min_rows):
+  """
+  The features of the chunks in batches of at least min_rows, small chunks are joined with the next ones
+  and a small last one with the batch before it
+  """
+  batch = None
+  pending = []
+  pending_rows = 0
+  for chunk in load_chunks():
+    pending.append(pca_features(chunk, columns, weights))
+    pending_rows += chunk.shape[0]
+    if pending_rows >= min_rows:
+      if batch is not None:
+        yield batch
+      batch = np.concatenate(pending)
+      pending = []
+      pending_rows = 0
+  if pending:
+    batch = np.concatenate(pending if batch is None else [batch, *pending])
+  if batch is not None:
+    yield batch
+
+def fit_pca_model(load_chunks, df_access_weights, explained_variance = 0.95):
+  """
+  Fits the PCA service index one chunk of buildings at a time, only a chunk is in memory at once.
+  load_chunks: called with no arguments, returns an iterable of residential frames with the subgroup counts.
+    It is read three times - to fit the scaler, the PCA and to find the range of the scores
+
+  >>> df_access_weights = pd.DataFrame({'subgroup_id': ['parks', 'schools', 'health'], 'gr_weights': [1., 1., 1.], 'sgr_weights': [1., 2., 3.]})
+  >>> df = pd.DataFrame({'parks': [1, 0], 'schools': [0, 2], 'health': [1, 1]})
+  >>> model = fit_pca_model(lambda: frame_chunks(df, 1), df_access_weights)
+  >>> model.components.shape[1], pca_service_index(model, df).round(6).tolist()
+  (3, [0.0, 100.0])
+  """
+  weights_map = df_access_weights.set_index('subgroup_id')[['gr_weights', 'sgr_weights']].to_dict('index')
+  columns = pd.Index(list(weights_map.keys())).tolist()
+  weights = np.array([float(weights_map[col]['gr_weights']) * float(weights_map[col]['sgr_weights']) for col in columns], dtype=np.float64)
+
+  scaler = StandardScaler()
+  for features in feature_batches(load_chunks, columns, weights, 1):
+    scaler.partial_fit(features)
+
+  rows = int(scaler.n_samples_seen_) if hasattr(scaler, 'n_samples_seen_') else 0
+  if rows == 0:
+    raise ValueError("No buildings to fit the PCA service index on")
+
+  # Every batch of the incremental PCA needs at least as many buildings as there are components,
+  # there are not more components than buildings
+  n_components = min(len(columns), rows)
+  pca = IncrementalPCA(n_components=n_components)
+  for features in feature_batches(load_chunks, columns, weights, n_components):
+    pca.partial_fit(scaler.transform(features))
+
+  num_components = np.argmax(np.cumsum(pca.explained_variance_ratio_) >= explained_variance) + 1
+  model = PCAModel(columns, weights, scaler.mean_, scaler.scale_, pca.mean_, pca.components_[:num_components], np.inf, -np.inf)
+
+  min_score, max_score = np.inf, -np.inf
+  for features in feature_batches(load_chunks, columns, weights, 1):
+    raw_scores = raw_pca_scores(model, features)
+    min_score, max_score = min(min_score, raw_scores.min()), max(max_score, raw_scores.max())
+
+  return model._replace(min_score=float(min_score), max_score=float(max_score))
+
+def raw_pca_scores(model, features):
+  standardized = (features - model.mean) / model.scale
+  return np.sum((standardized - model.pca_mean) @ model.components.T, axis=1)
+
+def pca_service_index(model, df):
+  """
+  The service index of the buildings of df on the 0-100 scale of the fitted buildings,
+  new buildings better or worse served than all fitted ones score above 100 or below 0
+  """
+  raw_scores = raw_pca_scores(model, pca_features(df, model.columns, model.weights))
+  return 100 * (raw_scores - model.min_score) / (model.max_score - model.min_score)
+
+def score_accessibility_index_pca(model, chunks, column_name):
+  """
+  Scores the buildings with the fitted model one chunk at a time, only a chunk is in memory at once
+  chunks: iterable of residential frames
+  Yields a copy of every chunk with column_name added
+  """
+  for chunk in chunks:
+    chunk = chunk.copy()
+    chunk[column_name] = pca_service_index(model, chunk)
+    yield chunk
+
+def pca_model_path(df_access_weights, *parts, cache_dir = PCA_MODEL_DIR):
+  """
+  A model is kept per set of access weights and parts (like the results table it scores and the model version)
+  """
+  weights = df_access_weights[['subgroup_id', 'gr_weights', 'sgr_weights']].to_dict('records')
+  return os.path.join(cache_dir, cache_key(weights, *parts))
+
+def save_pca_model(path, model):
+  arrays = {field: np.asarray(value, dtype=np.float64) for field, value in model._asdict().items() if field not in ('columns', 'min_score', 'max_score')}
+  save_arrays(path, arrays, {'columns': model.columns, 'min_score': model.min_score, 'max_score': model.max_score})
+
+def load_pca_model(path):
+  manifest = load_manifest(path)
+  arrays = {field: load_array(path, field) for field in ('weights', 'mean', 'scale', 'pca_mean', 'components')}
+  return PCAModel(manifest['columns'], min_score=manifest['min_score'], max_score=manifest['max_score'], **arrays)
+
+def cached_pca_model(path, fit_model):
+  """
+  path: pca_model_path, or None to always fit
+  fit_model: called to fit the model when it is not saved yet
+  """
+  if path and is_cached(path):
+    return load_pca_model(path)
+
+  model = fit_model()
+  if path:
+    save_pca_model(path, model)
+  return model
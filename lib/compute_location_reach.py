@@ -1,33 +1,57 @@
 import geopandas as gpd
-from shapely.geometry import MultiPoint
+import networkx as nx
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import MultiPoint, Point
 from tqdm import tqdm # progressbar
 
-from network import find_nearest_node, compute_accessibility_isochron, snap_point_to_edge, nearby_nodes
+from network import compute_accessibility_isochron, snap_to_network, is_csr_network, build_locations_tree, locations_within_isochron
+from csr_network import reached_nodes, node_arrays, nearest_source_costs
+from feature_index import build_feature_index, reachable_rows
+from parallel_reach import parallel_reach
+from pipeline import checkpointed_chunks
+from reach_table import reach_table_from_reached, reach_table_from_pairs, reach_table_within, remap_reach_table, pair_pois, poi_totals, building_subgroup_counts, building_subgroup_distances
 
 def accessibility_area(network, source_location, weight_type, max_weight):
   return compute_accessibility_isochron(network, source_location, weight_type, max_weight)
 
-def within_accessibility_area(accessibility_polygon, gdf_locations):
-  return gdf_locations[gdf_locations.geom.apply(lambda x: x.within(accessibility_polygon))]
+def within_accessibility_area(accessibility_polygon, gdf_locations, locations_tree = None):
+  """
+  locations_tree: build_locations_tree of gdf_locations.geom, pass it when testing the same locations against many polygons
+  """
+  if locations_tree is None:
+    locations_tree = build_locations_tree(gdf_locations.geom)
+  return gdf_locations.iloc[locations_within_isochron(locations_tree, accessibility_polygon)]
+
+def reach_from(network, source_node, weight_type, max_weight):
+  """
+  The cost to every accessible node of an nx.Graph, or the reached_nodes of a CSRNetwork
+  """
+  if is_csr_network(network):
+    return reached_nodes(network, source_node, weight_type, max_weight)
+  return nx.single_source_dijkstra_path_length(network, source_node, cutoff = max_weight, weight = weight_type)
 
 def compute_poi_absolute_reach(pedestrian_network, gdf_points_of_interest, gdf_residential_buildings, weight_type = 'length', max_weight = 1000):
   poi_reach = []
+  residentials_index = build_feature_index(pedestrian_network, gdf_residential_buildings["snapped_to_node"])
+  appartments = gdf_residential_buildings['appartments'].to_numpy()
 
   for i, poi in tqdm(gdf_points_of_interest.iterrows(), total=gdf_points_of_interest.shape[0], desc="Processing poi"):
     # Make sure to use the precomputed snapped_to_node, as recomputing it might result in a different node as the network has changes since adding it
     poi_node = poi["snapped_to_node"]
-    accessible_nodes = nearby_nodes(pedestrian_network, poi_node, weight_type, max_weight)
-    serviced_buildings = gdf_residential_buildings[gdf_residential_buildings["snapped_to_node"].apply(lambda x: x in accessible_nodes)]
+    reach = reach_from(pedestrian_network, poi_node, weight_type, max_weight)
+    serviced = reachable_rows(pedestrian_network, residentials_index, poi_node, reach, weight_type, max_weight)
 
-    # if serviced_buildings.empty:
+    # if serviced.size == 0:
     #   # TODO: Mark the POIs that do not serve any buildings, will be interesting to investigate them
 
     poi_reach.append({
       'id': poi.id,
       'geom': poi.geom,
       'subgroup': poi.subgroup,
-      'buildings_within_reach': serviced_buildings.shape[0],
-      'appartments_within_reach': serviced_buildings['appartments'].sum(),
+      'buildings_within_reach': serviced.shape[0],
+      'appartments_within_reach': appartments[serviced].sum(),
     })
 
   gdf_poi_reach = gpd.GeoDataFrame(poi_reach, geometry='geom')
@@ -35,38 +59,43 @@ def compute_poi_absolute_reach(pedestrian_network, gdf_points_of_interest, gdf_r
 
   return gdf_poi_reach
 
-def compute_poi_reach(pedestrian_network, gdf_points_of_interest, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, snap_to = 'edge'):
-  poi_reach = []
+def compute_poi_reach(pedestrian_network, gdf_points_of_interest, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, snap_to = 'edge', checkpoint = None):
+  """
+  checkpoint: directory the reach is written to in chunks of POIs as it goes (see pipeline.checkpointed_chunks),
+    a rerun with the same inputs resumes after the last finished chunk
+  """
 
   # Not sure if this should be at that level. Should strike a balance between coping and keeping the graph small
-  # When we snap_to node the network does not change, no need to copy it
-  pedestrian_network_copy = pedestrian_network.copy() if snap_to == 'egde' else pedestrian_network
-
-  for i, poi in tqdm(gdf_points_of_interest.iterrows(), total=gdf_points_of_interest.shape[0], desc="Processing poi"):
-    # TODO: This could be extended to work with MultiPoint and take into account different entrances of parks/buildings when computing the reach
-    # The data I have currently has a single point wraped in MultiPoint
-    poi_geom = poi.geom.geoms[0] if isinstance(poi.geom, MultiPoint) else poi.geom
-    if snap_to == 'edge':
-      poi_aprox_node_id = snap_point_to_edge(pedestrian_network_copy, poi_geom)
-    elif snap_to == 'node': # snap to node
-      poi_aprox_node_id = find_nearest_node(pedestrian_network_copy, poi_geom)
-    else:
-      raise "snap_to = 'node'|'edge'"
-
-    accessibility_polygon = accessibility_area(pedestrian_network_copy, poi_aprox_node_id, weight_type, max_weight)
-    serviced_buildings = within_accessibility_area(accessibility_polygon, gdf_residential_buildings)
-
-    # if serviced_buildings.empty:
-    #   # TODO: Mark the POIs that do not serve any buildings, will be interesting to investigate them
-
-    poi_reach.append({
-      'id': poi.id,
-      'geom': poi.geom,
-      'subgroup': poi.subgroup,
-      'buildings_within_reach': serviced_buildings.shape[0],
-      'appartments_within_reach': serviced_buildings['appartments'].sum(),
-      'service_distance_polygon': accessibility_polygon,
-    })
+  # When we snap_to node or work with a CSRNetwork (virtual nodes) the network does not change, no need to copy it
+  pedestrian_network_copy = pedestrian_network.copy() if snap_to == 'edge' and not is_csr_network(pedestrian_network) else pedestrian_network
+
+  # TODO: This could be extended to work with MultiPoint and take into account different entrances of parks/buildings when computing the reach
+  # The data I have currently has a single point wraped in MultiPoint
+  poi_geoms = gdf_points_of_interest.geom.apply(lambda geom: geom.geoms[0] if isinstance(geom, MultiPoint) else geom)
+  poi_aprox_node_ids = snap_to_network(pedestrian_network_copy, poi_geoms, snap_to)
+  residentials_tree = build_locations_tree(gdf_residential_buildings.geom)
+
+  def pois_chunk(start, stop):
+    chunk_reach = []
+    for (i, poi), poi_aprox_node_id in zip(gdf_points_of_interest.iloc[start:stop].iterrows(), poi_aprox_node_ids[start:stop]):
+      accessibility_polygon = accessibility_area(pedestrian_network_copy, poi_aprox_node_id, weight_type, max_weight)
+      serviced_buildings = within_accessibility_area(accessibility_polygon, gdf_residential_buildings, residentials_tree)
+
+      # if serviced_buildings.empty:
+      #   # TODO: Mark the POIs that do not serve any buildings, will be interesting to investigate them
+
+      chunk_reach.append({
+        'id': poi.id,
+        'geom': poi.geom,
+        'subgroup': poi.subgroup,
+        'buildings_within_reach': serviced_buildings.shape[0],
+        'appartments_within_reach': serviced_buildings['appartments'].sum(),
+        'service_distance_polygon': accessibility_polygon,
+      })
+    return chunk_reach
+
+  chunks = checkpointed_chunks(checkpoint, gdf_points_of_interest.shape[0], pois_chunk, desc="Processing poi")
+  poi_reach = [poi_info for chunk in chunks for poi_info in chunk]
 
   gdf_poi_reach = gpd.GeoDataFrame(poi_reach, geometry='geom')
   gdf_poi_reach.set_crs(epsg=7801, inplace=True)
@@ -75,11 +104,14 @@ def compute_poi_reach(pedestrian_network, gdf_points_of_interest, gdf_residentia
 
 def compute_buildings_absolute_reach(pedestrian_network, gdf_residential_buildings, pois, weight_type = 'length', max_weight = 1000):
   residentials_reach = []
+  pois = list(pois)
+  pois_indices = [build_feature_index(pedestrian_network, gdf_poi_type["snapped_to_node"]) for gdf_poi_type in pois]
+  pois_subgroups = [pd.factorize(gdf_poi_type['subgroup']) for gdf_poi_type in pois]
 
   for i, residential in tqdm(gdf_residential_buildings.iterrows(), total=gdf_residential_buildings.shape[0], desc="Processing poi"):
     # Make sure to use the precomputed snapped_to_node, as recomputing it might result in a different node as the network has changes since adding it
     residential_node = residential["snapped_to_node"]
-    accessible_nodes = nearby_nodes(pedestrian_network, residential_node, weight_type, max_weight)
+    reach = reach_from(pedestrian_network, residential_node, weight_type, max_weight)
 
     buidling_info = {
       'id': residential.id,
@@ -88,9 +120,12 @@ def compute_buildings_absolute_reach(pedestrian_network, gdf_residential_buildin
       'appcount': residential['appartments'],
     }
 
-    for gdf_poi_type in pois:
-      reachable_pois = gdf_poi_type[gdf_poi_type["snapped_to_node"].apply(lambda x: x in accessible_nodes)]
-      buidling_info.update(reachable_pois['subgroup'].value_counts().to_dict())
+    for poi_index, (subgroup_codes, subgroups) in zip(pois_indices, pois_subgroups):
+      reachable_pois = reachable_rows(pedestrian_network, poi_index, residential_node, reach, weight_type, max_weight)
+      reachable_codes = subgroup_codes[reachable_pois]
+      # Missing subgroups are factorized to -1 and not counted
+      subgroup_counts = np.bincount(reachable_codes[reachable_codes >= 0], minlength=len(subgroups))
+      buidling_info.update({subgroups[code]: int(subgroup_counts[code]) for code in np.flatnonzero(subgroup_counts)})
 
     residentials_reach.append(buidling_info)
 
@@ -100,39 +135,318 @@ def compute_buildings_absolute_reach(pedestrian_network, gdf_residential_buildin
   return gdf_residentials_reach
 
 
-def compute_buildings_reach(pedestrian_network, gdf_residential_buildings, pois, weight_type = 'length', max_weight = 1000, snap_to = 'edge'):
-  residentials_reach = []
-
-  # Not sure if this should be at that level. Should strike a balance between coping and keeping the graph small
-  # When we snap_to node the network does not change, no need to copy it
-  pedestrian_network_copy = pedestrian_network.copy() if snap_to == 'egde' else pedestrian_network
+def compute_reach_table(pedestrian_network, pois, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, workers = 1, checkpoint = None):
+  """
+  Searches once from every POI and collects the buildings within reach and their distance in a ReachTable.
+  The POIs are in the order of pois, one poi type after the other.
+
+  pois: dict - poi_type -> gdf with snapped_to_node
+  workers: number of processes running the searches on a CSRNetwork, None for all CPUs
+  checkpoint: directory the searches are written to in chunks of POIs as they go (see pipeline.checkpointed_chunks),
+    a rerun with the same inputs resumes after the last finished chunk
+  """
+  residentials_index = build_feature_index(pedestrian_network, gdf_residential_buildings["snapped_to_node"])
+
+  # Make sure to use the precomputed snapped_to_node, as recomputing it might result in a different node as the network has changes since adding it
+  poi_nodes = [poi_node for gdf_poi_type in pois.values() for poi_node in gdf_poi_type["snapped_to_node"]]
+  def pois_chunk(start, stop):
+    if is_csr_network(pedestrian_network):
+      return parallel_reach(pedestrian_network, poi_nodes[start:stop], residentials_index, weight_type, max_weight, workers = workers)
+    return [
+      reachable_rows(pedestrian_network, residentials_index, poi_node, reach_from(pedestrian_network, poi_node, weight_type, max_weight), weight_type, max_weight, return_costs = True)
+      for poi_node in tqdm(poi_nodes[start:stop], desc="Processing poi")
+    ]
+
+  if checkpoint is None:
+    return reach_table_from_reached(pois_chunk(0, len(poi_nodes)))
+
+  chunks = checkpointed_chunks(checkpoint, len(poi_nodes), pois_chunk, desc="Processing poi chunks")
+  return reach_table_from_reached([reached for chunk in chunks for reached in chunk])
+
+def previous_positions(previous_ids, previous_nodes, ids, nodes):
+  """
+  For every feature, its position in the previous run, -1 when it was added or it is snapped to another node now
+
+  >>> previous_positions([7, 8, 9], [3, (4, 0.5), 5], [9, 7, 10, 8], [5, 3, 6, (4, 0.25)]).tolist()
+  [2, 0, -1, -1]
+  """
+  positions = pd.Index(previous_ids).get_indexer(ids)
+  if len(previous_nodes) == 0:
+    return positions
+  previous_nodes, previous_fractions = node_arrays(previous_nodes)
+  nodes, fractions = node_arrays(nodes)
+
+  known = positions >= 0
+  same_node = known & (previous_nodes[positions] == nodes)
+  same_fraction = (previous_fractions[positions] == fractions) | (np.isnan(previous_fractions[positions]) & np.isnan(fractions))
+
+  return np.where(same_node & same_fraction, positions, -1)
+
+def update_reach_table(pedestrian_network, reach_table, previous_snapped_nodes, pois, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, workers = 1):
+  """
+  The compute_reach_table of the current features, from the table of a previous run and only the searches the changes need.
+  Snapping to a CSRNetwork does not change it, so a feature snapped to the same node as before has the same reach.
+  The pairs of the removed and re-snapped features are dropped and there is a search from every added or re-snapped
+  POI (to all buildings) and building (to the POIs that are not searched from) - the network is undirected, the pairs are the same both ways.
+
+  previous_snapped_nodes: dict name -> (feature ids, snapped nodes) of the run reach_table was computed in, the POI types in
+    the order of the table and the buildings under 'residentials', as read_network_from_file returns them
+  pois: dict - poi_type -> gdf with snapped_to_node
+  Returns the updated table and the number of searches it took
+  """
+  if not is_csr_network(pedestrian_network):
+    raise ValueError("Only the reach on a CSRNetwork can be updated, snapping changes an nx.Graph")
+
+  previous_pois_offsets = {}
+  previous_pois_count = 0
+  for name, (ids, _nodes) in previous_snapped_nodes.items():
+    if name != 'residentials':
+      previous_pois_offsets[name] = previous_pois_count
+      previous_pois_count += len(ids)
+
+  pois_previous = []
+  for poi_type, gdf_poi_type in pois.items():
+    if poi_type in previous_pois_offsets:
+      positions = previous_positions(*previous_snapped_nodes[poi_type], gdf_poi_type['id'], list(gdf_poi_type["snapped_to_node"]))
+      pois_previous.append(np.where(positions >= 0, positions + previous_pois_offsets[poi_type], -1))
+    else:
+      pois_previous.append(np.full(gdf_poi_type.shape[0], -1))
+  pois_previous = np.concatenate(pois_previous)
+  buildings_previous = previous_positions(*previous_snapped_nodes['residentials'], gdf_residential_buildings['id'], list(gdf_residential_buildings["snapped_to_node"]))
+
+  # Where the features of the previous run are now, -1 for the removed and re-snapped ones
+  poi_positions = np.full(previous_pois_count, -1)
+  poi_positions[pois_previous[pois_previous >= 0]] = np.flatnonzero(pois_previous >= 0)
+  building_positions = np.full(len(previous_snapped_nodes['residentials'][0]), -1)
+  building_positions[buildings_previous[buildings_previous >= 0]] = np.flatnonzero(buildings_previous >= 0)
+  pairs = [remap_reach_table(reach_table, poi_positions, building_positions)]
+
+  poi_nodes = [poi_node for gdf_poi_type in pois.values() for poi_node in gdf_poi_type["snapped_to_node"]]
+  residential_nodes = list(gdf_residential_buildings["snapped_to_node"])
+  searched_pois = np.flatnonzero(pois_previous < 0)
+  searched_buildings = np.flatnonzero(buildings_previous < 0)
+
+  if searched_pois.shape[0]:
+    residentials_index = build_feature_index(pedestrian_network, residential_nodes)
+    reached = parallel_reach(pedestrian_network, [poi_nodes[poi] for poi in searched_pois], residentials_index, weight_type, max_weight, workers = workers)
+    searched_table = reach_table_from_reached(reached)
+    pairs.append((searched_pois[pair_pois(searched_table)], searched_table.buildings, searched_table.distances))
+
+  if searched_buildings.shape[0]:
+    pois_index = build_feature_index(pedestrian_network, poi_nodes)
+    reached = parallel_reach(pedestrian_network, [residential_nodes[building] for building in searched_buildings], pois_index, weight_type, max_weight, workers = workers)
+    # Grouped by building, the pairs with the POIs searched from above are already there
+    searched_table = reach_table_from_reached(reached)
+    not_searched = pois_previous[searched_table.buildings] >= 0
+    pairs.append((searched_table.buildings[not_searched], searched_buildings[pair_pois(searched_table)][not_searched], searched_table.distances[not_searched]))
+
+  poi_rows, building_rows, distances = (np.concatenate(column) for column in zip(*pairs))
+  return reach_table_from_pairs(poi_rows, building_rows, distances, len(poi_nodes)), searched_pois.shape[0] + searched_buildings.shape[0]
+
+def poi_subgroup_codes(pois):
+  """
+  The subgroups of all POIs in order of appearance and the position of the subgroup of every POI, -1 for the POIs without one
+  """
+  subgroup_codes, subgroups = pd.factorize(pd.concat([gdf_poi_type['subgroup'] for gdf_poi_type in pois.values()], ignore_index=True))
+  return subgroup_codes, list(subgroups)
+
+def compute_absolute_reach(pedestrian_network, pois, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, workers = 1, reach_table = None):
+  """
+  Same results as compute_poi_absolute_reach for every POI type and compute_buildings_absolute_reach, derived from a single ReachTable.
+  The network is undirected, so the buildings a POI reaches are the buildings that reach the POI.
+  There are far fewer POIs than buildings, hence the table is computed with a search from every POI.
+
+  pois: dict - poi_type -> gdf with snapped_to_node
+  workers: number of processes running the searches on a CSRNetwork, None for all CPUs
+  reach_table: the compute_reach_table of the same network, pois and buildings, computed when not given
+  Returns a dict poi_type -> gdf_poi_reach and the gdf_residentials_reach
+  """
+  if reach_table is None:
+    reach_table = compute_reach_table(pedestrian_network, pois, gdf_residential_buildings, weight_type, max_weight, workers)
+  appartments = gdf_residential_buildings['appartments'].to_numpy()
+
+  buildings_within_reach, appartments_within_reach = poi_totals(reach_table, appartments)
+  pois_reach = {}
+  first = 0
+  for poi_type, gdf_points_of_interest in pois.items():
+    last = first + gdf_points_of_interest.shape[0]
+    gdf_poi_reach = gpd.GeoDataFrame({
+      'id': gdf_points_of_interest['id'].to_numpy(),
+      'geom': gdf_points_of_interest['geom'].to_numpy(),
+      'subgroup': gdf_points_of_interest['subgroup'].to_numpy(),
+      'buildings_within_reach': buildings_within_reach[first:last],
+      'appartments_within_reach': appartments_within_reach[first:last].astype(appartments.dtype),
+    }, geometry='geom')
+    gdf_poi_reach.set_crs(epsg=7801, inplace=True)
+    pois_reach[poi_type] = gdf_poi_reach
+    first = last
+
+  subgroup_codes, subgroups = poi_subgroup_codes(pois)
+  subgroup_counts = building_subgroup_counts(reach_table, subgroup_codes, gdf_residential_buildings.shape[0], len(subgroups))
+
+  gdf_residentials_reach = gpd.GeoDataFrame({
+    'id': gdf_residential_buildings['id'].to_numpy(),
+    'geom': gdf_residential_buildings['geom'].to_numpy(),
+    'floorcount': gdf_residential_buildings['floors'].to_numpy(),
+    'appcount': appartments,
+  }, geometry='geom')
+  # Like the per building search, subgroups that are not within reach are missing (NaN) and subgroups no building reaches have no column
+  for column, subgroup in enumerate(subgroups):
+    if subgroup_counts[:, column].any():
+      gdf_residentials_reach[subgroup] = np.where(subgroup_counts[:, column] > 0, subgroup_counts[:, column], np.nan)
+  gdf_residentials_reach.set_crs(epsg=7801, inplace=True)
 
-  for i, residential in tqdm(gdf_residential_buildings.iterrows(), total=gdf_residential_buildings.shape[0], desc="Processing poi"):
-    # Make sure to work with point geomerty
-    if snap_to == 'edge':
-      residential_approx_id = snap_point_to_edge(pedestrian_network_copy, residential.geom)
-    elif snap_to == 'node': # snap to node
-      residential_approx_id = find_nearest_node(pedestrian_network_copy, residential.geom)
+  return pois_reach, gdf_residentials_reach
+
+def threshold_sufix(threshold):
+  """
+  >>> threshold_sufix(300.0), threshold_sufix(7.5)
+  ('300', '7_5')
+  """
+  return f"{threshold:g}".replace('.', '_')
+
+def compute_absolute_reach_bands(pedestrian_network, pois, gdf_residential_buildings, thresholds, weight_type = 'length', workers = 1, reach_table = None):
+  """
+  compute_absolute_reach for every threshold (meters or minutes, in the unit of weight_type) from a single search per POI,
+  run to the largest threshold - the bands are filtered from the distances in the reach table.
+
+  reach_table: the compute_reach_table with a cutoff of at least the largest threshold, computed when not given
+  Returns a dict poi_type -> gdf_poi_reach with buildings_within_reach_<threshold> and appartments_within_reach_<threshold> columns
+  and a dict threshold -> gdf_residentials_reach
+  """
+  thresholds = sorted(thresholds)
+  if reach_table is None:
+    reach_table = compute_reach_table(pedestrian_network, pois, gdf_residential_buildings, weight_type, thresholds[-1], workers)
+
+  pois_reach = {}
+  residentials_reach = {}
+  for threshold in thresholds:
+    band_pois_reach, residentials_reach[threshold] = compute_absolute_reach(
+      pedestrian_network,
+      pois,
+      gdf_residential_buildings,
+      weight_type,
+      threshold,
+      reach_table = reach_table_within(reach_table, threshold),
+    )
+    for poi_type, gdf_band_reach in band_pois_reach.items():
+      gdf_poi_reach = pois_reach.setdefault(poi_type, gdf_band_reach[['id', 'geom', 'subgroup']].copy())
+      gdf_poi_reach[f'buildings_within_reach_{threshold_sufix(threshold)}'] = gdf_band_reach['buildings_within_reach'].to_numpy()
+      gdf_poi_reach[f'appartments_within_reach_{threshold_sufix(threshold)}'] = gdf_band_reach['appartments_within_reach'].to_numpy()
+
+  return pois_reach, residentials_reach
+
+def compute_nearest_poi_distances(pedestrian_network, pois, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, reach_table = None):
+  """
+  The network distance from every building to the nearest POI of every subgroup, NaN when there is none within max_weight.
+  A single search per subgroup, seeded from all of its POIs, the cost depends on the number of subgroups and not on the number of buildings.
+
+  pois: dict - poi_type -> gdf with snapped_to_node
+  reach_table: the compute_reach_table of the same network, pois, buildings and max_weight - the distances are read from it without any search
+  Returns a gdf with id, geom and a column per subgroup
+  """
+  gdf_nearest_poi = gpd.GeoDataFrame({
+    'id': gdf_residential_buildings['id'].to_numpy(),
+    'geom': gdf_residential_buildings['geom'].to_numpy(),
+  }, geometry='geom')
+
+  subgroup_codes, subgroups = poi_subgroup_codes(pois)
+  if reach_table is not None:
+    distances = building_subgroup_distances(reach_table, subgroup_codes, gdf_residential_buildings.shape[0], len(subgroups))
+    for column, subgroup in enumerate(subgroups):
+      gdf_nearest_poi[subgroup] = np.where(np.isfinite(distances[:, column]), distances[:, column], np.nan)
+    gdf_nearest_poi.set_crs(epsg=7801, inplace=True)
+    return gdf_nearest_poi
+
+  poi_nodes = [poi_node for gdf_poi_type in pois.values() for poi_node in gdf_poi_type["snapped_to_node"]]
+  residential_nodes = list(gdf_residential_buildings["snapped_to_node"])
+  if is_csr_network(pedestrian_network):
+    residential_nodes = node_arrays(residential_nodes)
+
+  for column, subgroup in enumerate(tqdm(subgroups, desc="Processing subgroups")):
+    subgroup_nodes = [poi_node for poi_node, code in zip(poi_nodes, subgroup_codes) if code == column]
+    if is_csr_network(pedestrian_network):
+      distances = nearest_source_costs(pedestrian_network, node_arrays(subgroup_nodes), residential_nodes, weight_type, max_weight)
     else:
-      raise "snap_to = 'node'|'edge'"
+      lengths = nx.multi_source_dijkstra_path_length(pedestrian_network, set(subgroup_nodes), cutoff = max_weight, weight = weight_type)
+      distances = np.array([lengths.get(node, np.inf) for node in residential_nodes], dtype=np.float64)
+    gdf_nearest_poi[subgroup] = np.where(np.isfinite(distances), distances, np.nan)
 
-    accessibility_polygon = accessibility_area(pedestrian_network_copy, residential_approx_id, weight_type, max_weight)
+  gdf_nearest_poi.set_crs(epsg=7801, inplace=True)
 
-    buidling_info = {
-      'id': residential.id,
-      'geom': residential.geom,
-      'floorcount': residential['floors'],
-      'appcount': residential['appartments'],
-      'accessibility_polygon': accessibility_polygon,
-    }
+  return gdf_nearest_poi
 
-    for gdf_poi_type in pois:
-      reachable_pois = within_accessibility_area(accessibility_polygon, gdf_poi_type)
-      buidling_info.update(reachable_pois['subgroup'].value_counts().to_dict())
+def compute_buildings_reach(pedestrian_network, gdf_residential_buildings, pois, weight_type = 'length', max_weight = 1000, snap_to = 'edge', checkpoint = None):
+  """
+  checkpoint: directory the reach is written to in chunks of buildings as it goes (see pipeline.checkpointed_chunks),
+    a rerun with the same inputs resumes after the last finished chunk
+  """
+  gdf_buildings_isochrons = compute_buildings_isochrons(pedestrian_network, gdf_residential_buildings, weight_type, max_weight, snap_to, checkpoint)
+  return buildings_reach_from_counts(gdf_buildings_isochrons, [count_reachable_pois(gdf_buildings_isochrons, gdf_poi_type) for gdf_poi_type in pois])
 
-    residentials_reach.append(buidling_info)
+def compute_buildings_isochrons(pedestrian_network, gdf_residential_buildings, weight_type = 'length', max_weight = 1000, snap_to = 'edge', checkpoint = None):
+  """
+  The accessibility_polygon of every building, the POIs within it are counted by count_reachable_pois.
+  It does not depend on the POIs, a change of the POIs only counts them again
+  checkpoint: see compute_buildings_reach
+  """
 
-  gdf_residentials_reach = gpd.GeoDataFrame(residentials_reach, geometry='geom')
-  gdf_residentials_reach.set_crs(epsg=7801, inplace=True)
-
-  return gdf_residentials_reach
+  # Not sure if this should be at that level. Should strike a balance between coping and keeping the graph small
+  # When we snap_to node or work with a CSRNetwork (virtual nodes) the network does not change, no need to copy it
+  pedestrian_network_copy = pedestrian_network.copy() if snap_to == 'edge' and not is_csr_network(pedestrian_network) else pedestrian_network
+
+  # Snap all buildings at once, non point geometries are approximated with their centroid
+  residential_approx_ids = snap_to_network(pedestrian_network_copy, gdf_residential_buildings.geom, snap_to)
+
+  def buildings_chunk(start, stop):
+    chunk_reach = []
+    for (i, residential), residential_approx_id in zip(gdf_residential_buildings.iloc[start:stop].iterrows(), residential_approx_ids[start:stop]):
+      chunk_reach.append({
+        'id': residential.id,
+        'geom': residential.geom,
+        'floorcount': residential['floors'],
+        'appcount': residential['appartments'],
+        'accessibility_polygon': accessibility_area(pedestrian_network_copy, residential_approx_id, weight_type, max_weight),
+      })
+    return chunk_reach
+
+  chunks = checkpointed_chunks(checkpoint, gdf_residential_buildings.shape[0], buildings_chunk, desc="Processing buildings")
+  buildings_isochrons = [buidling_info for chunk in chunks for buidling_info in chunk]
+
+  gdf_buildings_isochrons = gpd.GeoDataFrame(buildings_isochrons, columns=['id', 'geom', 'floorcount', 'appcount', 'accessibility_polygon'], geometry='geom')
+  gdf_buildings_isochrons.set_crs(epsg=7801, inplace=True)
+
+  return gdf_buildings_isochrons
+
+def count_reachable_pois(gdf_buildings_isochrons, gdf_points_of_interest):
+  """
+  The number of POIs of every subgroup within the accessibility_polygon of every building, all buildings at once.
+  A column per subgroup indexed like gdf_buildings_isochrons, NaN where a building reaches none of the subgroup
+
+  >>> buildings = pd.DataFrame({'accessibility_polygon': [shapely.box(0, 0, 3, 3), shapely.MultiPolygon([shapely.box(0, 0, 1, 1), shapely.box(4, 4, 6, 6)]), None]})
+  >>> pois = gpd.GeoDataFrame({'subgroup': ['parks', 'parks', 'schools'], 'geom': [Point(0.5, 0.5), Point(2, 2), Point(5, 5)]}, geometry='geom')
+  >>> count_reachable_pois(buildings, pois)
+     parks  schools
+  0    2.0      NaN
+  1    1.0      1.0
+  2    NaN      NaN
+  """
+  polygons = np.asarray(gdf_buildings_isochrons['accessibility_polygon'].values, dtype=object)
+  # A MultiPolygon contains the POIs within any of its parts, a POI is counted once per building
+  parts, building_of_part = shapely.get_parts(polygons, return_index=True)
+  shapely.prepare(parts)
+  part_positions, poi_positions = build_locations_tree(gdf_points_of_interest.geom).query(parts, predicate='contains')
+  pairs = np.unique(np.column_stack([building_of_part[part_positions], poi_positions]).reshape(-1, 2), axis=0)
+
+  counts = pd.crosstab(pairs[:, 0], gdf_points_of_interest['subgroup'].to_numpy()[pairs[:, 1]]) if pairs.shape[0] else pd.DataFrame()
+  counts = counts.reindex(range(polygons.shape[0])).where(lambda counts: counts > 0).astype(np.float64)
+  counts.index = gdf_buildings_isochrons.index
+  counts.index.name = counts.columns.name = None
+
+  return counts
+
+def buildings_reach_from_counts(gdf_buildings_isochrons, poi_counts):
+  """
+  The buildings reach of compute_buildings_reach, the compute_buildings_isochrons with the count_reachable_pois of every type of POIs
+  """
+  return pd.concat([gdf_buildings_isochrons, *poi_counts], axis=1)
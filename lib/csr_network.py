@@ -0,0 +1,419 @@
+from collections import namedtuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Array backed, undirected pedestrian network. Nodes are the integers 0..n-1.
+#   node_coords:  (n, 2) float64 - x, y of every node
+#   indptr:       (n + 1,) int32 - CSR offsets, the neighbours of node i are indices[indptr[i]:indptr[i + 1]]
+#   indices:      (2m,) int32 - CSR neighbours, every undirected edge is stored in both directions
+#   weights:      dict weight_type -> (2m,) float64, aligned with indices
+#   edge_nodes:   (m, 2) int32 - the undirected edges as (u, v)
+#   edge_weights: dict weight_type -> (m,) float64, aligned with edge_nodes
+CSRNetwork = namedtuple('CSRNetwork', ['node_coords', 'indptr', 'indices', 'weights', 'edge_nodes', 'edge_weights'])
+
+# Points snapped to an edge without changing the network are represented as virtual nodes:
+# (edge id, fraction of the edge between its first node and the snapped point)
+MAX_SEPARATE_SEEDS = 8
+# Search indexes are kept for the last MAX_SEARCH_INDEXES networks searched
+MAX_SEARCH_INDEXES = 4
+
+# The nodes of a network in a KD-tree and, for every weight type, the largest straight line distance an edge covers per unit of weight.
+# A path of cost c never ends further than c * stretch from where it starts, a bounded search only needs the nodes within that radius.
+# positions is a buffer of -1 for every node, a search writes the positions of its nodes in it and resets them when it is done
+SearchIndex = namedtuple('SearchIndex', ['node_tree', 'stretch', 'positions'])
+_search_indexes = []
+
+def csr_network_from_edges(node_coords, edge_nodes, edge_weights):
+  """
+  node_coords: (n, 2) array of node coordinates
+  edge_nodes: (m, 2) array of node ids, one row per undirected edge
+  edge_weights: dict weight_type -> (m,) array
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (1, 1)], [(0, 1), (1, 2)], {'length': [1.0, 1.0]})
+  >>> network.indptr.tolist(), network.indices.tolist()
+  ([0, 1, 3, 4], [1, 2, 0, 1])
+  """
+  node_coords = np.asarray(node_coords, dtype=np.float64).reshape(-1, 2)
+  edge_nodes = np.asarray(edge_nodes, dtype=np.int32).reshape(-1, 2)
+  edge_weights = {name: np.asarray(values, dtype=np.float64) for name, values in edge_weights.items()}
+  node_count = node_coords.shape[0]
+
+  # Every undirected edge becomes two directed slots, grouped by their start node
+  starts = np.concatenate([edge_nodes[:, 0], edge_nodes[:, 1]])
+  ends = np.concatenate([edge_nodes[:, 1], edge_nodes[:, 0]])
+  order = np.argsort(starts, kind='stable')
+
+  indptr = np.zeros(node_count + 1, dtype=np.int32)
+  np.cumsum(np.bincount(starts, minlength=node_count), out=indptr[1:])
+  indices = ends[order].astype(np.int32)
+  weights = {name: np.concatenate([values, values])[order] for name, values in edge_weights.items()}
+
+  return CSRNetwork(node_coords, indptr, indices, weights, edge_nodes, edge_weights)
+
+def csr_network_from_graph(G, weight_types=('length', 'time')):
+  """
+  Converts a networkx graph built by build_network_from_geodataframe.
+  Returns the network and a dict mapping the original node keys to the new integer ids
+  """
+  node_ids = {node: idx for idx, node in enumerate(G.nodes)}
+  node_coords = [G.nodes[node]['pos'] for node in G.nodes]
+  edges = list(G.edges(data=True))
+  edge_nodes = [(node_ids[u], node_ids[v]) for u, v, _data in edges]
+  edge_weights = {weight_type: [data[weight_type] for _u, _v, data in edges] for weight_type in weight_types}
+
+  return csr_network_from_edges(node_coords, edge_nodes, edge_weights), node_ids
+
+def network_array_names(weight_types):
+  """
+  The names of the arrays of a network with the given weight types, see network_arrays
+
+  >>> network_array_names(['length'])
+  ['node_coords', 'indptr', 'indices', 'edge_nodes', 'weights.length', 'edge_weights.length']
+  """
+  names = ['node_coords', 'indptr', 'indices', 'edge_nodes']
+  for weight_type in weight_types:
+    names += [f'weights.{weight_type}', f'edge_weights.{weight_type}']
+
+  return names
+
+def network_arrays(network):
+  """
+  The arrays of network by name, the weights of every weight type as weights.<weight_type> and edge_weights.<weight_type>.
+  The layout shared by the network cache and the workers of parallel_reach
+  """
+  arrays = {
+    'node_coords': network.node_coords,
+    'indptr': network.indptr,
+    'indices': network.indices,
+    'edge_nodes': network.edge_nodes,
+  }
+  for weight_type in network.weights:
+    arrays[f'weights.{weight_type}'] = network.weights[weight_type]
+    arrays[f'edge_weights.{weight_type}'] = network.edge_weights[weight_type]
+
+  return arrays
+
+def network_from_arrays(arrays):
+  """
+  The CSRNetwork of the arrays of network_arrays, the arrays are used as they are
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0)], [(0, 1)], {'length': [1.0]})
+  >>> network_from_arrays(network_arrays(network)).weights['length'].tolist()
+  [1.0, 1.0]
+  """
+  weight_types = [name.split('.', 1)[1] for name in arrays if name.startswith('weights.')]
+
+  return CSRNetwork(
+    arrays['node_coords'],
+    arrays['indptr'],
+    arrays['indices'],
+    {weight_type: arrays[f'weights.{weight_type}'] for weight_type in weight_types},
+    arrays['edge_nodes'],
+    {weight_type: arrays[f'edge_weights.{weight_type}'] for weight_type in weight_types},
+  )
+
+def node_count(network):
+  return network.node_coords.shape[0]
+
+def csr_slots(indptr, rows):
+  """
+  Returns the slots of the given rows of a CSR structure and, for every slot, the position of its row in rows
+
+  >>> owners, slots = csr_slots(np.array([0, 2, 2, 5]), np.array([2, 0]))
+  >>> owners.tolist(), slots.tolist()
+  ([0, 0, 0, 1, 1], [2, 3, 4, 0, 1])
+  """
+  starts = indptr[rows].astype(np.int64)
+  counts = indptr[rows + 1] - starts
+  owners = np.repeat(np.arange(len(rows)), counts)
+  first_slot_of_owner = np.cumsum(counts) - counts
+  slots = starts[owners] + np.arange(owners.shape[0]) - first_slot_of_owner[owners]
+
+  return owners, slots
+
+def neighbour_slots(network, nodes):
+  """
+  Returns the CSR slots of all neighbours of the given nodes and, for every slot, the position of its node in nodes
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (1, 1)], [(0, 1), (1, 2)], {'length': [1.0, 1.0]})
+  >>> owners, slots = neighbour_slots(network, np.array([1, 2]))
+  >>> owners.tolist(), network.indices[slots].tolist()
+  ([0, 0, 1], [2, 0, 1])
+  """
+  return csr_slots(network.indptr, nodes)
+
+def csgraph(network, weight_type):
+  """
+  A scipy view over the network arrays, no data is copied
+  """
+  n = node_count(network)
+  return csr_matrix((network.weights[weight_type], network.indices, network.indptr), shape=(n, n))
+
+def is_virtual_node(node):
+  return isinstance(node, tuple)
+
+def node_arrays(nodes):
+  """
+  Encodes a list of node ids and virtual nodes as two arrays, plain nodes get a NaN fraction
+
+  >>> node_arrays([3, (5, 0.25)])
+  (array([3, 5]), array([ nan, 0.25]))
+  """
+  ids = np.array([node[0] if is_virtual_node(node) else node for node in nodes], dtype=np.int64)
+  fractions = np.array([node[1] if is_virtual_node(node) else np.nan for node in nodes], dtype=np.float64)
+
+  return ids, fractions
+
+def nodes_from_arrays(ids, fractions):
+  """
+  >>> nodes_from_arrays(*node_arrays([3, (5, 0.25)]))
+  [3, (5, 0.25)]
+  """
+  return [node if np.isnan(fraction) else (node, fraction) for node, fraction in zip(ids.tolist(), fractions.tolist())]
+
+def virtual_node_seeds(network, virtual_node, weight_type):
+  """
+  The two end nodes of the edge of a virtual node and the cost to get to each of them
+  """
+  edge, fraction = virtual_node
+  weight = network.edge_weights[weight_type][edge]
+
+  return network.edge_nodes[edge], np.array([weight * fraction, weight * (1 - fraction)])
+
+def seeded_dijkstra(network, seed_nodes, seed_costs, weight_type, max_weight):
+  """
+  Returns the cost from the closest seed to every node, where every seed starts with its own cost.
+  Nodes further than max_weight get inf
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 2)], {'length': [4.0, 4.0]})
+  >>> seeded_dijkstra(network, [0, 1], [1.0, 3.0], 'length', 6).tolist()
+  [1.0, 3.0, inf]
+  """
+  seed_nodes = np.asarray(seed_nodes, dtype=np.int32).reshape(-1)
+  seed_costs = np.asarray(seed_costs, dtype=np.float64).reshape(-1)
+  n = node_count(network)
+  if seed_nodes.shape[0] == 0 or seed_costs.min() > max_weight:
+    return np.full(n, np.inf)
+
+  if seed_nodes.shape[0] <= MAX_SEPARATE_SEEDS:
+    # A search per seed on the shared arrays, offset by the seed cost
+    searches = dijkstra(csgraph(network, weight_type), directed=True, indices=seed_nodes, limit=max_weight - seed_costs.min())
+    costs = (searches.reshape(seed_nodes.shape[0], n) + seed_costs[:, None]).min(axis=0)
+  else:
+    # A single search from an extra source node connected to every seed with an edge weighing the seed cost
+    indptr = np.append(network.indptr, network.indptr[-1] + seed_nodes.shape[0]).astype(np.int32)
+    indices = np.concatenate([network.indices, seed_nodes])
+    weights = np.concatenate([network.weights[weight_type], seed_costs])
+    graph = csr_matrix((weights, indices, indptr), shape=(n + 1, n + 1))
+    costs = dijkstra(graph, directed=True, indices=n, limit=max_weight)[:n]
+
+  costs[costs > max_weight] = np.inf
+  return costs
+
+def search_index(network):
+  """
+  The SearchIndex of network, built the first time it is searched
+  """
+  for node_coords, index in _search_indexes:
+    if node_coords is network.node_coords:
+      return index
+
+  edge_lengths = np.hypot(*(network.node_coords[network.edge_nodes[:, 1]] - network.node_coords[network.edge_nodes[:, 0]]).T)
+  stretch = {}
+  for weight_type, weights in network.edge_weights.items():
+    # An edge of length > 0 with no weight makes the stretch infinite, the searches of that weight type then cover the whole network
+    with np.errstate(divide='ignore', invalid='ignore'):
+      stretch[weight_type] = float(np.max(edge_lengths[edge_lengths > 0] / weights[edge_lengths > 0], initial=0.0))
+
+  index = SearchIndex(cKDTree(network.node_coords), stretch, np.full(node_count(network), -1, dtype=np.int64))
+  _search_indexes.append((network.node_coords, index))
+  del _search_indexes[:-MAX_SEARCH_INDEXES]
+  return index
+
+def induced_subnetwork(network, nodes, weight_type, positions):
+  """
+  The network of the nodes and the edges between them, node i of it is nodes[i]. Only the weights of weight_type are kept.
+  positions: -1 for every node of network, left as it is found
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 2)], {'length': [1.0, 2.0]})
+  >>> subnetwork = induced_subnetwork(network, np.array([1, 2]), 'length', np.full(3, -1))
+  >>> subnetwork.indptr.tolist(), subnetwork.indices.tolist(), subnetwork.weights['length'].tolist()
+  ([0, 1, 2], [1, 0], [2.0, 2.0])
+  """
+  owners, slots = csr_slots(network.indptr, nodes)
+  positions[nodes] = np.arange(nodes.shape[0])
+  neighbour_positions = positions[network.indices[slots]]
+  positions[nodes] = -1
+  inside = neighbour_positions >= 0
+
+  indptr = np.zeros(nodes.shape[0] + 1, dtype=np.int32)
+  np.cumsum(np.bincount(owners[inside], minlength=nodes.shape[0]), out=indptr[1:])
+
+  return CSRNetwork(network.node_coords[nodes], indptr, neighbour_positions[inside].astype(np.int32), {weight_type: network.weights[weight_type][slots[inside]]}, None, None)
+
+def ball_costs(network, seed_nodes, seed_costs, weight_type, max_weight):
+  """
+  The nodes within max_weight from the closest seed, sorted, and their costs - every seed starts with its own cost.
+  Only the nodes within the straight line distance the remaining weight of a seed can cover are searched (see SearchIndex),
+  the work depends on the size of that ball and not on the size of the network
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 2)], {'length': [4.0, 4.0]})
+  >>> nodes, costs = ball_costs(network, [0, 1], [1.0, 3.0], 'length', 6)
+  >>> nodes.tolist(), costs.tolist()
+  ([0, 1], [1.0, 3.0])
+  """
+  seed_nodes = np.asarray(seed_nodes, dtype=np.int64).reshape(-1)
+  seed_costs = np.asarray(seed_costs, dtype=np.float64).reshape(-1)
+  seeded = seed_costs <= max_weight
+  seed_nodes, seed_costs = seed_nodes[seeded], seed_costs[seeded]
+  if seed_nodes.shape[0] == 0:
+    return np.array([], dtype=np.int64), np.array([])
+
+  index = search_index(network)
+  # The radius is grown by a hair so that rounding never leaves out a node at exactly max_weight
+  radii = (max_weight - seed_costs) * index.stretch[weight_type] * (1 + 1e-9) + 1e-9
+  ball = None
+  if np.isfinite(radii).all():
+    # One ball around the first seed that holds the balls of all the others, the seeds of a virtual node are the ends of an edge
+    center = network.node_coords[seed_nodes[0]]
+    radius = (radii + np.hypot(*(network.node_coords[seed_nodes] - center).T)).max()
+    ball = np.asarray(index.node_tree.query_ball_point(center, radius, return_sorted=True), dtype=np.int64)
+
+  if ball is None or ball.shape[0] > node_count(network) // 2:
+    costs = seeded_dijkstra(network, seed_nodes, seed_costs, weight_type, max_weight)
+    nodes = np.flatnonzero(np.isfinite(costs))
+    return nodes, costs[nodes]
+
+  subnetwork = induced_subnetwork(network, ball, weight_type, index.positions)
+  if seed_nodes.shape[0] == 1:
+    costs = dijkstra(csgraph(subnetwork, weight_type), directed=True, indices=np.searchsorted(ball, seed_nodes[0]), limit=max_weight - seed_costs[0]) + seed_costs[0]
+  else:
+    # A single search from an extra source node connected to every seed, like seeded_dijkstra does for many seeds
+    n = ball.shape[0]
+    indptr = np.append(subnetwork.indptr, subnetwork.indptr[-1] + seed_nodes.shape[0]).astype(np.int32)
+    indices = np.concatenate([subnetwork.indices, np.searchsorted(ball, seed_nodes).astype(np.int32)])
+    weights = np.concatenate([subnetwork.weights[weight_type], seed_costs])
+    costs = dijkstra(csr_matrix((weights, indices, indptr), shape=(n + 1, n + 1)), directed=True, indices=n, limit=max_weight)[:n]
+  reached = costs <= max_weight
+  return ball[reached], costs[reached]
+
+def reached_nodes(network, source_node, weight_type, max_weight):
+  """
+  source_node: a node id or a virtual node
+  Returns the nodes within max_weight from source_node, sorted, and the cost to get to them
+  """
+  if is_virtual_node(source_node):
+    return ball_costs(network, *virtual_node_seeds(network, source_node, weight_type), weight_type, max_weight)
+
+  return ball_costs(network, [source_node], [0.0], weight_type, max_weight)
+
+def reached_costs(reach, nodes):
+  """
+  reach: the sorted nodes and the costs of a search, as returned by reached_nodes
+  Returns the cost to every node of the array nodes, inf for the nodes that were not reached
+
+  >>> reached_costs((np.array([2, 5]), np.array([1.0, 3.0])), np.array([[5, 3], [2, 9]])).tolist()
+  [[3.0, inf], [1.0, inf]]
+  """
+  reached, costs = reach
+  if reached.shape[0] == 0:
+    return np.full(np.shape(nodes), np.inf)
+
+  positions = np.minimum(np.searchsorted(reached, nodes), reached.shape[0] - 1)
+  return np.where(reached[positions] == nodes, costs[positions], np.inf)
+
+def virtual_node_costs(network, end_costs, edges, fractions, weight_type, source_node = None):
+  """
+  Turns the costs to the ends of the edges, (k, 2), into costs to the virtual nodes (edges[i], fractions[i]).
+  Pass the virtual source_node the costs were computed from, so that targets on its own edge are reached directly
+  """
+  weights = network.edge_weights[weight_type][edges]
+  targets_costs = np.minimum(end_costs[:, 0] + weights * fractions, end_costs[:, 1] + weights * (1 - fractions))
+
+  if is_virtual_node(source_node):
+    source_edge, source_fraction = source_node
+    same_edge = edges == source_edge
+    targets_costs[same_edge] = np.minimum(targets_costs[same_edge], weights[same_edge] * np.abs(fractions[same_edge] - source_fraction))
+
+  return targets_costs
+
+def same_edge_costs(network, edges, fractions, target_edges, target_fractions, weight_type):
+  """
+  The cost along their edge from the closest of the virtual nodes (edges[i], fractions[i]) to every virtual target,
+  inf for the targets with no virtual node on their edge
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 2)], {'length': [4.0, 8.0]})
+  >>> same_edge_costs(network, np.array([0, 0]), np.array([0.25, 1.0]), np.array([0, 0, 1]), np.array([0.0, 0.75, 0.5]), 'length').tolist()
+  [1.0, 1.0, inf]
+  """
+  costs = np.full(target_edges.shape[0], np.inf)
+  if edges.shape[0] == 0:
+    return costs
+
+  # Edges are at least 2 apart on the key, the fractions in [0, 1] never mix the virtual nodes of two edges
+  order = np.argsort(edges * 2 + fractions, kind='stable')
+  edges, fractions = edges[order], fractions[order]
+  right = np.searchsorted(edges * 2 + fractions, target_edges * 2 + target_fractions)
+
+  weights = network.edge_weights[weight_type][target_edges]
+  for neighbour in (right - 1, right):
+    valid = (neighbour >= 0) & (neighbour < edges.shape[0])
+    neighbour = np.where(valid, neighbour, 0)
+    on_edge = valid & (edges[neighbour] == target_edges)
+    costs[on_edge] = np.minimum(costs[on_edge], weights[on_edge] * np.abs(fractions[neighbour[on_edge]] - target_fractions[on_edge]))
+
+  return costs
+
+def nearest_source_costs(network, sources, targets, weight_type, max_weight):
+  """
+  sources, targets: (ids, fractions) of node ids and virtual nodes, as returned by node_arrays
+  Returns the cost from the nearest source to every target, inf when no source is within max_weight.
+  All sources seed a single search, the cost does not depend on the number of targets
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (2, 0), (3, 0)], [(0, 1), (1, 2), (2, 3)], {'length': [4.0, 4.0, 4.0]})
+  >>> nearest_source_costs(network, node_arrays([0, (2, 0.5)]), node_arrays([1, 2, (0, 0.5), (2, 0.75)]), 'length', 5).tolist()
+  [4.0, 2.0, 2.0, 1.0]
+  """
+  source_ids, source_fractions = sources
+  is_virtual_source = ~np.isnan(source_fractions)
+  source_edges, edge_fractions = source_ids[is_virtual_source], source_fractions[is_virtual_source]
+  source_edge_weights = network.edge_weights[weight_type][source_edges]
+
+  # A virtual source seeds both ends of its edge
+  seed_nodes = np.concatenate([source_ids[~is_virtual_source], network.edge_nodes[source_edges, 0], network.edge_nodes[source_edges, 1]])
+  seed_costs = np.concatenate([np.zeros((~is_virtual_source).sum()), source_edge_weights * edge_fractions, source_edge_weights * (1 - edge_fractions)])
+  costs = seeded_dijkstra(network, seed_nodes, seed_costs, weight_type, max_weight)
+
+  target_ids, target_fractions = targets
+  is_virtual_target = ~np.isnan(target_fractions)
+  targets_costs = np.empty(target_ids.shape[0])
+  targets_costs[~is_virtual_target] = costs[target_ids[~is_virtual_target]]
+  target_edges = target_ids[is_virtual_target]
+  targets_costs[is_virtual_target] = np.minimum(
+    virtual_node_costs(network, costs[network.edge_nodes[target_edges]].reshape(-1, 2), target_edges, target_fractions[is_virtual_target], weight_type),
+    same_edge_costs(network, source_edges, edge_fractions, target_edges, target_fractions[is_virtual_target], weight_type),
+  )
+
+  targets_costs[targets_costs > max_weight] = np.inf
+  return targets_costs
+
+def bounded_dijkstra(network, source_node, weight_type, max_weight):
+  """
+  Returns the nodes within max_weight from source_node (a node id or a virtual node) and the cost to get to them, ordered by cost
+
+  >>> network = csr_network_from_edges([(0, 0), (1, 0), (1, 1)], [(0, 1), (1, 2)], {'length': [1.0, 5.0]})
+  >>> nodes, costs = bounded_dijkstra(network, 0, 'length', 6)
+  >>> nodes.tolist(), costs.tolist()
+  ([0, 1, 2], [0.0, 1.0, 6.0])
+  >>> bounded_dijkstra(network, 2, 'length', 4)[0].tolist()
+  [2]
+  >>> nodes, costs = bounded_dijkstra(network, (1, 0.2), 'length', 4)
+  >>> nodes.tolist(), costs.tolist()
+  ([1, 0, 2], [1.0, 2.0, 4.0])
+  """
+  nodes, costs = reached_nodes(network, source_node, weight_type, max_weight)
+  order = np.argsort(costs, kind='stable')
+
+  return nodes[order], costs[order]
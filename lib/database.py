@@ -1,24 +1,294 @@
+import io
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
-from sqlalchemy import create_engine, text
+import numpy as np
+import pandas as pd
+import shapely
+from sqlalchemy import create_engine, inspect, text
 
-def db_engine(connection_string):
-  return create_engine(f'postgresql+psycopg2://{connection_string}')
+CHUNK_SIZE = 50000
+# Connections kept open by the engine, enough to load all poi tables at once
+POOL_SIZE = 8
+
+# The SQL run before the COPY, the COPY and the SQL run after it
+WriteStatements = namedtuple('WriteStatements', ['prepare', 'copy', 'finish'])
+
+def db_engine(connection_string, pool_size = POOL_SIZE):
+  return create_engine(f'postgresql+psycopg2://{connection_string}', pool_size=pool_size, pool_pre_ping=True)
 
 def db_execute(engine, sql):
   with engine.connect() as conn:
     conn.execute(text(sql))
     conn.commit()
 
+def has_db_table(engine, schema, table_name):
+  return inspect(engine).has_table(table_name, schema=schema)
+
 def gdf_from_sql(connection, query, geom_column = 'geom'):
-  return gpd.read_postgis(query, connection, geom_col=geom_column)
+  return pd.concat(gdf_chunks_from_sql(connection, query, geom_column), ignore_index=True)
+
+def gdfs_from_sql(database, queries, geom_column = 'geom', workers = POOL_SIZE):
+  """
+  Runs the independent queries concurrently, each on its own connection of the database engine pool.
+  queries: dict name -> query
+  Returns the dict name -> gdf in the order of queries, loading takes as long as the slowest query
+  """
+  def load(query):
+    with database.connect() as db_connection:
+      return gdf_from_sql(db_connection, query, geom_column)
+
+  with ThreadPoolExecutor(max_workers=max(min(workers, len(queries)), 1)) as executor:
+    gdfs = {name: executor.submit(load, query) for name, query in queries.items()}
+    return {name: gdf.result() for name, gdf in gdfs.items()}
+
+def gdf_chunks_from_sql(connection, query, geom_column = 'geom', chunk_size = CHUNK_SIZE):
+  """
+  Streams the result of the query in GeoDataFrames of chunk_size rows through a server side cursor, gdf_from_sql joins them,
+  the driver never buffers the whole result as rows. An empty result gives a single empty chunk.
+  PostGIS returns the geometry as hex EWKB, every chunk is decoded with a single shapely call
+  """
+  result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).exec_driver_sql(query)
+  columns = list(result.keys())
+  empty = True
+  for rows in result.partitions(chunk_size):
+    empty = False
+    yield gdf_from_rows(rows, columns, geom_column)
+  if empty:
+    yield gdf_from_rows([], columns, geom_column)
+
+def gdf_from_rows(rows, columns, geom_column = 'geom'):
+  """
+  rows: tuples with the geometry as (E)WKB, binary or hex, the CRS is taken from the SRID of the first geometry
+
+  >>> gdf = gdf_from_rows([(1, shapely.to_wkb(shapely.set_srid(shapely.Point(1, 2), 7801), include_srid=True, hex=True)), (2, None)], ['id', 'geom'])
+  >>> gdf.geom.tolist(), gdf.crs.to_epsg()
+  ([<POINT (1 2)>, None], 7801)
+  """
+  df = pd.DataFrame.from_records(rows, columns=columns)
+  geoms = shapely.from_wkb(df[geom_column].to_numpy(dtype=object, na_value=None))
+  srids = shapely.get_srid(geoms[~shapely.is_missing(geoms)])
+  crs = int(srids[0]) if srids.shape[0] and srids[0] > 0 else None
+
+  df[geom_column] = gpd.array.from_shapely(geoms, crs=crs)
+
+  return gpd.GeoDataFrame(df, geometry=geom_column, crs=crs)
+
+def geometries_from_sql(values):
+  """
+  Decodes a geometry column read as text - hex EWKB as PostGIS returns a geometry, or WKT as older result tables store it.
+  Geometries (as read from GeoParquet) are kept
+
+  >>> geometries_from_sql(['0101000020791E000000000000000000000000000000000000', 'POINT (1 2)', None, shapely.Point(3, 4)]).tolist()
+  [<POINT (0 0)>, <POINT (1 2)>, None, <POINT (3 4)>]
+  """
+  values = np.asarray(values, dtype=object)
+  geoms = np.array([value if isinstance(value, shapely.Geometry) else None for value in values], dtype=object)
+  is_text = np.array([isinstance(value, str) for value in values], dtype=bool)
+  is_wkb = is_text & np.array([isinstance(value, str) and value[:2] in ('00', '01') for value in values], dtype=bool)
+  geoms[is_wkb] = shapely.from_wkb(values[is_wkb].astype(str))
+  geoms[is_text & ~is_wkb] = shapely.from_wkt(values[is_text & ~is_wkb].astype(str))
+
+  return geoms
+
+def create_table_form_dgf(engine, gdf, schema, table_name, if_exists = 'replace'):
+  gdf.to_postgis(name=table_name, con=engine, schema = schema, if_exists=if_exists)
+
+def quote_identifier(name):
+  """
+  >>> print(quote_identifier('results_kindergarden_service_level'))
+  "results_kindergarden_service_level"
+  >>> print(quote_identifier('a"b'))
+  "a""b"
+  """
+  return '"' + str(name).replace('"', '""') + '"'
+
+def geometry_columns(gdf):
+  """
+  The columns holding shapely geometries, the active geometry and any other one (like an isochron polygon)
+  """
+  return [
+    column for column in gdf.columns
+    if isinstance(gdf[column].dtype, gpd.array.GeometryDtype)
+    or (gdf[column].dtype == object and gdf[column].map(lambda value: isinstance(value, shapely.Geometry)).any())
+  ]
+
+def postgres_columns(gdf):
+  """
+  The column definitions of a table for gdf
+
+  >>> gdf = gpd.GeoDataFrame({'id': [1], 'name': ['a'], 'value': [0.5], 'geom': [shapely.Point(0, 0)]}, geometry='geom', crs=7801)
+  >>> postgres_columns(gdf)
+  ['"id" bigint', '"name" text', '"value" double precision', '"geom" geometry(Geometry, 7801)']
+  """
+  srid = gdf.crs.to_epsg() if getattr(gdf, 'crs', None) is not None else 0
+  geometries = geometry_columns(gdf)
+  definitions = []
+  for column, dtype in gdf.dtypes.items():
+    if column in geometries:
+      sql_type = f"geometry(Geometry, {srid or 0})"
+    elif pd.api.types.is_bool_dtype(dtype):
+      sql_type = "boolean"
+    elif pd.api.types.is_integer_dtype(dtype):
+      sql_type = "bigint"
+    elif pd.api.types.is_float_dtype(dtype):
+      sql_type = "double precision"
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+      sql_type = "timestamp"
+    else:
+      sql_type = "text"
+    definitions.append(f"{quote_identifier(column)} {sql_type}")
+
+  return definitions
 
-def create_table_form_dgf(engine, gdf, schema, table_name):
-  gdf.to_postgis(name=table_name, con=engine, schema = schema, if_exists='replace')
+def copy_rows(gdf, srid = 0):
+  """
+  The rows of gdf as COPY csv, geometries as hex EWKB, missing values as NULL
 
-def save_gdf_to_db(database, schema, table_name, gdf):
+  >>> gdf = gpd.GeoDataFrame({'id': [1, 2], 'value': [0.5, None], 'geom': [shapely.Point(0, 0), None]}, geometry='geom', crs=7801)
+  >>> print(copy_rows(gdf, 7801).getvalue())
+  1,0.5,0101000020791E000000000000000000000000000000000000
+  2,,
+  <BLANKLINE>
+  """
+  df = pd.DataFrame(gdf, copy=False)
+  for column in geometry_columns(gdf):
+    geoms = np.asarray(gdf[column].values, dtype=object)
+    if srid:
+      geoms = shapely.set_srid(geoms, srid)
+    df[column] = shapely.to_wkb(geoms, hex=True, include_srid=bool(srid))
+
+  buffer = io.StringIO()
+  df.to_csv(buffer, header=False, index=False)
+  buffer.seek(0)
+
+  return buffer
+
+def write_statements(schema, table_name, gdf, if_exists = 'replace'):
+  """
+  The SQL save_gdf_to_db runs around the COPY of the rows.
+  'replace' indexes the staging table under a name of its own and gives the index the name of the table's once the old
+  table (and its index) is dropped, every replace finds the names free
+
+  >>> gdf = gpd.GeoDataFrame({'id': [1], 'geom': [shapely.Point(0, 0)]}, geometry='geom', crs=7801)
+  >>> statements = write_statements('work', 'results', gdf)
+  >>> print('\\n'.join(statements.prepare))
+  DROP TABLE IF EXISTS "work"."results_staging"
+  CREATE TABLE "work"."results_staging" ("id" bigint, "geom" geometry(Geometry, 7801))
+  >>> print(statements.copy)
+  COPY "work"."results_staging" ("id", "geom") FROM STDIN WITH (FORMAT csv)
+  >>> print('\\n'.join(statements.finish))
+  CREATE INDEX "results_staging_geom_idx" ON "work"."results_staging" USING GIST ("geom")
+  DROP TABLE IF EXISTS "work"."results"
+  ALTER TABLE "work"."results_staging" RENAME TO "results"
+  ALTER INDEX "work"."results_staging_geom_idx" RENAME TO "results_geom_idx"
+  >>> statements = write_statements('work', 'results', gdf, 'append')
+  >>> statements.prepare, statements.copy, statements.finish
+  (['CREATE TABLE IF NOT EXISTS "work"."results" ("id" bigint, "geom" geometry(Geometry, 7801))'], 'COPY "work"."results" ("id", "geom") FROM STDIN WITH (FORMAT csv)', [])
+  """
+  if if_exists not in ('replace', 'append'):
+    raise ValueError("if_exists = 'replace'|'append'")
+
+  table = f"{quote_identifier(schema)}.{quote_identifier(table_name)}"
+  columns = ', '.join(quote_identifier(column) for column in gdf.columns)
+  if if_exists == 'append':
+    return WriteStatements([f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(postgres_columns(gdf))})"], f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", [])
+
+  staging_name = staging_table_name(table_name)
+  staging = f"{quote_identifier(schema)}.{quote_identifier(staging_name)}"
+
+  return WriteStatements(
+    [f"DROP TABLE IF EXISTS {staging}", f"CREATE TABLE {staging} ({', '.join(postgres_columns(gdf))})"],
+    f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)",
+    [
+      *(f"CREATE INDEX {quote_identifier(f'{staging_name}_{column}_idx')} ON {staging} USING GIST ({quote_identifier(column)})" for column in geometry_columns(gdf)),
+      *swap_statements(schema, table_name, geometry_columns(gdf)),
+    ],
+  )
+
+def staging_table_name(table_name):
+  return f"{table_name}_staging"
+
+def swap_statements(schema, table_name, geometries):
+  """
+  The SQL putting the staging table of table_name, with its spatial indexes on the geometries columns, in place of the table
+
+  >>> print('\\n'.join(swap_statements('work', 'results', ['geom'])))
+  DROP TABLE IF EXISTS "work"."results"
+  ALTER TABLE "work"."results_staging" RENAME TO "results"
+  ALTER INDEX "work"."results_staging_geom_idx" RENAME TO "results_geom_idx"
+  """
+  staging_name = staging_table_name(table_name)
+  return [
+    f"DROP TABLE IF EXISTS {quote_identifier(schema)}.{quote_identifier(table_name)}",
+    f"ALTER TABLE {quote_identifier(schema)}.{quote_identifier(staging_name)} RENAME TO {quote_identifier(table_name)}",
+    *(f"ALTER INDEX {quote_identifier(schema)}.{quote_identifier(f'{staging_name}_{column}_idx')} RENAME TO {quote_identifier(f'{table_name}_{column}_idx')}" for column in geometries),
+  ]
+
+def check_appended_columns(table_columns, gdf, table_name):
+  """
+  Raises unless the rows of gdf have the columns of the table they are appended to, table_columns is empty for a new table
+
+  >>> gdf = pd.DataFrame({'id': [1], 'parks': [2]})
+  >>> check_appended_columns(['parks', 'id'], gdf, 'results')
+  >>> check_appended_columns(['id'], gdf, 'results')
+  Traceback (most recent call last):
+  ...
+  ValueError: Can not append to results: the rows have the columns ['id', 'parks'], the table ['id']
+  """
+  if len(table_columns) and set(table_columns) != set(gdf.columns):
+    raise ValueError(f"Can not append to {table_name}: the rows have the columns {list(gdf.columns)}, the table {list(table_columns)}")
+
+def swap_staging_table(database, schema, table_name, geometries):
+  """
+  Puts the staging table of table_name in place of the table in one transaction, see swap_statements.
+  A result streamed in parts (the tiles of a tiled run) is written to the staging table with save_gdf_to_db, its first part
+  with 'replace' (that indexes it) and the others with 'append', readers see the old table until all parts are in
+  """
+  connection = database.raw_connection()
   try:
-    create_table_form_dgf(database, gdf, schema = schema, table_name = table_name)
-    print(f"Table {schema}.{table_name} created")
-  except Exception as e:
-    print(f"Table {schema}.{table_name} failed to create wirh {e}")
-    exit
+    with connection.cursor() as cursor:
+      for statement in swap_statements(schema, table_name, geometries):
+        cursor.execute(statement)
+    connection.commit()
+  except Exception:
+    connection.rollback()
+    raise
+  finally:
+    connection.close()
+
+  print(f"Table {schema}.{table_name} swapped in")
+
+def save_gdf_to_db(database, schema, table_name, gdf, if_exists = 'replace', chunk_size = CHUNK_SIZE):
+  """
+  Bulk writes gdf with COPY, chunk_size rows at a time (see write_statements for the SQL).
+  'replace' copies into a staging table, builds the spatial index and renames it in place of the table in one transaction -
+  readers see either the old or the new table, never a partial or a missing one.
+  'append' copies straight into the table (a tiled run streams its results into one table), it is created when missing.
+  The rows have to have the columns of an existing table.
+  Raises when the table can not be written
+  """
+  statements = write_statements(schema, table_name, gdf, if_exists)
+  srid = gdf.crs.to_epsg() if getattr(gdf, 'crs', None) is not None else 0
+
+  connection = database.raw_connection()
+  try:
+    with connection.cursor() as cursor:
+      if if_exists == 'append':
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s", (schema, table_name))
+        check_appended_columns([column for column, in cursor.fetchall()], gdf, f"{schema}.{table_name}")
+
+      for statement in statements.prepare:
+        cursor.execute(statement)
+      for start in range(0, gdf.shape[0], chunk_size):
+        cursor.copy_expert(statements.copy, copy_rows(gdf.iloc[start:start + chunk_size], srid))
+      for statement in statements.finish:
+        cursor.execute(statement)
+    connection.commit()
+  except Exception:
+    connection.rollback()
+    raise
+  finally:
+    connection.close()
+
+  print(f"Table {schema}.{table_name} {'created' if if_exists == 'replace' else 'appended to'}")
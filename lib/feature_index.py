@@ -0,0 +1,75 @@
+from collections import namedtuple
+import numpy as np
+
+from csr_network import CSRNetwork, csr_slots, virtual_node_costs, reached_costs, is_virtual_node, node_arrays
+
+# Inverted index from the nodes of a CSRNetwork to the rows of a feature table snapped to it.
+#   node_offsets: (n + 1,) - the rows snapped to node i are node_rows[node_offsets[i]:node_offsets[i + 1]]
+#   node_rows:    rows grouped by node, a row snapped to a virtual node is listed under both ends of its edge
+#   nodes:        (k,) the node id of every row, or the edge id when the row is a virtual node
+#   fractions:    (k,) NaN for rows snapped to a node, the fraction along the edge for virtual nodes
+#   edge_rows:    rows snapped to virtual nodes, ordered by their edge
+#   sorted_edges: the edge of every row in edge_rows, to find the rows on the edge of a virtual source
+FeatureIndex = namedtuple('FeatureIndex', ['node_offsets', 'node_rows', 'nodes', 'fractions', 'edge_rows', 'sorted_edges'])
+
+def build_feature_index(network, snapped_nodes):
+  """
+  snapped_nodes: the snapped_to_node column of the feature table
+  For an nx.Graph the index is a dict node -> array of rows
+  """
+  if not isinstance(network, CSRNetwork):
+    index = {}
+    for row, node in enumerate(snapped_nodes):
+      index.setdefault(node, []).append(row)
+    return {node: np.array(rows) for node, rows in index.items()}
+
+  nodes, fractions = node_arrays(list(snapped_nodes))
+  rows = np.arange(nodes.shape[0])
+  is_virtual = ~np.isnan(fractions)
+
+  # Rows snapped to a virtual node can be reached through either end of their edge
+  row_nodes = np.concatenate([nodes[~is_virtual], network.edge_nodes[nodes[is_virtual], 0], network.edge_nodes[nodes[is_virtual], 1]])
+  node_rows = np.concatenate([rows[~is_virtual], rows[is_virtual], rows[is_virtual]])
+  order = np.argsort(row_nodes, kind='stable')
+  node_offsets = np.zeros(network.node_coords.shape[0] + 1, dtype=np.int64)
+  np.cumsum(np.bincount(row_nodes, minlength=network.node_coords.shape[0]), out=node_offsets[1:])
+
+  edge_rows = rows[is_virtual][np.argsort(nodes[is_virtual], kind='stable')]
+
+  return FeatureIndex(node_offsets, node_rows[order], nodes, fractions, edge_rows, nodes[edge_rows])
+
+def reachable_rows(network, index, source_node, reach, weight_type, max_weight, return_costs = False):
+  """
+  reach: the cost to every accessible node of an nx.Graph (or just the nodes), or the reached_nodes of a CSRNetwork, as computed from source_node
+  Returns the sorted rows of the feature table within max_weight from source_node, and their costs with return_costs.
+  Only the rows snapped to the reached nodes are looked at, the cost does not depend on the size of the table
+  """
+  if not isinstance(network, CSRNetwork):
+    reached = [node for node in reach if node in index]
+    rows = np.concatenate([index[node] for node in reached]) if reached else np.array([], dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    if not return_costs:
+      return rows[order]
+    costs = np.concatenate([np.full(index[node].shape[0], reach[node], dtype=np.float64) for node in reached]) if reached else np.array([])
+    return rows[order], costs[order]
+
+  _owners, slots = csr_slots(index.node_offsets, reach[0])
+  candidates = index.node_rows[slots]
+  if is_virtual_node(source_node):
+    # Rows on the edge of the source are reachable along the edge, even when both of its ends are too far
+    source_edge = source_node[0]
+    first, last = np.searchsorted(index.sorted_edges, [source_edge, source_edge + 1])
+    candidates = np.concatenate([candidates, index.edge_rows[first:last]])
+  candidates = np.unique(candidates)
+
+  fractions = index.fractions[candidates]
+  is_virtual = ~np.isnan(fractions)
+  costs = np.empty(candidates.shape[0])
+  costs[~is_virtual] = reached_costs(reach, index.nodes[candidates[~is_virtual]])
+  edges = index.nodes[candidates[is_virtual]]
+  costs[is_virtual] = virtual_node_costs(network, reached_costs(reach, network.edge_nodes[edges]).reshape(-1, 2), edges, fractions[is_virtual], weight_type, source_node)
+
+  within = costs <= max_weight
+  if return_costs:
+    return candidates[within], costs[within]
+  return candidates[within]
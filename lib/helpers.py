@@ -1,9 +1,71 @@
+from functools import lru_cache
+import geopandas as gpd
+import numpy as np
+import shapely
 from pyproj import Transformer
 from shapely.geometry import Point, LineString, Polygon, MultiPolygon, GeometryCollection
 
 BGS2005 = "EPSG:7801"
 WGS84 = "EPSG:4326"
 
+@lru_cache(maxsize=None)
+def crs_transformer(source_crs = BGS2005, target_crs = WGS84):
+  """ Building a Transformer takes milliseconds, one is built per (source_crs, target_crs) and reused
+
+  >>> crs_transformer(BGS2005, WGS84) is crs_transformer(BGS2005, WGS84)
+  True
+  """
+  return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+def crs_transform_array(coords, swap_coords = False, source_crs = BGS2005, target_crs = WGS84):
+  """ Transforms an (n, 2) array of (x, y) in one call, with swap_coords the result is (lat, lon)
+
+  >>> crs_transform_array(np.array([[321812.94252381043, 4731192.267176171], [320960.4910, 4728848.5264]])).round(3)
+  array([[23.325, 42.696],
+         [23.315, 42.674]])
+  >>> crs_transform_array(np.array([[321812.94252381043, 4731192.267176171]]), swap_coords = True).round(3)
+  array([[42.696, 23.325]])
+  """
+  coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+  lon, lat = crs_transformer(source_crs, target_crs).transform(coords[:, 0], coords[:, 1])
+
+  return np.column_stack([lat, lon] if swap_coords else [lon, lat])
+
+def crs_transform_geometries(geoms, swap_coords = False, source_crs = BGS2005, target_crs = WGS84):
+  """ Transforms the coordinates of all geometries, of any type, in one call.
+  geoms: array like of shapely geometries or a GeoSeries, a GeoSeries keeps its index and gets target_crs
+
+  >>> crs_transform_geometries([Point(321812.94252381043, 4731192.267176171), LineString([(320960.4910, 4728848.5264), (320844.2254, 4728875.6080)])])
+  array([<POINT (23.325 42.696)>,
+         <LINESTRING (23.315 42.674, 23.314 42.674)>], dtype=object)
+  >>> crs_transform_geometries([Point(321812.94252381043, 4731192.267176171)], swap_coords = True)
+  array([<POINT (42.696 23.325)>], dtype=object)
+  """
+  transformed = shapely.transform(
+    np.asarray(geoms, dtype=object),
+    lambda coords: crs_transform_array(coords, swap_coords, source_crs, target_crs),
+  )
+  if isinstance(geoms, gpd.GeoSeries):
+    return gpd.GeoSeries(transformed, index=geoms.index, name=geoms.name, crs=target_crs)
+
+  return transformed
+
+def crs_transform_gdf(gdf, swap_coords = False, source_crs = BGS2005, target_crs = WGS84):
+  """ A copy of a result layer with every geometry column (the geometry and any other, like an isochron polygon) transformed
+
+  >>> gdf = gpd.GeoDataFrame({'id': [1], 'geom': [Point(321812.94252381043, 4731192.267176171)]}, geometry='geom', crs=BGS2005)
+  >>> crs_transform_gdf(gdf).geom.iloc[0]
+  <POINT (23.325 42.696)>
+  """
+  gdf = gdf.copy()
+  for column in gdf.columns:
+    if isinstance(gdf[column].dtype, gpd.array.GeometryDtype) or (gdf[column].dtype == object and gdf[column].map(lambda value: isinstance(value, shapely.Geometry)).any()):
+      gdf[column] = crs_transform_geometries(gdf[column].values, swap_coords, source_crs, target_crs)
+  if isinstance(gdf, gpd.GeoDataFrame) and gdf._geometry_column_name in gdf.columns:
+    gdf = gdf.set_crs(target_crs, allow_override=True)
+
+  return gdf
+
 def crs_transform_point(point, swap_coords = False, source_crs = BGS2005, target_crs = WGS84):
   """ In the database we have point in 7801 (x, y) which translates to 4326 (lon, lat),
   however plotting libraries use 4326 (lat, lon)
@@ -13,8 +75,7 @@ def crs_transform_point(point, swap_coords = False, source_crs = BGS2005, target
   >>> crs_transform_point(Point(321812.94252381043, 4731192.267176171), swap_coords = False)
   <POINT (23.325 42.696)>
   """
-  transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-  lon, lat = transformer.transform(point.x, point.y)
+  lon, lat = crs_transformer(source_crs, target_crs).transform(point.x, point.y)
 
   return Point(lat, lon) if swap_coords else Point(lon, lat)
 
@@ -32,8 +93,7 @@ def crs_transform_coords(x, y, swap_coords = False, toPoint = False, source_crs
   <POINT (42.696 23.325)>
   """
 
-  transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-  lon, lat = transformer.transform(x, y)
+  lon, lat = crs_transformer(source_crs, target_crs).transform(x, y)
 
   if swap_coords:
     return Point(lat, lon) if toPoint else (lat, lon)
@@ -49,14 +109,8 @@ def crs_transform_linestring(linestring, swap_coords = False, source_crs = BGS20
   >>> crs_transform_linestring(LineString([(320960.4910, 4728848.5264), (320844.2254, 4728875.6080), (320794.2176, 4729493.6845)]), swap_coords = True)
   <LINESTRING (42.674 23.315, 42.674 23.314, 42.68 23.313)>
   """
-  
-  transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-  transformed_coords = [transformer.transform(x, y) for x, y in linestring.coords]
-
-  if swap_coords:
-    transformed_coords = [(lat, lon) for lon, lat in transformed_coords]
 
-  return LineString(transformed_coords)
+  return LineString(crs_transform_array(linestring.coords, swap_coords, source_crs, target_crs))
 
 def crs_transform_polygon(polygon, swap_coords = False, source_crs = BGS2005, target_crs = WGS84):
   """ In the database we have point in 7801 (x, y) which translates to 4326 (lon, lat),
@@ -71,13 +125,8 @@ def crs_transform_polygon(polygon, swap_coords = False, source_crs = BGS2005, ta
     raise "Not Valid"
   if not isinstance(polygon, Polygon):
     raise ValueError(f"Not a Polygon. It is a {polygon.geom_type}")
-  transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
-  transformed_coords = [transformer.transform(x, y) for x, y in polygon.exterior.coords]
-
-  if swap_coords:
-    transformed_coords = [(lat, lon) for lon, lat in transformed_coords]
 
-  return Polygon(transformed_coords)
+  return Polygon(crs_transform_array(polygon.exterior.coords, swap_coords, source_crs, target_crs))
 
 def crs_transform_multipolygon(multipolygon, swap_coords=False, source_crs=BGS2005, target_crs=WGS84):
   if not multipolygon.is_valid:
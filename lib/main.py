@@ -1,18 +1,71 @@
 import pandas as pd
 import os
+import tempfile
 from dotenv import load_dotenv
 
-from database import db_engine, gdf_from_sql, save_gdf_to_db, db_execute
-from queries import pedestrian_network_query, residential_buildings_query, poi_query
-from network import build_network_from_geodataframe, extend_network_with
-from compute_accessibility_index import compute_accessibility_index_weighed_sum, compute_accessibility_index_pca
-from compute_location_reach import compute_poi_reach, compute_buildings_reach, compute_poi_absolute_reach, compute_buildings_absolute_reach
-import networkx as nx
+from database import db_engine, gdf_from_sql, gdf_chunks_from_sql, gdfs_from_sql, save_gdf_to_db, db_execute, has_db_table, staging_table_name, swap_staging_table, geometry_columns
+from queries import pedestrian_network_query, residential_buildings_query, poi_query, city_bounds_query, pedestrian_network_tile_query, residential_buildings_tile_query, poi_tile_query, access_weights_query, offline_queries
+from network import build_network_from_segments, network_segments_from_geodataframe, network_segments_from_chunks, extend_network_with_chunks, write_network, read_network_from_file, stale_snapped_features
+from network_cache import NETWORK_CACHE_DIR, cache_path, is_cached
+from compute_accessibility_index import compute_accessibility_index_weighed_sum, compute_accessibility_index_pca, fit_pca_model, frame_chunks, pca_model_path, cached_pca_model, load_pca_model, score_accessibility_index_pca, regions_service_level
+from parquet_store import read_table, read_table_within, write_table, export_queries, has_table, swap_table
+from compute_location_reach import compute_poi_reach, compute_buildings_isochrons, count_reachable_pois, buildings_reach_from_counts, compute_absolute_reach, compute_nearest_poi_distances, compute_reach_table, compute_absolute_reach_bands, threshold_sufix, update_reach_table
+from tiled_reach import city_tiles, compute_tiled_absolute_reach
+from reach_table import cached_reach_table, reach_table_path, reach_table_within, load_reach_table, save_reach_table
+from pipeline import PIPELINE_CACHE_DIR, cached_stage, changed_stage, data_hash
+import numpy as np
 
 # Load environment variables from a .env file
 load_dotenv()
 
+# The PCA service index models are kept per access weights and results table, so the scores of new or changed buildings
+# are comparable with the ones of earlier runs. Set REACH_PCA_MODEL_VERSION to a new value to refit them on the current buildings
+PCA_MODEL_VERSION = os.getenv('REACH_PCA_MODEL_VERSION', '1')
+
+def is_data_dir(database):
+  """
+  database is the path of an offline GeoParquet data directory (see parquet_store) instead of an engine
+  """
+  return isinstance(database, str)
+
+def save_gdf(database, schema, table_name, gdf, if_exists = 'replace'):
+  """
+  save_gdf_to_db, or write_table to an offline data directory - the schema is not used there
+  """
+  if is_data_dir(database):
+    write_table(database, table_name, gdf, if_exists)
+  else:
+    save_gdf_to_db(database, schema, table_name, gdf, if_exists)
+
+def swap_staged_table(database, schema, table_name, gdf):
+  """
+  Puts the staging table of table_name, written with save_gdf part by part, in place of the table.
+  gdf: a frame with the columns written to it
+  """
+  if is_data_dir(database):
+    swap_table(database, staging_table_name(table_name), table_name)
+  else:
+    swap_staging_table(database, schema, table_name, geometry_columns(gdf))
+
+def result_destination(database, schema):
+  """
+  Where save_gdf writes - the data directory, or the database (without its password) and schema
+  """
+  if is_data_dir(database):
+    return os.path.abspath(database)
+  return f"{database.url.render_as_string(hide_password=True)}/{schema}"
+
+def has_result_table(database, schema, table_name):
+  if is_data_dir(database):
+    return has_table(database, table_name)
+  return has_db_table(database, schema, table_name)
+
 def create_regions_with_service_level(database, tables_sufix):
+  if is_data_dir(database):
+    gdf_regions = regions_service_level(read_table(database, 'gen_adm_regions'), read_table(database, f"results_residentials_service_level_{tables_sufix}"), ['id', 'obns_lat'])
+    write_table(database, f"results_gen_adm_regions_service_level_{tables_sufix}", gdf_regions)
+    return
+
   sql = f"""
     DROP TABLE IF EXISTS zvezdi_work.results_gen_adm_regions_service_level_{tables_sufix};
     CREATE TABLE zvezdi_work.results_gen_adm_regions_service_level_{tables_sufix} AS
@@ -36,6 +89,11 @@ def create_regions_with_service_level(database, tables_sufix):
     print(f"Could not create, {e}")
 
 def create_ge_with_service_level(database, tables_sufix):
+  if is_data_dir(database):
+    gdf_ge = regions_service_level(read_table(database, 'ge_2020'), read_table(database, f"results_residentials_service_level_{tables_sufix}"), ['id', 'regname', 'rajon'])
+    write_table(database, f"results_ge_service_level_{tables_sufix}", gdf_ge)
+    return
+
   sql = f"""
     DROP TABLE IF EXISTS zvezdi_work.results_ge_service_level_{tables_sufix};
     CREATE TABLE zvezdi_work.results_ge_service_level_{tables_sufix} AS
@@ -59,128 +117,477 @@ def create_ge_with_service_level(database, tables_sufix):
   except Exception as e:
     print(f"Could not create, {e}")
 
-def compute_isochron_accesibilities(gdf_pedestrian_network, pois, gdf_residentials, df_access_weights, snap_to: None, save_network_as = None, database = None, schema = None, tables_sufix = None):
+def pca_model_for(gdf_residentials, df_access_weights, table_name):
+  """
+  The PCA service index model of the results table, fitted on the first run and reused by the next ones so their scores
+  are comparable, new and changed buildings are scored with it. It is refitted when the access weights or PCA_MODEL_VERSION change
+  """
+  return cached_pca_model(
+    pca_model_path(df_access_weights, table_name, PCA_MODEL_VERSION),
+    lambda: fit_pca_model(lambda: frame_chunks(gdf_residentials), df_access_weights),
+  )
+
+def save_result(database, schema, table_name, gdf, stage_cache = None):
+  """
+  save_gdf, skipped when the same gdf was the last one written to the table at the same destination and the table is still there
+  (see pipeline.changed_stage)
+  """
+  changed_stage(
+    stage_cache,
+    f"{schema}.{table_name}",
+    [result_destination(database, schema), gdf],
+    lambda: save_gdf(database, schema, table_name, gdf),
+    exists = lambda: has_result_table(database, schema, table_name),
+  )
+
+def compute_isochron_accesibilities(pedestrian_network_segments, pois, gdf_residentials, df_access_weights, snap_to: None, network_cache = None, database = None, schema = None, tables_sufix = None, stage_cache = None):
   """
   Compute the accesible items by creating isochron (convex hull around the points that are within the specified distance).
   This add some small error to the 'max_weight' but is fast to do and pretty.
+  pedestrian_network_segments: the NetworkSegments of the pedestrian network (see network.network_segments_from_chunks)
+  network_cache: path of the binary network cache, the network is read from it when present and written to it otherwise
+  stage_cache: directory of the cached stage outputs (see pipeline), the reach of unchanged inputs is reused and
+    the network is only loaded when a reach stage has to run. The reach stages checkpoint their chunks in it as they go,
+    a rerun after a crash resumes them
   """
-  pedestrian_network = build_network_from_geodataframe(gdf_pedestrian_network, save_as = save_network_as)
+  networks = {}
+
+  def pedestrian_network():
+    if 'network' not in networks:
+      if network_cache and is_cached(network_cache):
+        networks['network'], _snapped_nodes = read_network_from_file(network_cache, backend = 'networkx')
+      else:
+        networks['network'] = build_network_from_segments(pedestrian_network_segments, save_as = network_cache)
+    return networks['network']
+
+  # The network is identified by the content of its edges, whatever cache it is kept in
+  network_input = data_hash(pedestrian_network_segments)
+  reach_parameters = {'weight_type': 'length', 'max_weight': 1000, 'snap_to': snap_to}
 
   # Create tables for each POI with the number of buildings/appartments within reach
   for poi_type, poi_gdf in pois.items():
     print(f"Working on {poi_type}")
-    gdf_poi_reach = compute_poi_reach(
-      pedestrian_network,
-      poi_gdf,
+    gdf_poi_reach = cached_stage(
+      stage_cache,
+      f"isochron_poi_reach_{poi_type}",
+      [network_input, poi_gdf, gdf_residentials, reach_parameters],
+      lambda checkpoint: compute_poi_reach(
+        pedestrian_network(),
+        poi_gdf,
+        gdf_residentials,
+        weight_type = 'length',
+        max_weight = 1000,
+        snap_to = snap_to,
+        checkpoint = checkpoint,
+      ),
+      checkpoint = True,
+    )
+    save_result(database, schema, f"results_{poi_type}_reach_{tables_sufix}", gdf_poi_reach, stage_cache)
+
+  # Create table for residentials service level - compute the index both systematically and with PCA.
+  # The isochrons of the buildings do not depend on the POIs, the POIs of every type are counted in them by a stage of its own,
+  # a change of some POIs only counts the POIs of their type again
+  buildings_isochrons_input = [network_input, gdf_residentials, reach_parameters]
+  gdf_buildings_isochrons = cached_stage(
+    stage_cache,
+    "isochron_buildings_isochrons",
+    buildings_isochrons_input,
+    lambda checkpoint: compute_buildings_isochrons(
+      pedestrian_network(),
       gdf_residentials,
       weight_type = 'length',
       max_weight = 1000,
       snap_to = snap_to,
+      checkpoint = checkpoint,
+    ),
+    checkpoint = True,
+  )
+  poi_counts = [
+    cached_stage(
+      stage_cache,
+      f"isochron_buildings_reach_{poi_type}",
+      [*buildings_isochrons_input, poi_gdf],
+      lambda: count_reachable_pois(gdf_buildings_isochrons, poi_gdf),
     )
-    save_gdf_to_db(database, schema, f"results_{poi_type}_reach_{tables_sufix}", gdf_poi_reach)
+    for poi_type, poi_gdf in pois.items()
+  ]
+  gdf_residentials_reach = buildings_reach_from_counts(gdf_buildings_isochrons, poi_counts)
+  gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
+  table_name = f"results_residentials_service_level_{tables_sufix}"
+  pca_model = pca_model_for(gdf_residentials_with_access_index, df_access_weights, table_name)
+  gdf_residentials_with_access_index_and_pca = compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca', model = pca_model)
+  save_result(database, schema, table_name, gdf_residentials_with_access_index_and_pca, stage_cache)
 
-  # Create table for residentials service level - compute the index both systematically and with PCA
-  gdf_residentials_reach = compute_buildings_reach(
+def compute_absolute_reach_results(pedestrian_network_segments, pois, gdf_residentials, network_cache = None, backend = 'csr', workers = 1, nearest_poi_distances = False, thresholds = None, incremental = False, checkpoint = None):
+  """
+  The reach behind the results of compute_absolute_accesibilities, see it for the parameters.
+  checkpoint: directory the searches of the reach table are written to as they go, a rerun resumes after the last finished chunk
+  Returns a dict with the pois_reach and residentials_reach, the residentials_nearest_poi with nearest_poi_distances
+  and the pois_reach_bands and residentials_reach_bands with thresholds
+  """
+  snapped_gdfs = {**pois, 'residentials': gdf_residentials}
+  thresholds = thresholds or []
+  max_weight = max([1000, *thresholds])
+  reach_table_cache = reach_table_path(network_cache, 'length', max_weight) if network_cache else None
+
+  cached = network_cache and is_cached(network_cache)
+  if cached:
+    pedestrian_network, snapped_nodes = read_network_from_file(network_cache, backend = backend)
+    stale = stale_snapped_features(network_cache, snapped_nodes, snapped_gdfs)
+    if stale and not incremental:
+      # Snapping them again rewrites the network, which drops the reach tables computed for the previous features
+      print(f"The {', '.join(stale)} changed since {network_cache} was written, snapping them again")
+      cached = False
+
+  if cached:
+    if incremental:
+      # The cached network is not changed by snapping, the current features are snapped again and compared with the cached ones
+      for gdf in extend_network_with_chunks(pedestrian_network, snapped_gdfs.values()):
+        pass
+      changed = any(
+        name not in snapped_nodes or not np.array_equal(snapped_nodes[name][0], gdf['id'].to_numpy()) or snapped_nodes[name][1] != list(gdf["snapped_to_node"])
+        for name, gdf in snapped_gdfs.items()
+      ) or len(snapped_nodes) != len(snapped_gdfs)
+
+      if changed:
+        updated_reach_table = None
+        if is_cached(reach_table_cache):
+          updated_reach_table, searches = update_reach_table(
+            pedestrian_network,
+            load_reach_table(reach_table_cache),
+            snapped_nodes,
+            pois,
+            gdf_residentials,
+            weight_type = 'length',
+            max_weight = max_weight,
+            workers = workers,
+          )
+          print(f"Updated the reach table with {searches} searches")
+        # Writing the network drops the reach tables computed for the previous features
+        write_network(network_cache, pedestrian_network, snapped_gdfs)
+        if updated_reach_table is not None:
+          save_reach_table(reach_table_cache, updated_reach_table)
+    else:
+      for name, gdf in snapped_gdfs.items():
+        gdf["snapped_to_node"] = snapped_nodes[name][1]
+  else:
+    pedestrian_network = build_network_from_segments(pedestrian_network_segments, backend = backend)
+
+    # Extend network with all buildings and pois
+    for gdf in extend_network_with_chunks(pedestrian_network, snapped_gdfs.values()):
+      pass
+    if network_cache:
+      write_network(network_cache, pedestrian_network, snapped_gdfs)
+
+  # A single search per POI gives the reach table all the results are derived from, it is cached next to the network
+  full_reach_table = cached_reach_table(
+    reach_table_cache,
+    lambda: compute_reach_table(pedestrian_network, pois, gdf_residentials, weight_type = 'length', max_weight = max_weight, workers = workers, checkpoint = checkpoint),
+  )
+  reach_table = reach_table_within(full_reach_table, 1000)
+  pois_reach, gdf_residentials_reach = compute_absolute_reach(
     pedestrian_network,
+    pois,
     gdf_residentials,
-    pois.values(),
     weight_type = 'length',
     max_weight = 1000,
-    snap_to = snap_to,
+    reach_table = reach_table,
   )
-  gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
-  gdf_residentials_with_access_index_and_pca = compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca')
-  save_gdf_to_db(database, schema, f"results_residentials_service_level_{tables_sufix}", gdf_residentials_with_access_index_and_pca)
 
-def compute_absolute_accesibilities(gdf_pedestrian_network, pois, gdf_residentials, df_access_weights, save_network_as = None, database = None, schema = None, tables_sufix = None):
+  reach = {'pois_reach': pois_reach, 'residentials_reach': gdf_residentials_reach}
+
+  if nearest_poi_distances:
+    reach['residentials_nearest_poi'] = compute_nearest_poi_distances(
+      pedestrian_network,
+      pois,
+      gdf_residentials,
+      weight_type = 'length',
+      max_weight = 1000,
+      reach_table = reach_table,
+    )
+
+  if thresholds:
+    reach['pois_reach_bands'], reach['residentials_reach_bands'] = compute_absolute_reach_bands(
+      pedestrian_network,
+      pois,
+      gdf_residentials,
+      thresholds,
+      weight_type = 'length',
+      reach_table = full_reach_table,
+    )
+
+  return reach
+
+def compute_absolute_accesibilities(pedestrian_network_segments, pois, gdf_residentials, df_access_weights, network_cache = None, database = None, schema = None, tables_sufix = None, backend = 'csr', workers = 1, nearest_poi_distances = False, thresholds = None, incremental = False, stage_cache = None):
   """
   Compute the accesible items by adding each point to the network and computing all points within 'max_weight' distance from the origin point.
   The point is added by snapping the original to the closest edge and spliting it in two (weights are split proportionally).
   The process of adding the nodes is quite slow and not idempotent(if you snap the same point after adding some other edges,
   the resultion node might be different as the graph has changes),
   hence I preserve the node I've assosiated with a Point when adding it and use that preserved when computing accesible items 
+  pedestrian_network_segments: the NetworkSegments of the pedestrian network (see network.network_segments_from_chunks)
+  backend: 'networkx'|'csr' - with 'csr' the points are snapped as virtual nodes (edge, fraction) instead,
+    the network is not changed and every search starts from both ends of the snapped edge
+  workers: number of processes running the searches on the 'csr' backend, None for all CPUs
+  network_cache: path of the binary network cache, the snapped network is read from it when present and written to it otherwise
+  nearest_poi_distances: also save the distance from every building to the nearest POI of every subgroup
+  thresholds: list of extra cutoffs in meters, also save the POI reach per band and the residentials service level for every cutoff.
+    The reach table is computed once to the largest cutoff and every band is filtered from it
+  incremental: when the features changed since the cached network was written, update its reach table with searches from
+    the added and moved features only, instead of failing on the stale cache. Needs the 'csr' backend
+  stage_cache: directory of the cached stage outputs (see pipeline), the reach of unchanged inputs is reused without
+    loading the network and the tables that did not change are not written again. The searches of the reach table
+    are checkpointed in it as they go, a rerun after a crash resumes them
   """
-  pedestrian_network = build_network_from_geodataframe(gdf_pedestrian_network)
+  # The network is identified by the content of its edges, whatever cache it is kept in. The inputs are hashed before they are snapped
+  reach = cached_stage(
+    stage_cache,
+    "absolute_reach",
+    [data_hash(pedestrian_network_segments), pois, gdf_residentials, {'backend': backend, 'nearest_poi_distances': nearest_poi_distances, 'thresholds': thresholds or []}],
+    lambda checkpoint: compute_absolute_reach_results(
+      pedestrian_network_segments,
+      pois,
+      gdf_residentials,
+      network_cache = network_cache,
+      backend = backend,
+      workers = workers,
+      nearest_poi_distances = nearest_poi_distances,
+      thresholds = thresholds,
+      incremental = incremental,
+      checkpoint = checkpoint,
+    ),
+    checkpoint = True,
+  )
 
-  # Extend network with all buildings and pois
-  for poi_type, poi_gdf in pois.items():
-    extend_network_with(pedestrian_network, poi_gdf)
-  extend_network_with(pedestrian_network, gdf_residentials)
-  nx.write_gml(pedestrian_network, 'lib/saves/pedestrian_network_extended.graph')
-  
   # Create tables for each POI with the number of buildings/appartments within reach
-  for poi_type, poi_gdf in pois.items():
-    print(f"Working on {poi_type}")
-    gdf_poi_reach = compute_poi_absolute_reach(
-      pedestrian_network,
-      poi_gdf,
-      gdf_residentials,
-      weight_type = 'length',
-      max_weight = 1000,
-    )
-    save_gdf_to_db(database, schema, f"results_{poi_type}_reach_{tables_sufix}", gdf_poi_reach)
+  for poi_type, gdf_poi_reach in reach['pois_reach'].items():
+    save_result(database, schema, f"results_{poi_type}_reach_{tables_sufix}", gdf_poi_reach, stage_cache)
 
   # Create table for residentials service level - compute the index both systematically and with PCA
-  gdf_residentials_reach = compute_buildings_absolute_reach(
-    pedestrian_network,
-    gdf_residentials,
-    pois.values(),
-    weight_type = 'length',
-    max_weight = 1000,
+  gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(reach['residentials_reach'], df_access_weights, column_name = 'service_index')
+  table_name = f"results_residentials_service_level_{tables_sufix}"
+  pca_model = pca_model_for(gdf_residentials_with_access_index, df_access_weights, table_name)
+  gdf_residentials_with_access_index_and_pca = compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca', model = pca_model)
+  save_result(database, schema, table_name, gdf_residentials_with_access_index_and_pca, stage_cache)
+
+  if nearest_poi_distances:
+    save_result(database, schema, f"results_residentials_nearest_poi_{tables_sufix}", reach['residentials_nearest_poi'], stage_cache)
+
+  if thresholds:
+    for poi_type, gdf_poi_reach in reach['pois_reach_bands'].items():
+      save_result(database, schema, f"results_{poi_type}_reach_bands_{tables_sufix}", gdf_poi_reach, stage_cache)
+    for threshold, gdf_residentials_reach in reach['residentials_reach_bands'].items():
+      gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
+      table_name = f"results_residentials_service_level_{tables_sufix}_{threshold_sufix(threshold)}"
+      pca_model = pca_model_for(gdf_residentials_with_access_index, df_access_weights, table_name)
+      gdf_residentials_with_access_index_and_pca = compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca', model = pca_model)
+      save_result(database, schema, table_name, gdf_residentials_with_access_index_and_pca, stage_cache)
+
+def access_weights(db_connection, data_dir = None):
+  """
+  data_dir: read the weights from an offline data directory instead
+  """
+  if data_dir:
+    df_access_weights = read_table(data_dir, 'access_weights')
+  else:
+    df_access_weights = pd.read_sql_query(access_weights_query(), con=db_connection)
+  df_access_weights['gr_weights'] = pd.to_numeric(df_access_weights['gr_weights'])
+  df_access_weights['sgr_weights'] = pd.to_numeric(df_access_weights['sgr_weights'])
+
+  return df_access_weights
+
+def subgroup_columns_frame(gdf_residentials_reach, df_access_weights):
+  """
+  gdf_residentials_reach with a column for every subgroup of the access weights, in their order, 0 where no POI of it is within reach.
+  Every tile of a city gets the same columns, whatever the subgroups its buildings reach. Subgroups without a weight are dropped,
+  they do not count in any index
+
+  >>> df_access_weights = pd.DataFrame({'subgroup_id': ['parks', 'schools'], 'gr_weights': [0.5, 0.25], 'sgr_weights': [2, 4]})
+  >>> subgroup_columns_frame(pd.DataFrame({'id': [1, 2], 'schools': [1, None], 'other': [2, 2]}), df_access_weights)
+     id  parks  schools
+  0   1    0.0      1.0
+  1   2    0.0      0.0
+  """
+  subgroups = list(df_access_weights['subgroup_id'])
+  columns = [column for column in ['id', 'geom', 'floorcount', 'appcount'] if column in gdf_residentials_reach.columns]
+  df = gdf_residentials_reach.reindex(columns=[*columns, *subgroups])
+  df[subgroups] = df[subgroups].astype(np.float64).fillna(0)
+
+  return df
+
+def compute_tiled_absolute_accesibilities(load_tile, tiles, df_access_weights, database = None, schema = None, tables_sufix = None, workers = 1):
+  """
+  The results of compute_absolute_accesibilities for the whole city, computed one tile at a time (see tiled_reach).
+  The reach of every tile is appended to the staging tables of the results as soon as it is done, the buildings of every tile
+  with a column for every subgroup (see subgroup_columns_frame), scored with the PCA service index model of earlier runs.
+  Without one, the buildings of every tile are written to a temporary directory until all tiles are done, the model is fitted
+  reading them back one tile at a time and they are scored and saved from there. The staging tables are swapped in once all tiles are in, readers see the tables of the previous
+  run until then. A table without rows in any tile is replaced by an empty one
+  """
+  staged_tables = {}
+  empty_tables = {}
+
+  def save_tile_table(table_name, gdf):
+    if gdf.empty:
+      empty_tables.setdefault(table_name, gdf)
+      return
+    save_gdf(database, schema, staging_table_name(table_name), gdf, if_exists = 'append' if table_name in staged_tables else 'replace')
+    staged_tables.setdefault(table_name, gdf.iloc[:0])
+
+  residentials_table_name = f"results_residentials_service_level_{tables_sufix}"
+  pca_model_cache = pca_model_path(df_access_weights, residentials_table_name, PCA_MODEL_VERSION)
+  pca_model = load_pca_model(pca_model_cache) if is_cached(pca_model_cache) else None
+  with tempfile.TemporaryDirectory() as tiles_dir:
+    tile_paths = []
+    for tile, pois_reach, gdf_residentials_reach in compute_tiled_absolute_reach(load_tile, tiles, weight_type = 'length', max_weight = 1000, workers = workers):
+      print(f"Computed tile {tile.bounds}")
+      for poi_type, gdf_poi_reach in pois_reach.items():
+        save_tile_table(f"results_{poi_type}_reach_{tables_sufix}", gdf_poi_reach)
+
+      gdf_residentials_reach = subgroup_columns_frame(gdf_residentials_reach, df_access_weights)
+      gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
+      if pca_model is None:
+        tile_paths.append(os.path.join(tiles_dir, f"tile_{len(tile_paths)}.pkl"))
+        gdf_residentials_with_access_index.to_pickle(tile_paths[-1])
+      else:
+        for gdf_residentials_scored in score_accessibility_index_pca(pca_model, [gdf_residentials_with_access_index], column_name = 'service_index_pca'):
+          save_tile_table(residentials_table_name, gdf_residentials_scored)
+
+    if pca_model is None:
+      def load_tiles():
+        return (pd.read_pickle(path) for path in tile_paths)
+
+      pca_model = cached_pca_model(pca_model_cache, lambda: fit_pca_model(load_tiles, df_access_weights))
+      for gdf_residentials_scored in score_accessibility_index_pca(pca_model, load_tiles(), column_name = 'service_index_pca'):
+        save_tile_table(residentials_table_name, gdf_residentials_scored)
+
+  for table_name, gdf in staged_tables.items():
+    swap_staged_table(database, schema, table_name, gdf)
+  for table_name, gdf in empty_tables.items():
+    if table_name not in staged_tables:
+      save_gdf(database, schema, table_name, gdf)
+
+def compute_city_absolute_accesibilities(database, schema, poi_tables, tile_size, tables_sufix = None, workers = 1):
+  """
+  Tiles the extent of all residential buildings and loads every tile with its halo from the database,
+  or from the tables of an offline data directory
+  """
+  if is_data_dir(database):
+    city_bounds = tuple(read_table(database, 'residential_buildings', columns = ['geom']).total_bounds)
+    df_access_weights = access_weights(None, data_dir = database)
+  else:
+    with database.connect() as db_connection:
+      city_bounds = tuple(pd.read_sql_query(city_bounds_query(), con=db_connection).iloc[0])
+      df_access_weights = access_weights(db_connection)
+
+  def load_tile(tile):
+    if is_data_dir(database):
+      return (
+        read_table_within(database, 'pedestrian_network', tile.network_bounds),
+        {poi_table: read_table_within(database, poi_table, tile.features_bounds) for poi_table in poi_tables},
+        read_table_within(database, 'residential_buildings', tile.features_bounds),
+      )
+    with database.connect() as db_connection:
+      gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_tile_query(tile.network_bounds))
+      gdf_residentials = gdf_from_sql(db_connection, residential_buildings_tile_query(tile.features_bounds))
+    pois = gdfs_from_sql(database, {poi_table: poi_tile_query(poi_table, tile.features_bounds) for poi_table in poi_tables})
+    return gdf_pedestrian_network, pois, gdf_residentials
+
+  compute_tiled_absolute_accesibilities(
+    load_tile,
+    city_tiles(city_bounds, tile_size, max_weight = 1000),
+    df_access_weights,
+    database = database,
+    schema = schema,
+    tables_sufix = tables_sufix,
+    workers = workers,
   )
-  gdf_residentials_with_access_index = compute_accessibility_index_weighed_sum(gdf_residentials_reach, df_access_weights, column_name = 'service_index')
-  gdf_residentials_with_access_index_and_pca = compute_accessibility_index_pca(gdf_residentials_with_access_index, df_access_weights, column_name = 'service_index_pca')
-  save_gdf_to_db(database, schema, f"results_residentials_service_level_{tables_sufix}", gdf_residentials_with_access_index_and_pca)
 
 def main():
-  database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+  # Path of an offline GeoParquet data directory, read the inputs from and write the results to it instead of the database
+  DATA_DIR = os.getenv('REACH_DATA_DIR')
+  # REACH_EXPORT=1 exports the inputs from the database to REACH_DATA_DIR and stops
+  EXPORT = os.getenv('REACH_EXPORT', '0') == '1'
+  database = DATA_DIR if DATA_DIR and not EXPORT else db_engine(os.getenv('DB_CONNECTION_STRING'))
   SCOPE = 'Lozenec'
   SCHEMA = 'zvezdi_work'
+  WORKERS = int(os.getenv('REACH_WORKERS', 1))
+  # Update the cached reach from the changed features only instead of failing on a stale cache
+  INCREMENTAL = os.getenv('REACH_INCREMENTAL', '0') == '1'
+  # Extra catchments in meters, e.g. REACH_THRESHOLDS=300,500,800
+  THRESHOLDS = [float(threshold) for threshold in os.getenv('REACH_THRESHOLDS', '').split(',') if threshold.strip()]
+  POI_TABLES = ['poi_culture', 'poi_health', 'poi_kids', 'poi_mobility', 'poi_others', 'poi_parks', 'poi_schools', 'poi_sport']
+  # Tile size in meters, runs the absolute reach for the whole city one tile at a time instead of for SCOPE
+  TILE_SIZE = os.getenv('REACH_TILE_SIZE')
+  # Reuse the outputs of the stages whose inputs did not change, REACH_STAGE_CACHE=0 reruns everything
+  STAGE_CACHE = PIPELINE_CACHE_DIR if os.getenv('REACH_STAGE_CACHE', '1') == '1' else None
+
+  if EXPORT:
+    export_queries(database, DATA_DIR, offline_queries(SCOPE, POI_TABLES))
+    return
+
+  if TILE_SIZE:
+    compute_city_absolute_accesibilities(database, SCHEMA, POI_TABLES, float(TILE_SIZE), tables_sufix = "absolute_city", workers = WORKERS)
+    create_regions_with_service_level(database, "absolute_city")
+    create_ge_with_service_level(database, "absolute_city")
+    return
+
+  if is_data_dir(database):
+    pedestrian_network_segments = network_segments_from_geodataframe(read_table(database, 'pedestrian_network'))
+    gdf_residential_buildings_lozenec = read_table(database, 'residential_buildings')
+    df_access_weights = access_weights(None, data_dir = database)
+    pois = {poi_table: read_table(database, poi_table) for poi_table in POI_TABLES}
+  else:
+    with database.connect() as db_connection:
+      # The pedestrian network is streamed in chunks, only their segments are kept
+      pedestrian_network_segments = network_segments_from_chunks(gdf_chunks_from_sql(db_connection, pedestrian_network_query(SCOPE)))
+      gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
+      df_access_weights = access_weights(db_connection)
+
+    pois = gdfs_from_sql(database, {poi_table: poi_query(poi_table, SCOPE) for poi_table in POI_TABLES})
 
-  with database.connect() as db_connection:
-    gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_query(SCOPE))
-    gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
-    df_access_weights = pd.read_sql_query("select subgroup_id, sgr_weights, gr_weights from zvezdi_work.access_weights", con=db_connection)
-    df_access_weights['gr_weights'] = pd.to_numeric(df_access_weights['gr_weights'])
-    df_access_weights['sgr_weights'] = pd.to_numeric(df_access_weights['sgr_weights'])
-
-    pois = {
-      'poi_culture': gdf_from_sql(db_connection, poi_query('poi_culture', SCOPE)),
-      'poi_health': gdf_from_sql(db_connection, poi_query('poi_health', SCOPE)),
-      'poi_kids': gdf_from_sql(db_connection, poi_query('poi_kids', SCOPE)),
-      'poi_mobility': gdf_from_sql(db_connection, poi_query('poi_mobility', SCOPE)),
-      'poi_others': gdf_from_sql(db_connection, poi_query('poi_others', SCOPE)),
-      'poi_parks': gdf_from_sql(db_connection, poi_query('poi_parks', SCOPE)),
-      'poi_schools': gdf_from_sql(db_connection, poi_query('poi_schools', SCOPE)),
-      'poi_sport': gdf_from_sql(db_connection, poi_query('poi_sport', SCOPE)),
-    }
+  # The networks are cached by the segments of the pedestrian network, the same in the database and offline whatever chunks it is read in.
+  # The features snapped to a cached network are checked against the loaded ones, the ones that changed are snapped again
+  # (or update the reach table with REACH_INCREMENTAL)
+  network_hash = data_hash(pedestrian_network_segments)
+  isochron_network_cache = cache_path(NETWORK_CACHE_DIR, network_hash, {'backend': 'networkx'})
+  absolute_network_cache = cache_path(NETWORK_CACHE_DIR, network_hash, {'backend': 'csr', 'snap_to': 'edge'})
 
   compute_isochron_accesibilities(
-    gdf_pedestrian_network,
+    pedestrian_network_segments,
     pois,
     gdf_residential_buildings_lozenec,
     df_access_weights,
     snap_to = 'edge',
-    save_network_as = "lib/saves/pedestrian_network.graph",
+    network_cache = isochron_network_cache,
     database = database,
     schema = SCHEMA,
     tables_sufix = "isochron",
+    stage_cache = STAGE_CACHE,
   )
   create_regions_with_service_level(database, "isochron")
   create_ge_with_service_level(database, "isochron")
 
   compute_absolute_accesibilities(
-    gdf_pedestrian_network,
+    pedestrian_network_segments,
     pois,
     gdf_residential_buildings_lozenec,
     df_access_weights,
-    save_network_as = "lib/saves/pedestrian_network_extended.graph",
+    network_cache = absolute_network_cache,
     database = database,
     schema = SCHEMA,
     tables_sufix = "absolute",
+    workers = WORKERS,
+    nearest_poi_distances = True,
+    thresholds = THRESHOLDS,
+    incremental = INCREMENTAL,
+    stage_cache = STAGE_CACHE,
   )
   create_regions_with_service_level(database, "absolute")
   create_ge_with_service_level(database, "absolute")
+  for threshold in THRESHOLDS:
+    create_regions_with_service_level(database, f"absolute_{threshold_sufix(threshold)}")
+    create_ge_with_service_level(database, f"absolute_{threshold_sufix(threshold)}")
 
 if __name__ == "__main__":
   main()
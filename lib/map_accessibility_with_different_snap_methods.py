@@ -1,21 +1,23 @@
 import geopandas as gpd
-from shapely.geometry import MultiPoint, MultiPolygon
+from shapely.geometry import MultiPoint
 
 from helpers import crs_transform_point, crs_transform
 from database import db_engine, gdf_from_sql
 from queries import pedestrian_network_query, administrative_regions_query, residential_buildings_query, poi_query, buffered_region_boundary
-from network import build_network_from_geodataframe, find_nearest_node, compute_accessibility_isochron,snap_point_to_edge, node_to_point, compute_accessibility_boundary_points, filter_nodes_within_accessibility_isochron
+from network_cache import NETWORK_CACHE_DIR, cache_path
+from parquet_store import read_table
+from pipeline import data_hash
+from network import cached_network, network_segments_from_geodataframe, find_nearest_node, compute_accessibility_isochron,snap_point_to_edge, node_to_point, compute_accessibility_boundary_points, filter_nodes_within_accessibility_isochron, build_locations_tree, locations_within_isochron
 import os
 from dotenv import load_dotenv
 
 import folium
 
-def filter_points_within_isochron(geo_data_frame, alpha_shape):
-  if isinstance(alpha_shape, MultiPolygon):
-    filtered_gdf = geo_data_frame[geo_data_frame.geometry.apply(lambda x: any(x.within(polygon) for polygon in alpha_shape.geoms))]
-  else:
-    filtered_gdf = geo_data_frame[geo_data_frame.geometry.apply(lambda x: x.within(alpha_shape))]
-  return filtered_gdf
+def filter_points_within_isochron(geo_data_frame, alpha_shape, points_tree = None):
+  # A MultiPolygon alpha shape keeps the points within any of its polygons
+  if points_tree is None:
+    points_tree = build_locations_tree(geo_data_frame.geometry)
+  return geo_data_frame.iloc[locations_within_isochron(points_tree, alpha_shape)]
 
 def draw_accessibility(layer, pedestrian_network, gdf_residential_buildings, node_id, color):
   point = node_to_point(pedestrian_network, node_id)
@@ -83,18 +85,31 @@ def draw_accessibility(layer, pedestrian_network, gdf_residential_buildings, nod
 # Load environment variables from a .env file
 load_dotenv()
 
-# Get data
-database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+# Get data, from an offline GeoParquet data directory (see main.py) when REACH_DATA_DIR is set
+DATA_DIR = os.getenv('REACH_DATA_DIR')
 SCOPE = 'Lozenec'
-with database.connect() as db_connection:
-  gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_query(SCOPE))
-  gdf_adm_regions = gdf_from_sql(db_connection, administrative_regions_query())
-  gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
-  gdf_pois = gdf_from_sql(db_connection, poi_query('poi_schools', SCOPE))
+if DATA_DIR:
+  gdf_pedestrian_network = read_table(DATA_DIR, 'pedestrian_network')
+  gdf_adm_regions = read_table(DATA_DIR, 'gen_adm_regions', columns=['id', 'geom', 'obns_cyr']).rename(columns={'obns_cyr': 'municipality'})
+  gdf_residential_buildings_lozenec = read_table(DATA_DIR, 'residential_buildings')
+  gdf_pois = read_table(DATA_DIR, 'poi_schools')
+
+  gdf_buffer_region = read_table(DATA_DIR, 'buffered_region')
+else:
+  database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+  with database.connect() as db_connection:
+    gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_query(SCOPE))
+    gdf_adm_regions = gdf_from_sql(db_connection, administrative_regions_query())
+    gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
+    gdf_pois = gdf_from_sql(db_connection, poi_query('poi_schools', SCOPE))
+
+    gdf_buffer_region = gdf_from_sql(db_connection, buffered_region_boundary(SCOPE))
+
+# The network is cached by its content, like main.py does
+# Keyed by the segments of the pedestrian network like the network caches of main.py
+pedestrian_network_segments = network_segments_from_geodataframe(gdf_pedestrian_network)
+pedestrian_network = cached_network(cache_path(NETWORK_CACHE_DIR, data_hash(pedestrian_network_segments), {'backend': 'networkx'}), lambda: pedestrian_network_segments)
 
-  gdf_buffer_region = gdf_from_sql(db_connection, buffered_region_boundary(SCOPE))
-
-pedestrian_network = build_network_from_geodataframe(gdf_pedestrian_network, save_as = "lib/saves/pedestrian_network.graph")
 results = {}
 
 poi = gdf_pois.sample().iloc[0]
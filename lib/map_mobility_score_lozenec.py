@@ -1,13 +1,12 @@
 from shapely.geometry import MultiPoint
 
-from helpers import crs_transform_coords, crs_transform_multipolygon, crs_transform_polygon
-from database import db_engine, gdf_from_sql
+from helpers import crs_transform_coords, crs_transform_gdf, crs_transform_geometries
+from database import db_engine, gdf_from_sql, gdfs_from_sql, geometries_from_sql
 from queries import residential_buildings_with_service_level_query, poi_reach_query, buffered_region_boundary
+from parquet_store import read_table, read_table_in
 
 import folium
 from folium.plugins import MarkerCluster
-from helpers import crs_transform_coords, crs_transform_polygon
-from shapely import wkt
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.colors
 
@@ -85,8 +84,8 @@ def popup(content_dict):
 
 def residentials_service_level_layer(gdf_residentials_service_levels, color_map, color_metric=None, show=True):
   residentials_cluster = MarkerCluster(name = f"Residential buildings {color_metric}", show=show)
-  for idx, row in gdf_residentials_service_levels.iterrows():
-    lon, lat = crs_transform_coords(row["geom"].x, row["geom"].y)
+  for idx, row in crs_transform_gdf(gdf_residentials_service_levels).iterrows():
+    lon, lat = row["geom"].x, row["geom"].y
     marker = folium.CircleMarker(
       location = [lat, lon],
       radius = 5,
@@ -107,9 +106,8 @@ def residentials_service_level_layer(gdf_residentials_service_levels, color_map,
 
 def ge_service_level_layer(gdf_ge_service_levels, color_map, color_metric=None, show=True):
   ge_layer = folium.FeatureGroup(name=f"GE {color_metric}", show=show)
-  for _idx, ge in gdf_ge_service_levels.iterrows():
-    ge_4326 = crs_transform_multipolygon(ge.geom)
-    for polygon in list(ge_4326.geoms):
+  for _idx, ge in crs_transform_gdf(gdf_ge_service_levels).iterrows():
+    for polygon in list(ge.geom.geoms):
       folium.Polygon(
         locations = [(lat, lon) for lon, lat in polygon.exterior.coords], 
         color = color_for(round(ge[color_metric]), color_map),
@@ -132,9 +130,8 @@ def ge_service_level_layer(gdf_ge_service_levels, color_map, color_metric=None,
 
 def adm_regions_service_level_layer(gdf_adm_regions_service_levels, color_map, color_metric=None, show=True):
   adm_regions_layer = folium.FeatureGroup(name=f"Administrative Regions {color_metric}", show=show)
-  for _idx, region in gdf_adm_regions_service_levels.iterrows():
-    region_4326 = crs_transform_multipolygon(region.geom)
-    for polygon in list(region_4326.geoms):
+  for _idx, region in crs_transform_gdf(gdf_adm_regions_service_levels).iterrows():
+    for polygon in list(region.geom.geoms):
       folium.Polygon(
         locations = [(lat, lon) for lon, lat in polygon.exterior.coords], 
         color = color_for(round(region[color_metric]), color_map),
@@ -157,11 +154,16 @@ def adm_regions_service_level_layer(gdf_adm_regions_service_levels, color_map, c
 def poi_reach_layer(poi_type, gdf_poi_reach, draw_isochron=False):
   poi_cluster = MarkerCluster(name = f"{poi_type.replace('_', ' ').capitalize()} Reach", show = False)
 
+  # All markers and isochrons of the layer are transformed at once
+  points_4326 = crs_transform_geometries([geom.geoms[0] if isinstance(geom, MultiPoint) else geom for geom in gdf_poi_reach.geom])
+  if draw_isochron:
+    polygons_4326 = crs_transform_geometries(geometries_from_sql(gdf_poi_reach['service_distance_polygon'].values))
+
   # Add points to the Parks layer
-  for idx, row in gdf_poi_reach.iterrows():
+  for position, (idx, row) in enumerate(gdf_poi_reach.iterrows()):
     point = row.geom.geoms[0] if isinstance(row.geom, MultiPoint) else row.geom
 
-    lon, lat = crs_transform_coords(point.x, point.y)
+    lon, lat = points_4326[position].x, points_4326[position].y
     marker = folium.CircleMarker(
       location=[lat, lon],
       radius=5,
@@ -178,8 +180,7 @@ def poi_reach_layer(poi_type, gdf_poi_reach, draw_isochron=False):
     marker.add_to(poi_cluster)
 
     if draw_isochron:
-      polygon_geometry = wkt.loads(row['service_distance_polygon'])
-      polygon_geometry = crs_transform_polygon(polygon_geometry)
+      polygon_geometry = polygons_4326[position]
 
       folium.GeoJson(
         polygon_geometry.__geo_interface__,
@@ -198,13 +199,36 @@ load_dotenv()
 
 # Get data
 SCOPE = 'Lozenec'
-database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+POI_TYPES = ['poi_culture', 'poi_health', 'poi_kids', 'poi_mobility', 'poi_others', 'poi_parks', 'poi_schools', 'poi_sport']
+# Read the results from an offline GeoParquet data directory (see main.py) instead of the database
+DATA_DIR = os.getenv('REACH_DATA_DIR')
+
+if DATA_DIR:
+  gdf_adm_regions_service_levels = read_table(DATA_DIR, "results_gen_adm_regions_service_level_absolute")
+  gdf_ge_service_level = read_table(DATA_DIR, "results_ge_service_level_absolute")
+  gdf_adm_regions = read_table(DATA_DIR, "gen_adm_regions")
+  lozenec = gdf_adm_regions[gdf_adm_regions.obns_lat == 'LOZENEC'].geometry.union_all()
+  gdf_residential_buildings_service_levels_lozenec = read_table_in(DATA_DIR, "results_residentials_service_level_absolute", lozenec, predicate='within')
+  gdf_buffer_region = read_table(DATA_DIR, "buffered_region")
+  buffered_lozenec = gdf_buffer_region.geometry.union_all()
+  pois = {
+    poi_type: read_table_in(DATA_DIR, f"results_{poi_type}_reach_absolute", buffered_lozenec)[['id', 'geom', 'subgroup', 'buildings_within_reach', 'appartments_within_reach']]
+    for poi_type in POI_TYPES
+  }
+else:
+  database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+
+  with database.connect() as db_connection:
+    gdf_adm_regions_service_levels = gdf_from_sql(db_connection, "select * from zvezdi_work.results_gen_adm_regions_service_level_absolute")
+    gdf_ge_service_level = gdf_from_sql(db_connection, "select * from zvezdi_work.results_ge_service_level_absolute")
+    gdf_residential_buildings_service_levels_lozenec = gdf_from_sql(db_connection, residential_buildings_with_service_level_query(SCOPE, analytics_type='absolute'))
+    gdf_buffer_region = gdf_from_sql(db_connection, buffered_region_boundary(SCOPE))
+
+  pois = gdfs_from_sql(database, {
+    poi_type: poi_reach_query(poi_type, SCOPE, analytics_type='absolute')
+    for poi_type in POI_TYPES
+  })
 
-with database.connect() as db_connection:
-  gdf_adm_regions_service_levels = gdf_from_sql(db_connection, "select * from zvezdi_work.results_gen_adm_regions_service_level_absolute")
-  gdf_ge_service_level = gdf_from_sql(db_connection, "select * from zvezdi_work.results_ge_service_level_absolute")
-  gdf_residential_buildings_service_levels_lozenec = gdf_from_sql(db_connection, residential_buildings_with_service_level_query(SCOPE, analytics_type='absolute'))
-  gdf_buffer_region = gdf_from_sql(db_connection, buffered_region_boundary(SCOPE))
 center_lon, center_lat = crs_transform_coords(gdf_residential_buildings_service_levels_lozenec.geometry.x.mean(), gdf_residential_buildings_service_levels_lozenec.geometry.y.mean())
 map = folium.Map(location=[center_lat, center_lon], zoom_start=14)
 
@@ -230,18 +254,6 @@ adm_regions_layer_pca = adm_regions_service_level_layer(gdf_adm_regions_service_
 adm_regions_layer.add_to(map)
 adm_regions_layer_pca.add_to(map)
 
-with database.connect() as db_connection:
-    pois = {
-      'poi_culture': gdf_from_sql(db_connection, poi_reach_query('poi_culture', SCOPE, analytics_type='absolute')),
-      'poi_health': gdf_from_sql(db_connection, poi_reach_query('poi_health', SCOPE, analytics_type='absolute')),
-      'poi_kids': gdf_from_sql(db_connection, poi_reach_query('poi_kids', SCOPE, analytics_type='absolute')),
-      'poi_mobility': gdf_from_sql(db_connection, poi_reach_query('poi_mobility', SCOPE, analytics_type='absolute')),
-      'poi_others': gdf_from_sql(db_connection, poi_reach_query('poi_others', SCOPE, analytics_type='absolute')),
-      'poi_parks': gdf_from_sql(db_connection, poi_reach_query('poi_parks', SCOPE, analytics_type='absolute')),
-      'poi_schools': gdf_from_sql(db_connection, poi_reach_query('poi_schools', SCOPE, analytics_type='absolute')),
-      'poi_sport': gdf_from_sql(db_connection, poi_reach_query('poi_sport', SCOPE, analytics_type='absolute')),
-    }
-
 for poi_type, gdf_poi_reach in pois.items():
   poi_layer = poi_reach_layer(poi_type, gdf_poi_reach, draw_isochron=False)
   poi_layer.add_to(map)
@@ -1,6 +1,6 @@
-from database import db_engine, gdf_from_sql
-from helpers import crs_transform_coords, crs_transform_polygon
-from shapely import wkt
+from database import db_engine, gdf_from_sql, geometries_from_sql
+from helpers import crs_transform_gdf, crs_transform_geometries
+from parquet_store import read_table
 
 import os
 from dotenv import load_dotenv
@@ -11,7 +11,9 @@ from folium.plugins import MarkerCluster
 # Load environment variables from a .env file
 load_dotenv()
 
-database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+# Read the results from an offline GeoParquet data directory (see main.py) instead of the database
+DATA_DIR = os.getenv('REACH_DATA_DIR')
+database = DATA_DIR or db_engine(os.getenv('DB_CONNECTION_STRING'))
 
 def merge_gdf(absolute, isochron):
   merged_gdf = absolute.merge(isochron, on='geom', suffixes=('_absolute', '_isochron'))
@@ -35,9 +37,13 @@ def merge_gdf(absolute, isochron):
   return result_gdf
   
 def draw_accessability(database, poi_type, color):
-  with database.connect() as connection:
-    gdf_poi_reach_isochron = gdf_from_sql(connection, f"select * from zvezdi_work.results_{poi_type}_reach_isochron")
-    gdf_poi_reach_absolute = gdf_from_sql(connection, f"select * from zvezdi_work.results_{poi_type}_reach_absolute")
+  if isinstance(database, str):
+    gdf_poi_reach_isochron = read_table(database, f"results_{poi_type}_reach_isochron")
+    gdf_poi_reach_absolute = read_table(database, f"results_{poi_type}_reach_absolute")
+  else:
+    with database.connect() as connection:
+      gdf_poi_reach_isochron = gdf_from_sql(connection, f"select * from zvezdi_work.results_{poi_type}_reach_isochron")
+      gdf_poi_reach_absolute = gdf_from_sql(connection, f"select * from zvezdi_work.results_{poi_type}_reach_absolute")
 
   merged = merge_gdf(gdf_poi_reach_absolute, gdf_poi_reach_isochron)
 
@@ -46,8 +52,11 @@ def draw_accessability(database, poi_type, color):
   polygons_layer = folium.FeatureGroup(name=f"{poi_type} isochron reach", show=False)
 
   # Add points from isochron
-  for idx, row in merged.iterrows():
-    lon, lat = crs_transform_coords(row["geom"].x, row["geom"].y)
+  # All markers and isochrons are transformed at once
+  merged_4326 = crs_transform_gdf(merged)
+  polygons_4326 = crs_transform_geometries(geometries_from_sql(merged['service_distance_polygon'].values))
+  for position, (idx, row) in enumerate(merged_4326.iterrows()):
+    lon, lat = row["geom"].x, row["geom"].y
     marker = folium.CircleMarker(
       location=[lat, lon],
       radius=5,
@@ -65,8 +74,7 @@ def draw_accessability(database, poi_type, color):
     marker.add_to(pois_marker_cluster)
 
     # Add polygons as reach
-    polygon_geometry = wkt.loads(row['service_distance_polygon'])
-    polygon_geometry = crs_transform_polygon(polygon_geometry)
+    polygon_geometry = polygons_4326[position]
 
     folium.GeoJson(
       polygon_geometry.__geo_interface__,
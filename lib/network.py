@@ -1,58 +1,219 @@
+from collections import namedtuple
 import networkx as nx
-from shapely.geometry import Point, MultiPoint, LineString, MultiLineString
-from shapely.geometry import MultiPoint
-from tqdm import tqdm # progressbar
+import numpy as np
+import shapely
+from shapely.geometry import Point, LineString
 
-def build_network_from_geodataframe(gdf, save_as = None):
-  G = nx.Graph()
-  
-  for _idx, row in gdf.iterrows():
-    geom = row['geom']
-    length = row['meters']
-    time = row['minutes']
-    
-    if isinstance(geom, MultiLineString):
-      for line in geom.geoms:
-        add_line_to_graph(G, line, length, time)
-    elif isinstance(geom, LineString):
-      add_line_to_graph(G, geom, length, time)
-    else:
-        raise TypeError(f"Unexpected geometry type: {type(geom)}")
-  
+from csr_network import CSRNetwork, csr_network_from_edges, csr_network_from_graph, bounded_dijkstra, neighbour_slots, is_virtual_node
+from network_cache import save_network, load_network, load_snapped_points, is_cached
+from snapping import build_snapping_index, nearest_nodes, project_to_nearest_edges, snap_to_edges, snap_points
+
+# coords of all lines one after the other, the positions in them where a segment starts and the weights {'length': (m,), 'time': (m,)} of every segment
+NetworkSegments = namedtuple('NetworkSegments', ['coords', 'segment_starts', 'edge_weights'])
+
+def build_network_from_geodataframe(gdf, save_as = None, backend = 'networkx'):
+  """
+  backend: 'networkx'|'csr' - 'csr' builds a CSRNetwork with integer node ids instead of an nx.Graph keyed by coordinates
+  save_as: path of a directory to store the network in the binary format of write_network
+  """
+  return build_network_from_segments(network_segments_from_geodataframe(gdf), save_as, backend)
+
+def build_network_from_chunks(gdf_chunks, save_as = None, backend = 'networkx'):
+  """
+  Same as build_network_from_geodataframe for the rows of all chunks (e.g. from database.gdf_chunks_from_sql),
+  only the segments of a chunk are kept once it is processed
+  """
+  return build_network_from_segments(network_segments_from_chunks(gdf_chunks), save_as, backend)
+
+def build_network_from_segments(segments, save_as = None, backend = 'networkx'):
+  """
+  The network of the NetworkSegments of network_segments_from_geodataframe or network_segments_from_chunks
+  """
+  if backend not in ('networkx', 'csr'):
+    raise ValueError("backend = 'networkx'|'csr'")
+
+  node_coords, edge_nodes, edge_weights = network_edges_from_segments(segments)
+  network = csr_network_from_edges(node_coords, edge_nodes, edge_weights)
   if save_as:
-    nx.write_gml(G, save_as)
+    save_network(save_as, network)
+
+  if backend == 'csr':
+    return network
+  return graph_from_csr_network(network)
+
+def graph_from_csr_network(network):
+  """
+  An nx.Graph keyed by coordinates, like the networkx backend builds
+  """
+  G = nx.Graph()
+  nodes = [tuple(coord) for coord in network.node_coords.tolist()]
+  G.add_nodes_from((node, {'pos': node}) for node in nodes)
+  G.add_edges_from(
+    (nodes[u], nodes[v], {'length': length, 'time': time})
+    for (u, v), length, time in zip(network.edge_nodes.tolist(), network.edge_weights['length'].tolist(), network.edge_weights['time'].tolist())
+  )
 
   return G
 
-def add_line_to_graph(G, line, length, time):
-  coords = list(line.coords)
-  
-  for i in range(len(coords) - 1):
-    start = coords[i]
-    end = coords[i + 1]
-    
-    # Add nodes with 'pos' attribute
-    if start not in G:
-      G.add_node(start, pos=start)
-    if end not in G:
-      G.add_node(end, pos=end)
-    
-    # Add edge with length and time as weights
-    G.add_edge(start, end, length=length, time=time)
+def network_edges_from_geodataframe(gdf):
+  """
+  Splits every (Multi)LineString in gdf into its segments, all rows at once.
+  Node coordinates are interned into integer ids in order of first appearance.
+  Every segment gets the share of the row's 'meters' and 'minutes' proportional to its own length.
+  Returns node_coords (n, 2), edge_nodes (m, 2) and edge_weights {'length': (m,), 'time': (m,)}
+  """
+  return network_edges_from_segments(network_segments_from_geodataframe(gdf))
+
+def network_segments_from_geodataframe(gdf):
+  """
+  The NetworkSegments of the rows of gdf, a network is identified by them whatever chunks it is read in
+  """
+  geoms = np.asarray(gdf['geom'].values, dtype=object)
+  type_ids = shapely.get_type_id(geoms)
+  unexpected = ~np.isin(type_ids, [shapely.GeometryType.LINESTRING, shapely.GeometryType.MULTILINESTRING])
+  if unexpected.any():
+    raise TypeError(f"Unexpected geometry type: {type(geoms[np.argmax(unexpected)])}")
+
+  lines, row_of_line = shapely.get_parts(geoms, return_index=True)
+  coords, line_of_coord = shapely.get_coordinates(lines, return_index=True)
+
+  # A segment connects two consecutive coordinates of the same line
+  segment_starts = np.flatnonzero(line_of_coord[:-1] == line_of_coord[1:]).astype(np.int64)
+  segment_lengths = np.hypot(*(coords[segment_starts + 1] - coords[segment_starts]).T)
+
+  edge_rows = row_of_line[line_of_coord[segment_starts]]
+  row_lengths = np.bincount(edge_rows, weights=segment_lengths, minlength=len(gdf))[edge_rows]
+  row_segments = np.bincount(edge_rows, minlength=len(gdf))[edge_rows]
+  shares = np.where(
+    row_lengths > 0,
+    np.divide(segment_lengths, row_lengths, out=np.zeros_like(segment_lengths), where=row_lengths > 0),
+    1 / row_segments,
+  )
+
+  edge_weights = {
+    'length': gdf['meters'].to_numpy(dtype=np.float64)[edge_rows] * shares,
+    'time': gdf['minutes'].to_numpy(dtype=np.float64)[edge_rows] * shares,
+  }
+
+  return NetworkSegments(coords, segment_starts, edge_weights)
+
+def network_segments_from_chunks(gdf_chunks):
+  """
+  Joins the network_segments_from_geodataframe of every chunk, they are the same as the ones of all the rows in a single frame
+
+  >>> import geopandas as gpd
+  >>> from pipeline import data_hash
+  >>> gdf = gpd.GeoDataFrame({'meters': [1.0, 2.0, 2.0], 'minutes': [1.0, 2.0, 2.0], 'geom': [LineString([(0, 0), (1, 0)]), LineString([(1, 0), (1, 2)]), LineString([(1, 2), (3, 2)])]}, geometry='geom')
+  >>> data_hash(network_segments_from_chunks([gdf.iloc[:1], gdf.iloc[1:]])) == data_hash(network_segments_from_geodataframe(gdf))
+  True
+  """
+  all_coords, all_segment_starts, all_edge_weights = [], [], []
+  coords_count = 0
+  for coords, segment_starts, edge_weights in map(network_segments_from_geodataframe, gdf_chunks):
+    all_coords.append(coords)
+    all_segment_starts.append(segment_starts + coords_count)
+    all_edge_weights.append(edge_weights)
+    coords_count += coords.shape[0]
+
+  edge_weights = {weight_type: np.concatenate([weights[weight_type] for weights in all_edge_weights]) for weight_type in ('length', 'time')}
+  return NetworkSegments(np.concatenate(all_coords).reshape(-1, 2), np.concatenate(all_segment_starts).astype(np.int64), edge_weights)
+
+def network_edges_from_segments(segments):
+  """
+  Interns the coordinates into integer ids in order of first appearance and connects the segments
+  """
+  coords, segment_starts, edge_weights = segments
+  unique_coords, first_seen, inverse = np.unique(coords, axis=0, return_index=True, return_inverse=True)
+  order = np.argsort(first_seen, kind='stable')
+  node_of_unique = np.empty_like(order)
+  node_of_unique[order] = np.arange(order.shape[0])
+  node_coords = unique_coords[order]
+  node_of_coord = node_of_unique[inverse.reshape(-1)]
+
+  edge_nodes = np.column_stack([node_of_coord[segment_starts], node_of_coord[segment_starts + 1]])
+
+  return node_coords, edge_nodes, edge_weights
 
-def read_network_from_file(path_to_graph):
-  return nx.read_gml(path_to_graph)
+def is_csr_network(network):
+  return isinstance(network, CSRNetwork)
+
+def write_network(path, network, snapped_nodes = None):
+  """
+  Stores the network in a binary, memory mappable format (see network_cache), an nx.Graph is stored as its CSR arrays.
+  snapped_nodes: dict name -> gdf with snapped_to_node, stored next to the network with the points they were snapped from
+  """
+  snapped_points = {name: snapped_from(gdf) for name, gdf in (snapped_nodes or {}).items()}
+  snapped_nodes = {name: (gdf['id'].to_numpy(), list(gdf['snapped_to_node'])) for name, gdf in (snapped_nodes or {}).items()}
+  if not is_csr_network(network):
+    network, node_ids = csr_network_from_graph(network)
+    snapped_nodes = {name: (ids, [node_ids[node] for node in nodes]) for name, (ids, nodes) in snapped_nodes.items()}
+
+  save_network(path, network, snapped_nodes, snapped_points)
+
+def snapped_from(gdf):
+  """
+  The coordinates of the points the geometries of gdf are snapped from, a feature that moves without changing them snaps to the same node
+  """
+  return shapely.get_coordinates(snap_points(gdf['geom'].values)).reshape(-1, 2)
+
+def stale_snapped_features(network_cache, snapped_nodes, gdfs):
+  """
+  The names of the gdfs whose features are not the ones snapped in network_cache, or moved since
+  snapped_nodes: as read with the network from network_cache
+  """
+  snapped_points = load_snapped_points(network_cache)
+  return [
+    name for name, gdf in gdfs.items()
+    if name not in snapped_nodes or name not in snapped_points
+    or not np.array_equal(snapped_nodes[name][0], gdf['id'].to_numpy())
+    or not np.array_equal(snapped_points[name], snapped_from(gdf))
+  ]
+
+def read_network_from_file(path_to_graph, backend = 'csr'):
+  """
+  Opens a network stored with write_network.
+  Returns the network and a dict name -> (feature ids, snapped nodes)
+  """
+  network, snapped_nodes = load_network(path_to_graph)
+  if backend == 'csr':
+    return network, snapped_nodes
+
+  nodes = [tuple(coord) for coord in network.node_coords.tolist()]
+  snapped_nodes = {name: (ids, [nodes[node] for node in snapped]) for name, (ids, snapped) in snapped_nodes.items()}
+
+  return graph_from_csr_network(network), snapped_nodes
+
+def cached_network(network_cache, load_segments, backend = 'networkx'):
+  """
+  Reads the network from network_cache, or builds it from load_segments() and stores it there
+  load_segments: callable returning the NetworkSegments of the pedestrian network, only called on a cache miss
+  """
+  if is_cached(network_cache):
+    network, _snapped_nodes = read_network_from_file(network_cache, backend = backend)
+    return network
+
+  return build_network_from_segments(load_segments(), save_as = network_cache, backend = backend)
 
 def find_nearest_node(G, point):
   """
   Returns a node id in the graph structure
   """
+  if is_csr_network(G):
+    return int(np.argmin(np.hypot(G.node_coords[:, 0] - point.x, G.node_coords[:, 1] - point.y)))
   return min(G.nodes(data=True), key=lambda x: Point(x[1]['pos']).distance(point))[0]
 
 def node_to_point(G, node_id):
   """
   Transforms a node id in the graph to a Point(x, y) object
   """
+  if is_csr_network(G):
+    if is_virtual_node(node_id):
+      edge, fraction = node_id
+      start, end = G.node_coords[G.edge_nodes[edge]]
+      return Point(start + fraction * (end - start))
+    if 0 <= node_id < G.node_coords.shape[0]:
+      return Point(G.node_coords[node_id])
+    raise ValueError(f"Node {node_id} does not exist in the graph.")
   if G.has_node(node_id):
     return Point(G.nodes[node_id]['pos'])
   else:
@@ -69,6 +230,9 @@ def shortest_path(G, start_point, end_point, weight='time'):
   return path, total_cost
 
 def compute_accessibility_boundary_points(network, source_node, weight_type, max_weight):
+  if is_csr_network(network):
+    return compute_csr_accessibility_boundary_points(network, source_node, weight_type, max_weight)
+
   # Find all nodes within the max_weight distance and the cost to get to them
   lengths = nx.single_source_dijkstra_path_length(network, source_node, cutoff = max_weight, weight = weight_type)
   reachable_nodes = lengths.keys()
@@ -83,27 +247,85 @@ def compute_accessibility_boundary_points(network, source_node, weight_type, max
   
   return boundary_points, LineString(boundary_points)
 
-def compute_accessibility_isochron(network, source_node, weight_type, max_weight):
+def compute_csr_accessibility_boundary_points(network, source_node, weight_type, max_weight):
+  reachable_nodes, _costs = bounded_dijkstra(network, source_node, weight_type, max_weight)
+  reachable = np.zeros(network.node_coords.shape[0], dtype=bool)
+  reachable[reachable_nodes] = True
+
+  # A reachable node is on the boundary when at least one of its neighbours is not reachable
+  slot_owner, slots = neighbour_slots(network, reachable_nodes)
+  escapes = np.zeros(reachable_nodes.shape[0], dtype=bool)
+  escapes[slot_owner[~reachable[network.indices[slots]]]] = True
+
+  boundary_points = reachable_nodes[escapes].tolist()
+
+  return boundary_points, LineString(network.node_coords[boundary_points])
+
+def convex_hull(coords, vertices_only = False):
+  """
+  Convex hull of an (n, 2) coordinate array, without creating a Point per coordinate.
+  vertices_only: return the (k, 2) hull vertices (a closed ring for a polygon) instead of the geometry
+
+  >>> convex_hull(np.array([[0, 0], [2, 0], [1, 1], [2, 2], [0, 2]])).area
+  4.0
+  >>> convex_hull(np.array([[0, 0], [2, 0], [1, 1], [2, 2], [0, 2]]), vertices_only = True).tolist()
+  [[0.0, 0.0], [0.0, 2.0], [2.0, 2.0], [2.0, 0.0], [0.0, 0.0]]
+  """
+  hull = shapely.convex_hull(shapely.multipoints(np.asarray(coords, dtype=np.float64).reshape(-1, 2)))
+  if vertices_only:
+    return shapely.get_coordinates(hull)
+  return hull
+
+def compute_accessibility_isochron(network, source_node, weight_type, max_weight, vertices_only = False):
   """
   weight_type: string - The name of the edge metric to be used
   max_weight: number - Value in the metric system of the "weight" to stop traversing the graph further when reached
+  vertices_only: return only the coordinates of the hull vertices, see convex_hull
   """
+  if is_csr_network(network):
+    reachable_nodes, _costs = bounded_dijkstra(network, source_node, weight_type, max_weight)
+    return convex_hull(network.node_coords[reachable_nodes], vertices_only)
+
   # Find all nodes within the max_weight distance and the cost to get to them
   lengths = nx.single_source_dijkstra_path_length(network, source_node, cutoff = max_weight, weight = weight_type)
 
-  points_within_distance = [Point(network.nodes[node]['pos']) for node in lengths.keys()]
-  multi_point = MultiPoint(points_within_distance)
+  return convex_hull([network.nodes[node]['pos'] for node in lengths], vertices_only)
+
+def build_locations_tree(geoms):
+  """
+  STRtree over a layer of locations, built once and queried with locations_within_isochron for every isochron
+  """
+  return shapely.STRtree(np.asarray(geoms, dtype=object))
 
-  return multi_point.convex_hull
+def locations_within_isochron(locations_tree, isochron):
+  """
+  Returns the sorted tree positions of the locations within the isochron.
+  A MultiPolygon contains the locations within any of its parts
 
-def filter_nodes_within_accessibility_isochron(network, accessibility_isochron):
-  filtered_nodes = []
-  for node in network.nodes:
-    point = Point(network.nodes[node]['pos'])
-    if point.within(accessibility_isochron):
-      filtered_nodes.append(node)
+  >>> tree = build_locations_tree([Point(1, 1), Point(5, 5), Point(2, 1)])
+  >>> locations_within_isochron(tree, shapely.box(0, 0, 3, 3)).tolist()
+  [0, 2]
+  """
+  parts = shapely.get_parts(isochron)
+  shapely.prepare(parts)
+  _parts, positions = locations_tree.query(parts, predicate='contains')
 
-  return filtered_nodes
+  return np.unique(positions)
+
+def filter_nodes_within_accessibility_isochron(network, accessibility_isochron, nodes_tree = None):
+  """
+  nodes_tree: build_locations_tree of the node points, pass it when filtering the same network with many isochrons
+  """
+  if is_csr_network(network):
+    nodes = np.arange(network.node_coords.shape[0])
+    node_coords = network.node_coords
+  else:
+    nodes = list(network.nodes)
+    node_coords = np.array([network.nodes[node]['pos'] for node in nodes], dtype=np.float64).reshape(-1, 2)
+  if nodes_tree is None:
+    nodes_tree = build_locations_tree(shapely.points(node_coords))
+
+  return [nodes[position] for position in locations_within_isochron(nodes_tree, accessibility_isochron)]
 
 def find_nearest_edge(network, point):
   nearest_edge = None
@@ -149,14 +371,82 @@ def snap_point_to_edge(network, point, length_attr='length', time_attr='time', a
 
   return new_node
 
-def extend_network_with(network, gdf):
-  approximated_nodes = []
-  for idx, row in tqdm(gdf.iterrows(), total=gdf.shape[0], desc="Adding nodes"):
-    new_node = snap_point_to_edge(network, row.geom, add_to_network=True)
-    approximated_nodes.append(new_node)
+def split_edges_at(network, snapping_index, edge_positions, projected, offsets, length_attr='length', time_attr='time'):
+  """
+  Batch version of snap_point_to_edge(add_to_network=True). Every indexed edge is split once into a chain
+  through all the points projected on it, ordered by their offset from the start of the edge.
+  Returns the new node for every projected point
+  """
+  new_nodes = [(float(x), float(y)) for x, y in projected.tolist()]
+
+  order = np.lexsort((offsets, edge_positions))
+  split_edges, first = np.unique(edge_positions[order], return_index=True)
+  for edge_position, points_on_edge in zip(split_edges.tolist(), np.split(order, first[1:])):
+    u, v = snapping_index.edge_nodes[edge_position]
+    data = network.edges[u, v]
+    original_length = data[length_attr]
+    original_time = data[time_attr]
+
+    points = list(dict.fromkeys(new_nodes[i] for i in points_on_edge))
+    chain = [u] + points + [v]
+    chain_coords = np.array([network.nodes[u]['pos']] + points + [network.nodes[v]['pos']], dtype=np.float64)
+    lengths = np.hypot(*np.diff(chain_coords, axis=0).T)
+
+    network.remove_edge(u, v)
+    for node in points:
+      if node not in network:
+        network.add_node(node, pos=node)
+
+    for a, b, length in zip(chain, chain[1:], lengths):
+      time = original_time * (length / original_length) if original_length != 0 else original_time / (len(chain) - 1)
+      network.add_edge(a, b, **{length_attr: float(length), time_attr: time})
+
+  return new_nodes
+
+def virtual_nodes(edge_positions, fractions):
+  return list(zip(edge_positions.tolist(), fractions.tolist()))
+
+def extend_network_with(network, gdf, snapping_index = None):
+  """
+  Snaps every geometry in gdf to its nearest edge and stores the result in gdf["snapped_to_node"].
+  An nx.Graph gets its edges split at the snapped points.
+  A CSRNetwork is left untouched, the snapped points are stored as virtual nodes (edge id, fraction),
+  so the result does not depend on the order the points are added in and the network can be shared.
+  snapping_index: SnappingIndex - reuse an index of the network in its current state, built when not given
+  """
+  gdf["snapped_to_node"] = snap_to_network(network, gdf.geom, 'edge', snapping_index)
+
+def extend_network_with_chunks(network, gdf_chunks):
+  """
+  extend_network_with every chunk (e.g. the POIs and buildings, or the chunks of database.gdf_chunks_from_sql) and yields it
+  with its snapped_to_node. The snapping index of a CSRNetwork is built once, an nx.Graph changes with every chunk and gets a new one
+  """
+  snapping_index = build_snapping_index(network) if is_csr_network(network) else None
+  for gdf in gdf_chunks:
+    extend_network_with(network, gdf, snapping_index)
+    yield gdf
+
+def snap_to_network(network, geoms, snap_to = 'edge', snapping_index = None):
+  """
+  Returns the node every geometry is approximated with
+  snap_to: 'node'|'edge' - 'edge' splits the nearest edges of an nx.Graph at the snapped points
+    and returns virtual nodes for a CSRNetwork
+  """
+  snapping_index = snapping_index or build_snapping_index(network)
+  if snap_to == 'edge':
+    if is_csr_network(network):
+      return virtual_nodes(*snap_to_edges(snapping_index, geoms))
+    edge_positions, projected, offsets = project_to_nearest_edges(snapping_index, geoms)
+    return split_edges_at(network, snapping_index, edge_positions, projected, offsets)
+  elif snap_to == 'node':
+    nodes = nearest_nodes(snapping_index, geoms)
+    return nodes.tolist() if isinstance(nodes, np.ndarray) else nodes
 
-  gdf["snapped_to_node"] = approximated_nodes
+  raise ValueError("snap_to = 'node'|'edge'")
 
 def nearby_nodes(network, source_node, weight_type, max_weight):
+  if is_csr_network(network):
+    reachable_nodes, _costs = bounded_dijkstra(network, source_node, weight_type, max_weight)
+    return set(reachable_nodes.tolist())
   lengths = nx.single_source_dijkstra_path_length(network, source_node, cutoff = max_weight, weight = weight_type)
   return lengths.keys()
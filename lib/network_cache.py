@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+from csr_network import node_arrays, nodes_from_arrays, network_array_names, network_arrays, network_from_arrays
+
+NETWORK_CACHE_DIR = "lib/saves/networks"
+FORMAT_VERSION = 2
+MANIFEST = 'manifest.json'
+
+# A cached network is a directory with one .npy file per array, opened with mmap so loading costs milliseconds.
+# The manifest is written last and lists the weight types and the snapped nodes stored next to the network.
+# Every snapped feature is stored with its id, its node and the point it was snapped from, a feature that moved is snapped again.
+
+def cache_key(*parts):
+  """
+  A short hash of the source query and the parameters the network was built with
+
+  >>> cache_key('select * from pedestrian_network', {'backend': 'csr'}) == cache_key('select * from pedestrian_network', {'backend': 'csr'})
+  True
+  >>> cache_key('select * from pedestrian_network', {'backend': 'csr'}) == cache_key('select * from pedestrian_network', {'backend': 'networkx'})
+  False
+  """
+  payload = json.dumps([FORMAT_VERSION, *parts], sort_keys=True, default=str)
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def cache_path(cache_dir, *parts):
+  return os.path.join(cache_dir, cache_key(*parts))
+
+def is_cached(path):
+  return os.path.exists(os.path.join(path, MANIFEST))
+
+def save_arrays(path, arrays, manifest):
+  """
+  Writes one .npy file per array and the manifest last, in a directory next to path that is moved in place,
+  readers never see a partial directory
+  """
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  shutil.rmtree(tmp_path, ignore_errors=True)
+  os.makedirs(tmp_path)
+  for name, array in arrays.items():
+    np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+
+  with open(os.path.join(tmp_path, MANIFEST), 'w') as manifest_file:
+    json.dump({'version': FORMAT_VERSION, **manifest}, manifest_file)
+
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  os.replace(tmp_path, path)
+
+def load_manifest(path):
+  with open(os.path.join(path, MANIFEST)) as manifest_file:
+    manifest = json.load(manifest_file)
+  if manifest['version'] != FORMAT_VERSION:
+    raise ValueError(f"{path} is stored in version {manifest['version']}, expected {FORMAT_VERSION}")
+
+  return manifest
+
+def load_array(path, name):
+  return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+
+def save_network(path, network, snapped_nodes = None, snapped_points = None):
+  """
+  snapped_nodes: dict name -> (feature ids, snapped nodes) - node ids or virtual nodes of the features snapped to the network
+  snapped_points: dict name -> (k, 2) coordinates of the points the features were snapped from
+  Anything else cached inside path (like the reach tables of the network) is removed with the old network
+  """
+  arrays = network_arrays(network)
+  snapped_nodes = snapped_nodes or {}
+  for name, (ids, nodes) in snapped_nodes.items():
+    arrays[f'snapped.{name}.ids'] = np.asarray(ids)
+    arrays[f'snapped.{name}.nodes'], arrays[f'snapped.{name}.fractions'] = node_arrays(nodes)
+  for name, points in (snapped_points or {}).items():
+    arrays[f'snapped.{name}.points'] = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+  save_arrays(path, arrays, {'weight_types': list(network.weights), 'snapped': list(snapped_nodes)})
+
+def load_network(path):
+  """
+  Returns the CSRNetwork, its arrays memory mapped read only, and the snapped nodes dict name -> (feature ids, snapped nodes)
+  """
+  manifest = load_manifest(path)
+
+  def array(name):
+    return load_array(path, name)
+
+  network = network_from_arrays({name: array(name) for name in network_array_names(manifest['weight_types'])})
+  snapped_nodes = {
+    name: (array(f'snapped.{name}.ids'), nodes_from_arrays(array(f'snapped.{name}.nodes'), array(f'snapped.{name}.fractions')))
+    for name in manifest['snapped']
+  }
+
+  return network, snapped_nodes
+
+def load_snapped_points(path):
+  """
+  The dict name -> coordinates of the points the features of the network at path were snapped from
+  """
+  manifest = load_manifest(path)
+  return {name: load_array(path, f'snapped.{name}.points') for name in manifest['snapped'] if os.path.exists(os.path.join(path, f'snapped.{name}.points.npy'))}
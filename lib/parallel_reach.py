@@ -0,0 +1,101 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from tqdm import tqdm # progressbar
+
+from csr_network import reached_nodes, node_arrays, network_arrays, network_from_arrays
+from feature_index import FeatureIndex, reachable_rows
+
+# Set in every worker by attach_worker, the network and the locations are views over shared memory
+_worker = {}
+
+def share_arrays(arrays):
+  """
+  Copies every array into its own shared memory block.
+  Returns the blocks (the caller closes and unlinks them) and the specs to attach to them by name
+  """
+  blocks = []
+  specs = {}
+  for name, array in arrays.items():
+    array = np.ascontiguousarray(array)
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    specs[name] = (block.name, array.shape, array.dtype.str)
+
+  return blocks, specs
+
+def attach_arrays(specs):
+  blocks = []
+  arrays = {}
+  for name, (block_name, shape, dtype) in specs.items():
+    # The pool workers share the resource tracker of the parent, which unlinks the blocks
+    block = SharedMemory(name=block_name)
+    blocks.append(block)
+    arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+  return blocks, arrays
+
+def source_node(nodes, fractions, position):
+  if np.isnan(fractions[position]):
+    return int(nodes[position])
+  return (int(nodes[position]), float(fractions[position]))
+
+def reached_targets(network, source, targets, weight_type, max_weight):
+  """
+  targets: FeatureIndex of the locations
+  Returns the positions of the targets within max_weight from source and the cost to get to them
+  """
+  reach = reached_nodes(network, source, weight_type, max_weight)
+  return reachable_rows(network, targets, source, reach, weight_type, max_weight, return_costs = True)
+
+def attach_worker(specs, weight_type, max_weight):
+  blocks, arrays = attach_arrays(specs)
+  _worker['blocks'] = blocks
+  _worker['network'] = network_from_arrays({name: array for name, array in arrays.items() if not name.startswith(('source.', 'target.'))})
+  _worker['sources'] = (arrays['source.nodes'], arrays['source.fractions'])
+  _worker['targets'] = FeatureIndex(*(arrays[f'target.{field}'] for field in FeatureIndex._fields))
+  _worker['weight_type'] = weight_type
+  _worker['max_weight'] = max_weight
+
+def reach_chunk(positions):
+  nodes, fractions = _worker['sources']
+  return [
+    reached_targets(_worker['network'], source_node(nodes, fractions, position), _worker['targets'], _worker['weight_type'], _worker['max_weight'])
+    for position in positions
+  ]
+
+def parallel_reach(network, sources, targets, weight_type = 'length', max_weight = 1000, workers = None, chunk_size = 64):
+  """
+  Runs the bounded search from every source on a process pool and returns, for every source,
+  the positions of the targets within reach and their costs - the same as calling reached_targets for every source.
+  The workers map the network arrays, the sources and the targets from shared memory instead of receiving a pickled copy.
+
+  network: CSRNetwork
+  sources: list of node ids or virtual nodes
+  targets: FeatureIndex of the locations
+  workers: number of processes, defaults to the number of CPUs
+  """
+  sources = list(sources)
+  workers = workers or os.cpu_count()
+  if workers <= 1 or len(sources) <= chunk_size:
+    return [reached_targets(network, source, targets, weight_type, max_weight) for source in tqdm(sources, desc="Processing sources")]
+
+  source_nodes, source_fractions = node_arrays(sources)
+  arrays = network_arrays(network)
+  arrays['source.nodes'] = source_nodes
+  arrays['source.fractions'] = source_fractions
+  for field, array in targets._asdict().items():
+    arrays[f'target.{field}'] = array
+
+  blocks, specs = share_arrays(arrays)
+  try:
+    chunks = [range(start, min(start + chunk_size, len(sources))) for start in range(0, len(sources), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=attach_worker, initargs=(specs, weight_type, max_weight)) as executor:
+      chunks_reached = tqdm(executor.map(reach_chunk, chunks), total=len(chunks), desc=f"Processing sources on {workers} workers")
+      return [reached for chunk in chunks_reached for reached in chunk]
+  finally:
+    for block in blocks:
+      block.close()
+      block.unlink()
@@ -0,0 +1,154 @@
+import json
+import os
+import shutil
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from database import gdf_from_sql
+
+# An offline copy of the database: a directory with a GeoParquet dataset per table, <data_dir>/<table_name>.parquet/part-*.parquet.
+# Geometries are stored as WKB columns and decoded a whole column at a time, the files are memory mapped when read.
+# Input tables are exported from the database with export_queries, results tables are written with write_table.
+
+def table_path(data_dir, table_name):
+  return os.path.join(data_dir, f"{table_name}.parquet")
+
+def has_table(data_dir, table_name):
+  return os.path.isdir(table_path(data_dir, table_name))
+
+def table_parts(data_dir, table_name):
+  path = table_path(data_dir, table_name)
+  return sorted(os.path.join(path, part) for part in os.listdir(path) if part.endswith('.parquet'))
+
+def geo_metadata(part):
+  """
+  The GeoParquet metadata of a part, None for a part without geometries
+  """
+  import pyarrow.parquet as pq
+  metadata = pq.read_schema(part).metadata or {}
+  return json.loads(metadata[b'geo']) if b'geo' in metadata else None
+
+def is_geo_part(part):
+  return geo_metadata(part) is not None
+
+def has_bbox_covering(part):
+  """
+  The part stores the bounding box of every geometry, the rows it has to read for a bbox are found without decoding the geometries
+  """
+  metadata = geo_metadata(part)
+  return metadata is not None and 'covering' in metadata['columns'][metadata['primary_column']]
+
+def read_table(data_dir, table_name, columns = None, bbox = None):
+  """
+  The table as a GeoDataFrame, or a DataFrame for tables without geometries (like the access weights)
+  bbox: (xmin, ymin, xmax, ymax) - only read the rows whose geometry bounding box intersects it.
+    A part written without the bounding boxes (see write_table) is read whole
+  """
+  parts = table_parts(data_dir, table_name)
+  if not parts:
+    raise ValueError(f"{table_path(data_dir, table_name)} has no parts")
+  if not is_geo_part(parts[0]):
+    return pd.concat([pd.read_parquet(part, columns=columns, memory_map=True) for part in parts], ignore_index=True)
+
+  return pd.concat([
+    gpd.read_parquet(part, columns=columns, bbox=bbox if bbox is not None and has_bbox_covering(part) else None, memory_map=True)
+    for part in parts
+  ], ignore_index=True)
+
+def read_table_within(data_dir, table_name, bounds):
+  """
+  The rows whose geometry intersects bounds, like st_intersects with an envelope
+  """
+  gdf = read_table(data_dir, table_name, bbox=bounds)
+  return gdf[gdf.intersects(shapely.box(*bounds))].reset_index(drop=True)
+
+def read_table_in(data_dir, table_name, area, predicate = 'intersects'):
+  """
+  The rows whose geometry is in relation predicate ('intersects'|'within') to the geometry area, like a spatial join with a region
+  """
+  if predicate not in ('intersects', 'within'):
+    raise ValueError("predicate = 'intersects'|'within'")
+
+  gdf = read_table(data_dir, table_name, bbox=area.bounds)
+  return gdf[getattr(gdf, predicate)(area)].reset_index(drop=True)
+
+def geometry_frame(df):
+  """
+  df with every column of shapely geometries (like an isochron polygon) as a geometry column, so it is stored as WKB
+  """
+  df = df.copy()
+  for column in df.columns:
+    if df[column].dtype == object and df[column].map(lambda value: isinstance(value, shapely.Geometry)).any():
+      df[column] = gpd.GeoSeries(df[column], crs=getattr(df, 'crs', None))
+
+  return df
+
+def write_table(data_dir, table_name, df, if_exists = 'replace'):
+  """
+  if_exists: 'replace'|'append' - 'replace' writes a new dataset that is moved in place of the old one,
+    'append' adds a part to the dataset (a tiled run streams its results into one table)
+
+  >>> import tempfile
+  >>> data_dir = tempfile.mkdtemp()
+  >>> gdf = gpd.GeoDataFrame({'id': [1, 2], 'geom': [shapely.Point(0, 0), shapely.Point(5, 5)]}, geometry='geom', crs=7801)
+  >>> write_table(data_dir, 'buildings', gdf) # doctest: +ELLIPSIS
+  Table ... created
+  >>> write_table(data_dir, 'buildings', gdf.assign(id=[3, 4], geom=[shapely.Point(10, 10), shapely.Point(2, 0)]), 'append') # doctest: +ELLIPSIS
+  Table ... appended to
+  >>> buildings = read_table(data_dir, 'buildings')
+  >>> buildings.id.tolist(), buildings.geom.tolist(), buildings.crs.to_epsg()
+  ([1, 2, 3, 4], [<POINT (0 0)>, <POINT (5 5)>, <POINT (10 10)>, <POINT (2 0)>], 7801)
+  >>> read_table_within(data_dir, 'buildings', (0, 0, 5, 5)).id.tolist()
+  [1, 2, 4]
+  >>> read_table_in(data_dir, 'buildings', shapely.box(0, 0, 5, 5), 'within').id.tolist()
+  []
+  >>> write_table(data_dir, 'weights', pd.DataFrame({'subgroup_id': ['parks'], 'gr_weights': [0.5]})) # doctest: +ELLIPSIS
+  Table ... created
+  >>> read_table(data_dir, 'weights')
+    subgroup_id  gr_weights
+  0       parks         0.5
+  """
+  if if_exists not in ('replace', 'append'):
+    raise ValueError("if_exists = 'replace'|'append'")
+
+  df = geometry_frame(df)
+  # The bounding box of every geometry is stored next to it, a bbox read filters on it without decoding the geometries
+  options = {'write_covering_bbox': True} if isinstance(df, gpd.GeoDataFrame) else {}
+  path = table_path(data_dir, table_name)
+  if if_exists == 'append' and os.path.isdir(path):
+    part = os.path.join(path, f"part-{len(table_parts(data_dir, table_name)):05d}.parquet")
+    tmp_part = f"{part}.tmp{os.getpid()}"
+    df.to_parquet(tmp_part, index=False, **options)
+    os.replace(tmp_part, part)
+  else:
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    df.to_parquet(os.path.join(tmp_path, "part-00000.parquet"), index=False, **options)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+  print(f"Table {path} {'created' if if_exists == 'replace' else 'appended to'}")
+
+def swap_table(data_dir, staging_name, table_name):
+  """
+  Moves the dataset of staging_name in place of table_name, a result streamed in parts (the tiles of a tiled run)
+  is written to the staging dataset and readers see the old table until all parts are in
+  """
+  path = table_path(data_dir, table_name)
+  shutil.rmtree(path, ignore_errors=True)
+  os.replace(table_path(data_dir, staging_name), path)
+
+  print(f"Table {path} swapped in")
+
+def export_queries(database, data_dir, queries):
+  """
+  Writes the result of every query of the database to data_dir, to run offline from it.
+  queries: dict table_name -> query, the queries returning no geometry (like the access weights) are read with pandas
+  """
+  with database.connect() as db_connection:
+    for table_name, query in queries.items():
+      columns = list(db_connection.exec_driver_sql(f"select * from ({query}) query limit 0").keys())
+      df = gdf_from_sql(db_connection, query) if 'geom' in columns else pd.read_sql_query(query, con=db_connection)
+      write_table(data_dir, table_name, df)
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import shutil
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from tqdm import tqdm # progressbar
+
+PIPELINE_CACHE_DIR = "lib/saves/stages"
+CHECKPOINT_CHUNK_SIZE = 1000
+
+# The stages of main.py are cached by the content of their inputs - frames, arrays and parameters - not by their names.
+# cached_stage keeps the output of a stage per hash of its inputs, changed_stage remembers the hash of the inputs
+# a side effect (like writing a results table) last ran with and skips it while they stay the same.
+# A long stage can checkpoint its work in chunks (checkpointed_chunks), a rerun after a crash resumes after the last finished chunk.
+
+def is_geometry_series(series):
+  return isinstance(series.dtype, gpd.array.GeometryDtype) or (series.dtype == object and series.map(lambda value: isinstance(value, shapely.Geometry)).any())
+
+def update_hash(digest, value):
+  if isinstance(value, pd.DataFrame):
+    digest.update(repr((type(value).__name__, value.shape, [str(column) for column in value.columns])).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(value.index).to_numpy().tobytes())
+    for column in value.columns:
+      update_hash(digest, value[column].reset_index(drop=True))
+  elif isinstance(value, pd.Series):
+    digest.update(repr(('Series', str(value.dtype), value.shape[0])).encode('utf-8'))
+    if is_geometry_series(value):
+      geoms = np.array([geom if isinstance(geom, shapely.Geometry) else None for geom in value], dtype=object)
+      wkbs = shapely.to_wkb(geoms, include_srid=True)
+      digest.update(np.array([len(wkb) if wkb is not None else -1 for wkb in wkbs], dtype=np.int64).tobytes())
+      digest.update(b''.join(wkb for wkb in wkbs if wkb is not None))
+    else:
+      try:
+        digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+      except TypeError:
+        # Unhashable values, like lists, are hashed by their text
+        digest.update(pd.util.hash_pandas_object(value.astype(str), index=False).to_numpy().tobytes())
+  elif isinstance(value, np.ndarray):
+    digest.update(repr(('ndarray', value.dtype.str, value.shape)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(value).tobytes())
+  elif isinstance(value, dict):
+    digest.update(b'dict')
+    for key in sorted(value, key=repr):
+      update_hash(digest, key)
+      update_hash(digest, value[key])
+  elif isinstance(value, (list, tuple)):
+    digest.update(repr((type(value).__name__, len(value))).encode('utf-8'))
+    for item in value:
+      update_hash(digest, item)
+  else:
+    digest.update(repr((type(value).__name__, value)).encode('utf-8'))
+
+def data_hash(*values):
+  """
+  A short hash of the content of the values
+
+  >>> df = pd.DataFrame({'id': [1, 2], 'subgroup': ['parks', 'schools']})
+  >>> data_hash(df, {'max_weight': 1000}) == data_hash(df.copy(), {'max_weight': 1000})
+  True
+  >>> data_hash(df, {'max_weight': 1000}) == data_hash(df.assign(id=[1, 3]), {'max_weight': 1000})
+  False
+  >>> data_hash(gpd.GeoSeries([shapely.Point(0, 0)])) == data_hash(gpd.GeoSeries([shapely.Point(0, 1)]))
+  False
+  """
+  digest = hashlib.sha256()
+  for value in values:
+    update_hash(digest, value)
+
+  return digest.hexdigest()[:16]
+
+def write_atomically(path, write):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  tmp_path = f"{path}.tmp{os.getpid()}"
+  write(tmp_path)
+  os.replace(tmp_path, path)
+
+def cached_stage(cache_dir, name, inputs, compute, checkpoint = False):
+  """
+  The output of compute, cached by the hash of name and inputs.
+  cache_dir: directory of the stage outputs, None to always compute
+  inputs: list of everything the output depends on - frames, the data_hash of a network, parameters
+  checkpoint: compute is called with the checkpoint directory of the stage (None without cache_dir),
+    kept until the output is cached, a rerun with the same inputs resumes from it
+  """
+  if not cache_dir:
+    return compute(None) if checkpoint else compute()
+
+  key = data_hash(name, inputs)
+  path = os.path.join(cache_dir, 'outputs', name, f"{key}.pkl")
+  if os.path.exists(path):
+    print(f"Reusing {name}")
+    return pd.read_pickle(path)
+
+  checkpoint_path = os.path.join(cache_dir, 'checkpoints', name, key)
+  output = compute(checkpoint_path) if checkpoint else compute()
+  write_atomically(path, lambda tmp_path: pd.to_pickle(output, tmp_path))
+  shutil.rmtree(checkpoint_path, ignore_errors=True)
+  return output
+
+def checkpointed_chunks(checkpoint, total, compute_chunk, chunk_size = CHECKPOINT_CHUNK_SIZE, desc = None):
+  """
+  The results of compute_chunk(start, stop) for every chunk of range(total), in order.
+  checkpoint: directory every finished chunk is written to, None to keep nothing.
+    The chunks already in it are loaded instead of computed, a rerun resumes after the last finished chunk
+  """
+  chunks = [(start, min(start + chunk_size, total)) for start in range(0, total, chunk_size)]
+  results = []
+  with tqdm(total=total, desc=desc) as progress:
+    for start, stop in chunks:
+      path = os.path.join(checkpoint, f"chunk_{start}_{stop}.pkl") if checkpoint else None
+      if path and os.path.exists(path):
+        result = pd.read_pickle(path)
+      else:
+        result = compute_chunk(start, stop)
+        if path:
+          write_atomically(path, lambda tmp_path: pd.to_pickle(result, tmp_path))
+      results.append(result)
+      progress.update(stop - start)
+
+  return results
+
+def changed_stage(cache_dir, name, inputs, run, exists = None):
+  """
+  Calls run unless it already ran for name with the same inputs, returns whether it ran.
+  cache_dir: directory of the stage records, None to always run
+  exists: called before skipping, run is called again when it returns False (like when the table it wrote was dropped)
+  The hash is recorded after run returns, a failed run is retried the next time
+  """
+  if not cache_dir:
+    run()
+    return True
+
+  path = os.path.join(cache_dir, 'changed', name)
+  digest = data_hash(name, inputs)
+  if os.path.exists(path):
+    with open(path) as record:
+      if record.read() == digest and (exists is None or exists()):
+        print(f"Skipping {name}, unchanged")
+        return False
+
+  run()
+
+  def write_record(tmp_path):
+    with open(tmp_path, 'w') as record:
+      record.write(digest)
+
+  write_atomically(path, write_record)
+  return True
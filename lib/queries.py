@@ -28,6 +28,48 @@ BUFFER_LOZENEC_SQL = f"""
   select geom from zvezdi_work.gen_lezenec_buf
 """
 
+ACCESS_WEIGHTS_SQL = f"""
+  select subgroup_id, sgr_weights, gr_weights from zvezdi_work.access_weights
+"""
+
+###### Tiled queries for the whole city #######
+
+CITY_BOUNDS_SQL = f"""
+  select ST_XMin(extent) as xmin, ST_YMin(extent) as ymin, ST_XMax(extent) as xmax, ST_YMax(extent) as ymax
+  from (select ST_Extent(geom) as extent from zvezdi_work.buildings_res_all_2023) buildings
+"""
+
+def envelope(bounds):
+  """
+  >>> envelope((0, 0, 10, 20.5))
+  'ST_MakeEnvelope(0, 0, 10, 20.5, 7801)'
+  """
+  xmin, ymin, xmax, ymax = bounds
+  return f"ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, 7801)"
+
+def city_bounds_query():
+  return CITY_BOUNDS_SQL
+
+def pedestrian_network_tile_query(bounds):
+  return f"""
+    select pn.geom as geom, type, str_class as class, length_m as meters, minutes
+    from zvezdi_work.pedestrian_network pn
+    where st_intersects(pn.geom, {envelope(bounds)})
+  """
+
+def residential_buildings_tile_query(bounds):
+  return f"""
+    select id, geom, floorcount as floors, appcount as appartments from zvezdi_work.buildings_res_all_2023 buildings
+    where st_intersects(buildings.geom, {envelope(bounds)})
+  """
+
+def poi_tile_query(table_name, bounds):
+  return f"""
+    select poi.id, poi.geom, poi.subgroup_i as subgroup
+    from zvezdi_work.{table_name} poi
+    where st_intersects(poi.geom, {envelope(bounds)})
+  """
+
 
 def pedestrian_network_query(scope):
   if scope == "Lozenec":
@@ -48,7 +90,7 @@ def residential_buildings_with_service_level_query(scope, analytics_type = 'abso
     select rrsl.* from zvezdi_work.results_residentials_service_level_{analytics_type} rrsl, zvezdi_work.gen_adm_regions gar 
     where gar.obns_lat = 'LOZENEC' and ST_Contains(gar.geom, rrsl.geom)
     """
-  return "Implement me!"
+  return f"select rrsl.* from zvezdi_work.results_residentials_service_level_{analytics_type} rrsl"
 
 def buffered_region_boundary(scope):
   if scope == "Lozenec":
@@ -61,7 +103,9 @@ def poi_query(table_name, scope):
       from zvezdi_work.{table_name} poi, zvezdi_work.gen_lezenec_buf buffered_lozenec
       where st_intersects(poi.geom, buffered_lozenec.geom)
     """
-  return "Implement me!"
+  return f"""
+    select poi.id, poi.geom, poi.subgroup_i as subgroup from zvezdi_work.{table_name} poi
+  """
 
 def poi_reach_query(table_name, scope, analytics_type = 'absolute'):
   if scope == "Lozenec":
@@ -77,7 +121,30 @@ def poi_reach_query(table_name, scope, analytics_type = 'absolute'):
         from zvezdi_work.results_{table_name}_reach_{analytics_type} poi, zvezdi_work.gen_lezenec_buf buffered_lozenec
         where st_intersects(poi.geom, buffered_lozenec.geom)
       """
-  return "Implement me!"
+  columns = "poi.id, poi.geom, poi.subgroup, poi.buildings_within_reach, poi.appartments_within_reach"
+  if analytics_type != "absolute":
+    columns += ", poi.service_distance_polygon"
+  return f"select {columns} from zvezdi_work.results_{table_name}_reach_{analytics_type} poi"
 
 def administrative_regions_with_service_level_query():
   return "select * from zvezdi_work.results_gen_adm_regions_service_level"
+
+def access_weights_query():
+  return ACCESS_WEIGHTS_SQL
+
+def offline_queries(scope, poi_tables):
+  """
+  The tables main.py and the map scripts read, by the name they get in an offline data directory (see parquet_store)
+
+  >>> sorted(offline_queries('Lozenec', ['poi_parks']))
+  ['access_weights', 'buffered_region', 'ge_2020', 'gen_adm_regions', 'pedestrian_network', 'poi_parks', 'residential_buildings']
+  """
+  return {
+    'pedestrian_network': pedestrian_network_query(scope),
+    'residential_buildings': residential_buildings_query(scope),
+    'access_weights': access_weights_query(),
+    **{poi_table: poi_query(poi_table, scope) for poi_table in poi_tables},
+    'gen_adm_regions': "select id, obns_lat, obns_cyr, geom from zvezdi_work.gen_adm_regions",
+    'ge_2020': "select id, regname, rajon, geom from ge_2020",
+    **({'buffered_region': buffered_region_boundary(scope)} if buffered_region_boundary(scope) else {}),
+  }
@@ -0,0 +1,155 @@
+from collections import namedtuple
+import os
+import numpy as np
+
+from network_cache import cache_key, is_cached, save_arrays, load_manifest, load_array
+
+# Every building - POI pair within the cutoff and the network distance between them, grouped by POI like a CSR matrix.
+# The network is undirected, the same pairs answer both what a POI reaches and what reaches a building.
+#   indptr:    (p + 1,) - the buildings POI i reaches are buildings[indptr[i]:indptr[i + 1]]
+#   buildings: rows of the residentials table, sorted for every POI
+#   distances: the network distance of every pair
+ReachTable = namedtuple('ReachTable', ['indptr', 'buildings', 'distances'])
+
+def reach_table_from_reached(reached):
+  """
+  reached: (building rows, distances) for every POI
+
+  >>> table = reach_table_from_reached([(np.array([0, 2]), np.array([5.0, 7.0])), (np.array([], dtype=np.int64), np.array([]))])
+  >>> table.indptr.tolist(), table.buildings.tolist(), table.distances.tolist()
+  ([0, 2, 2], [0, 2], [5.0, 7.0])
+  """
+  reached = list(reached)
+  indptr = np.zeros(len(reached) + 1, dtype=np.int64)
+  np.cumsum([rows.shape[0] for rows, _distances in reached], out=indptr[1:])
+  buildings = np.concatenate([rows for rows, _distances in reached]).astype(np.int64) if reached else np.array([], dtype=np.int64)
+  distances = np.concatenate([distances for _rows, distances in reached]).astype(np.float64) if reached else np.array([])
+
+  return ReachTable(indptr, buildings, distances)
+
+def reach_table_from_pairs(pois, buildings, distances, pois_count):
+  """
+  Groups the (poi, building, distance) pairs by POI
+
+  >>> table = reach_table_from_pairs(np.array([2, 0, 0]), np.array([1, 2, 0]), np.array([1.0, 7.0, 5.0]), 3)
+  >>> table.indptr.tolist(), table.buildings.tolist(), table.distances.tolist()
+  ([0, 2, 2, 3], [0, 2, 1], [5.0, 7.0, 1.0])
+  """
+  order = np.lexsort((buildings, pois))
+  indptr = np.zeros(pois_count + 1, dtype=np.int64)
+  np.cumsum(np.bincount(pois, minlength=pois_count), out=indptr[1:])
+
+  return ReachTable(indptr, np.asarray(buildings, dtype=np.int64)[order], np.asarray(distances, dtype=np.float64)[order])
+
+def remap_reach_table(reach_table, poi_positions, building_positions):
+  """
+  poi_positions, building_positions: the new position of every POI and building of the table, -1 to drop its pairs
+  Returns the kept pairs at their new positions as (pois, buildings, distances)
+
+  >>> table = ReachTable(np.array([0, 2, 3]), np.array([0, 1, 1]), np.array([5.0, 7.0, 1.0]))
+  >>> [pairs.tolist() for pairs in remap_reach_table(table, np.array([1, 0]), np.array([-1, 0]))]
+  [[1, 0], [0, 0], [7.0, 1.0]]
+  """
+  pois = np.asarray(poi_positions)[pair_pois(reach_table)]
+  buildings = np.asarray(building_positions)[reach_table.buildings]
+  kept = (pois >= 0) & (buildings >= 0)
+
+  return pois[kept], buildings[kept], reach_table.distances[kept]
+
+def pair_pois(reach_table):
+  """
+  The POI of every pair
+
+  >>> pair_pois(ReachTable(np.array([0, 2, 2, 3]), np.array([0, 2, 1]), np.array([5.0, 7.0, 1.0]))).tolist()
+  [0, 0, 2]
+  """
+  return np.repeat(np.arange(reach_table.indptr.shape[0] - 1), np.diff(reach_table.indptr))
+
+def poi_totals(reach_table, appartments):
+  """
+  Returns the number of buildings and the number of appartments every POI reaches
+  """
+  pois_count = reach_table.indptr.shape[0] - 1
+  buildings_within_reach = np.diff(reach_table.indptr)
+  appartments_within_reach = np.bincount(pair_pois(reach_table), weights=np.asarray(appartments)[reach_table.buildings], minlength=pois_count)
+
+  return buildings_within_reach, appartments_within_reach
+
+def reach_table_within(reach_table, max_weight):
+  """
+  The pairs of a table computed with a larger cutoff that are within max_weight, to answer several thresholds from one search
+
+  >>> table = reach_table_within(ReachTable(np.array([0, 2, 3]), np.array([0, 2, 1]), np.array([5.0, 7.0, 1.0])), 6)
+  >>> table.indptr.tolist(), table.buildings.tolist(), table.distances.tolist()
+  ([0, 1, 2], [0, 1], [5.0, 1.0])
+  """
+  within = reach_table.distances <= max_weight
+  pois_count = reach_table.indptr.shape[0] - 1
+  indptr = np.zeros(pois_count + 1, dtype=np.int64)
+  np.cumsum(np.bincount(pair_pois(reach_table)[within], minlength=pois_count), out=indptr[1:])
+
+  return ReachTable(indptr, reach_table.buildings[within], reach_table.distances[within])
+
+def pair_subgroups(reach_table, poi_subgroups):
+  """
+  poi_subgroups: the subgroup column position of every POI, -1 for the POIs that are left out
+  Returns the pairs of the POIs that are not left out and their subgroup column
+  """
+  subgroups = np.asarray(poi_subgroups)[pair_pois(reach_table)]
+  counted = subgroups >= 0
+
+  return counted, subgroups[counted]
+
+def building_subgroup_counts(reach_table, poi_subgroups, buildings_count, subgroups_count):
+  """
+  Returns the buildings x subgroups matrix with the number of POIs of the subgroup within reach of the building
+
+  >>> table = ReachTable(np.array([0, 2, 3, 4]), np.array([0, 1, 1, 1]), np.array([5.0, 7.0, 1.0, 2.0]))
+  >>> building_subgroup_counts(table, [0, 0, -1], 2, 1).tolist()
+  [[1], [2]]
+  """
+  counted, subgroups = pair_subgroups(reach_table, poi_subgroups)
+  counts = np.zeros((buildings_count, subgroups_count), dtype=np.int64)
+  np.add.at(counts, (reach_table.buildings[counted], subgroups), 1)
+
+  return counts
+
+def building_subgroup_distances(reach_table, poi_subgroups, buildings_count, subgroups_count):
+  """
+  Returns the buildings x subgroups matrix with the distance to the nearest POI of the subgroup, inf when none is within reach
+
+  >>> table = ReachTable(np.array([0, 2, 3, 4]), np.array([0, 1, 1, 1]), np.array([5.0, 7.0, 1.0, 2.0]))
+  >>> building_subgroup_distances(table, [0, 0, -1], 3, 1).tolist()
+  [[5.0], [1.0], [inf]]
+  """
+  counted, subgroups = pair_subgroups(reach_table, poi_subgroups)
+  distances = np.full((buildings_count, subgroups_count), np.inf)
+  np.minimum.at(distances, (reach_table.buildings[counted], subgroups), reach_table.distances[counted])
+
+  return distances
+
+def reach_table_path(network_cache, weight_type, max_weight):
+  """
+  The reach tables are kept inside the cache of the snapped network they were computed on and go away with it
+  """
+  return os.path.join(network_cache, 'reach_tables', cache_key(weight_type, max_weight))
+
+def save_reach_table(path, reach_table):
+  save_arrays(path, reach_table._asdict(), {})
+
+def load_reach_table(path):
+  load_manifest(path)
+  return ReachTable(*(load_array(path, field) for field in ReachTable._fields))
+
+def cached_reach_table(path, compute_table):
+  """
+  path: reach_table_path, or None to always compute
+  compute_table: called to compute the table when it is not cached yet
+  """
+  if path and is_cached(path):
+    return load_reach_table(path)
+
+  reach_table = compute_table()
+  if path:
+    save_reach_table(path, reach_table)
+  return reach_table
@@ -0,0 +1,106 @@
+from collections import namedtuple
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+
+from csr_network import CSRNetwork
+
+# Built once per network and reused for every batch of points snapped to it.
+#   edge_tree:   STRtree over the edge segments, tree positions match edge_nodes
+#   edge_nodes:  list of (u, v) node keys for every indexed edge
+#   edge_coords: (m, 2, 2) start and end coordinates of every indexed edge
+#   node_tree:   KD-tree over the node coordinates, tree positions match node_keys
+#   node_keys:   the node keys of the network (integer ids for a CSRNetwork)
+SnappingIndex = namedtuple('SnappingIndex', ['edge_tree', 'edge_nodes', 'edge_coords', 'node_tree', 'node_keys'])
+
+def build_snapping_index(network):
+  """
+  Works for both an nx.Graph keyed by coordinates and a CSRNetwork
+  """
+  if isinstance(network, CSRNetwork):
+    node_keys = np.arange(network.node_coords.shape[0])
+    node_coords = network.node_coords
+    edge_nodes = [tuple(edge) for edge in network.edge_nodes.tolist()]
+    edge_coords = network.node_coords[network.edge_nodes]
+  else:
+    node_keys = list(network.nodes)
+    node_coords = np.array([network.nodes[node]['pos'] for node in node_keys], dtype=np.float64).reshape(-1, 2)
+    edge_nodes = list(network.edges())
+    edge_coords = np.array([(network.nodes[u]['pos'], network.nodes[v]['pos']) for u, v in edge_nodes], dtype=np.float64).reshape(-1, 2, 2)
+
+  edge_tree = shapely.STRtree(shapely.linestrings(edge_coords))
+  node_tree = cKDTree(node_coords)
+
+  return SnappingIndex(edge_tree, edge_nodes, edge_coords, node_tree, node_keys)
+
+def snap_points(geoms):
+  """
+  Points are kept as they are, every other geometry is substituted with its centroid
+
+  >>> snap_points([shapely.Point(1, 2), shapely.box(0, 0, 2, 2)]).tolist()
+  [<POINT (1 2)>, <POINT (1 1)>]
+  """
+  geoms = np.asarray(geoms, dtype=object)
+  is_point = shapely.get_type_id(geoms) == shapely.GeometryType.POINT
+
+  return np.where(is_point, geoms, shapely.centroid(geoms))
+
+def nearest_nodes(snapping_index, geoms):
+  """
+  Returns the nearest node key for every geometry
+  """
+  points = snap_points(geoms)
+  _distances, positions = snapping_index.node_tree.query(shapely.get_coordinates(points))
+
+  if isinstance(snapping_index.node_keys, np.ndarray):
+    return snapping_index.node_keys[positions]
+  return [snapping_index.node_keys[position] for position in positions]
+
+def nearest_edges(snapping_index, geoms):
+  """
+  Returns the position in snapping_index.edge_nodes of the nearest edge for every geometry.
+  On equal distances the edge that comes first in the network wins
+  """
+  points = snap_points(geoms)
+  input_positions, tree_positions = snapping_index.edge_tree.query_nearest(points, all_matches=True)
+
+  order = np.lexsort((tree_positions, input_positions))
+  _inputs, first = np.unique(input_positions[order], return_index=True)
+
+  return tree_positions[order][first]
+
+def project_to_nearest_edges(snapping_index, geoms):
+  """
+  Returns, for every geometry, the position of the nearest edge, the projected point coordinates
+  and the distance from the start of the edge to the projected point
+  """
+  points = shapely.get_coordinates(snap_points(geoms))
+  edge_positions = nearest_edges(snapping_index, geoms)
+
+  starts = snapping_index.edge_coords[edge_positions, 0]
+  directions = snapping_index.edge_coords[edge_positions, 1] - starts
+  squared_lengths = np.einsum('ij,ij->i', directions, directions)
+  along = np.einsum('ij,ij->i', points - starts, directions)
+  fractions = np.clip(np.divide(along, squared_lengths, out=np.zeros_like(along), where=squared_lengths > 0), 0, 1)
+
+  projected = starts + fractions[:, None] * directions
+
+  return edge_positions, projected, fractions * np.sqrt(squared_lengths)
+
+def snap_to_edges(snapping_index, geoms):
+  """
+  Snaps without changing the network. Returns, for every geometry, the position of the nearest edge
+  and the fraction of the edge between its first node and the projected point
+
+  >>> from csr_network import csr_network_from_edges
+  >>> snapping_index = build_snapping_index(csr_network_from_edges([(4.0, 2.0), (0.9, 5.8)], [(0, 1)], {'length': [4.9]}))
+  >>> snap_to_edges(snapping_index, [shapely.Point(0.9, 5.8)])[1].tolist()
+  [1.0]
+  """
+  edge_positions, _projected, offsets = project_to_nearest_edges(snapping_index, geoms)
+  segments = snapping_index.edge_coords[edge_positions]
+  edge_lengths = np.hypot(*(segments[:, 1] - segments[:, 0]).T)
+  # Rounding can put the fraction of a point at the end of an edge just over 1, which would give the other end a negative cost
+  fractions = np.clip(np.divide(offsets, edge_lengths, out=np.zeros_like(offsets), where=edge_lengths > 0), 0, 1)
+
+  return edge_positions, fractions
@@ -0,0 +1,94 @@
+from collections import namedtuple
+import math
+import shapely
+
+from network import build_network_from_geodataframe, extend_network_with
+from snapping import build_snapping_index, snap_points
+from compute_location_reach import compute_absolute_reach
+
+# Features are expected within SNAP_MARGIN meters of their nearest edge
+SNAP_MARGIN = 200
+
+# A tile of the city and the areas loaded to compute the reach of the features inside it.
+#   bounds:          (xmin, ymin, xmax, ymax) - the tile, a feature belongs to the tile its point is in
+#   features_bounds: bounds grown by the cutoff and twice the snap margin, every feature that can reach or be reached
+#                    by a feature of the tile is in it
+#   network_bounds:  features_bounds grown by a snap margin, every feature of features_bounds finds its nearest edge in it
+#                    and every path within the cutoff of a feature of the tile is in it
+Tile = namedtuple('Tile', ['bounds', 'features_bounds', 'network_bounds'])
+
+def grow_bounds(bounds, margin):
+  xmin, ymin, xmax, ymax = bounds
+  return (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+
+def city_tiles(bounds, tile_size, max_weight, snap_margin = SNAP_MARGIN):
+  """
+  Splits bounds in a grid of tile_size x tile_size tiles.
+  max_weight: the cutoff in meters - the network weight of a path is never less than its length in the plane,
+    for a cutoff in minutes pass the longest distance walked in that time
+
+  >>> tiles = city_tiles((0, 0, 1500, 900), 1000, 300, snap_margin = 50)
+  >>> [tile.bounds for tile in tiles]
+  [(0.0, 0.0, 1000.0, 1000.0), (1000.0, 0.0, 2000.0, 1000.0)]
+  >>> tiles[0].features_bounds, tiles[0].network_bounds
+  ((-400.0, -400.0, 1400.0, 1400.0), (-450.0, -450.0, 1450.0, 1450.0))
+  """
+  xmin, ymin, xmax, ymax = (float(bound) for bound in bounds)
+  columns = max(math.ceil((xmax - xmin) / tile_size), 1)
+  rows = max(math.ceil((ymax - ymin) / tile_size), 1)
+
+  tiles = []
+  for row in range(rows):
+    for column in range(columns):
+      tile_bounds = (xmin + column * tile_size, ymin + row * tile_size, xmin + (column + 1) * tile_size, ymin + (row + 1) * tile_size)
+      features_bounds = grow_bounds(tile_bounds, max_weight + 2 * snap_margin)
+      tiles.append(Tile(tile_bounds, features_bounds, grow_bounds(features_bounds, snap_margin)))
+
+  return tiles
+
+def within_tile(geoms, bounds):
+  """
+  The geometries whose snap point is in bounds, the right and top edges belong to the next tile
+
+  >>> within_tile([shapely.Point(0, 0), shapely.Point(10, 5), shapely.box(6, 6, 10, 10)], (0, 0, 10, 10)).tolist()
+  [True, False, True]
+  """
+  coords = shapely.get_coordinates(snap_points(geoms)).reshape(-1, 2)
+  xmin, ymin, xmax, ymax = bounds
+
+  return (coords[:, 0] >= xmin) & (coords[:, 0] < xmax) & (coords[:, 1] >= ymin) & (coords[:, 1] < ymax)
+
+def untimed(stage, run):
+  return run()
+
+def compute_tiled_absolute_reach(load_tile, tiles, weight_type = 'length', max_weight = 1000, workers = 1, timed = untimed):
+  """
+  compute_absolute_reach over the whole city, one tile at a time, only a tile and its halo are in memory at once.
+  Every feature is reported by the tile it is in, with the same reach as a single global run.
+
+  load_tile: called with a Tile, returns the pedestrian network gdf in tile.network_bounds and the dict poi_type -> gdf
+    and the residential buildings gdf in tile.features_bounds
+  timed: called with the stage ('build'|'snapping'|'reach') and a function running it for a tile, returns what it returns
+    (benchmark.py times the stages of all tiles with it)
+  Yields the tile, its dict poi_type -> gdf_poi_reach and its gdf_residentials_reach
+  """
+  for tile in tiles:
+    gdf_pedestrian_network, pois, gdf_residentials = load_tile(tile)
+    in_tile = {poi_type: within_tile(gdf_poi_type.geom, tile.bounds) for poi_type, gdf_poi_type in pois.items()}
+    residentials_in_tile = within_tile(gdf_residentials.geom, tile.bounds)
+    if gdf_pedestrian_network.empty or not (residentials_in_tile.any() or any(poi_in_tile.any() for poi_in_tile in in_tile.values())):
+      continue
+
+    pedestrian_network = timed('build', lambda: build_network_from_geodataframe(gdf_pedestrian_network, backend = 'csr'))
+
+    def snap():
+      snapping_index = build_snapping_index(pedestrian_network)
+      for gdf in [*pois.values(), gdf_residentials]:
+        extend_network_with(pedestrian_network, gdf, snapping_index)
+
+    timed('snapping', snap)
+    pois_reach, gdf_residentials_reach = timed('reach', lambda: compute_absolute_reach(pedestrian_network, pois, gdf_residentials, weight_type, max_weight, workers))
+
+    # The features of the halo are reported by their own tiles
+    pois_reach = {poi_type: gdf_poi_reach[in_tile[poi_type]] for poi_type, gdf_poi_reach in pois_reach.items()}
+    yield tile, pois_reach, gdf_residentials_reach[residentials_in_tile]
@@ -1,29 +1,42 @@
 import folium
 
-from helpers import crs_transform_coords
+from helpers import crs_transform_coords, crs_transform_array
+import numpy as np
 import pandas as pd
 import os
 from dotenv import load_dotenv
 
 from database import db_engine, gdf_from_sql
 from queries import pedestrian_network_query, administrative_regions_query, residential_buildings_query
-from network import build_network_from_geodataframe
-from helpers import crs_transform_coords
+from network_cache import NETWORK_CACHE_DIR, cache_path
+from parquet_store import read_table
+from pipeline import data_hash
+from network import cached_network, network_segments_from_geodataframe
 
 
 # Load environment variables from a .env file
 load_dotenv()
-database = db_engine(os.getenv('DB_CONNECTION_STRING'))
 
 SCOPE = 'Lozenec'
 SCHEMA = 'zvezdi_work'
 
-with database.connect() as db_connection:
-  gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_query(SCOPE))
-  gdf_adm_regions = gdf_from_sql(db_connection, administrative_regions_query())
-  gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
+# Get data, from an offline GeoParquet data directory (see main.py) when REACH_DATA_DIR is set
+DATA_DIR = os.getenv('REACH_DATA_DIR')
+if DATA_DIR:
+  gdf_pedestrian_network = read_table(DATA_DIR, 'pedestrian_network')
+  gdf_adm_regions = read_table(DATA_DIR, 'gen_adm_regions', columns=['id', 'geom', 'obns_cyr']).rename(columns={'obns_cyr': 'municipality'})
+  gdf_residential_buildings_lozenec = read_table(DATA_DIR, 'residential_buildings')
+else:
+  database = db_engine(os.getenv('DB_CONNECTION_STRING'))
+  with database.connect() as db_connection:
+    gdf_pedestrian_network = gdf_from_sql(db_connection, pedestrian_network_query(SCOPE))
+    gdf_adm_regions = gdf_from_sql(db_connection, administrative_regions_query())
+    gdf_residential_buildings_lozenec = gdf_from_sql(db_connection, residential_buildings_query(SCOPE))
+
+# Keyed by the segments of the pedestrian network like the network caches of main.py
+pedestrian_network_segments = network_segments_from_geodataframe(gdf_pedestrian_network)
+pedestrian_network = cached_network(cache_path(NETWORK_CACHE_DIR, data_hash(pedestrian_network_segments), {'backend': 'networkx'}), lambda: pedestrian_network_segments)
 
-pedestrian_network = build_network_from_geodataframe(gdf_pedestrian_network, save_as = "lib/saves/pedestrian_network.graph")
 
 points = [
  [321540.0290951831, 4730158.139271268],
@@ -450,17 +463,17 @@ center_lon, center_lat = crs_transform_coords(df.x.mean(), df.y.mean())
 m = folium.Map(location=[center_lat, center_lon], zoom_start=14)
 
 # Add edges to the map
-for start_node, end_node in pedestrian_network.edges:
-  start_lon, start_lat = crs_transform_coords(start_node[0], start_node[1])
-  end_lon, end_lat = crs_transform_coords(end_node[0], end_node[1])
+edges = list(pedestrian_network.edges)
+edges_4326 = crs_transform_array(np.array(edges, dtype=np.float64).reshape(-1, 2), swap_coords=True).reshape(-1, 2, 2)
+for start, end in edges_4326:
   folium.PolyLine(
-    locations=[[start_lat, start_lon], [end_lat, end_lon]],
+    locations=[start.tolist(), end.tolist()],
     color='#62635b'
   ).add_to(m)
 
 # Add nodes to the map
-for node in pedestrian_network.nodes:
-  lon, lat = crs_transform_coords(node[0], node[1])
+nodes = list(pedestrian_network.nodes)
+for node, (lat, lon) in zip(nodes, crs_transform_array(np.array(nodes, dtype=np.float64).reshape(-1, 2), swap_coords=True)):
   folium.CircleMarker(
     location=[lat, lon],
     radius=5,
@@ -471,8 +484,7 @@ for node in pedestrian_network.nodes:
     popup=f'Node {node}'
   ).add_to(m)
 
-for idx, row in df.iterrows():
-  lon, lat = crs_transform_coords(row.x, row.y)
+for lat, lon in crs_transform_array(df[['x', 'y']].to_numpy(), swap_coords=True):
   marker = folium.CircleMarker(
     location=[lat, lon],
     radius=7,